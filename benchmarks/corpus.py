@@ -0,0 +1,144 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Benchmark corpus module
+
+Builds the samples sent to the provider. Every scenario varies the number of documents, their size, the archive
+format and how many archives are nested.
+"""
+import base64
+import gzip
+import io
+import random
+import tarfile
+import zipfile
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam',
+         'quis', 'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip', 'ex', 'ea', 'commodo']
+
+# archive formats, with the extension and mimetype of the archive
+FORMATS = {
+    'zip': ('.zip', 'application/zip'),
+    'tar': ('.tar', 'application/x-tar'),
+    'tar.gz': ('.tar.gz', 'application/gzip'),
+    'gzip': ('.gz', 'application/gzip')
+}
+
+# documents nested in more than compression_recursive_extract_level archives are rejected by the provider
+SCENARIOS = {
+    'txt': {'files': 1, 'size': 16384, 'format': None, 'depth': 0},
+    'zip-10': {'files': 10, 'size': 65536, 'format': 'zip', 'depth': 1},
+    'zip-nested': {'files': 5, 'size': 65536, 'format': 'zip', 'depth': 2},
+    'tar-gz-large': {'files': 3, 'size': 4194304, 'format': 'tar.gz', 'depth': 1},
+    'gzip': {'files': 1, 'size': 1048576, 'format': 'gzip', 'depth': 1}
+}
+
+
+def get_document(size, rnd):
+    """
+    Get a text document
+    :param size: Document size in bytes
+    :param rnd: Random generator
+    :return: Document content
+    """
+    content = io.StringIO()
+    length = 0
+    while length < size:
+        line = ' '.join(rnd.choice(WORDS) for _ in range(12)) + '.\n'
+        content.write(line)
+        length += len(line)
+
+    return content.getvalue()[:size].encode('utf-8')
+
+
+def _archive(files, archive_format):
+    """
+    Pack a list of files into an archive
+    :param files: List of (filename, content) tuples
+    :param archive_format: Archive format, one of FORMATS
+    :return: Archive content
+    """
+    archive = io.BytesIO()
+    if archive_format == 'zip':
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for filename, content in files:
+                zip_file.writestr(filename, content)
+    elif archive_format == 'gzip':
+        if len(files) != 1:
+            raise ValueError('gzip archives contain a single file')
+        with gzip.GzipFile(filename=files[0][0], fileobj=archive, mode='wb') as gzip_file:
+            gzip_file.write(files[0][1])
+    else:
+        with tarfile.open(fileobj=archive, mode='w:gz' if archive_format == 'tar.gz' else 'w') as tar_file:
+            for filename, content in files:
+                info = tarfile.TarInfo(filename)
+                info.size = len(content)
+                tar_file.addfile(info, io.BytesIO(content))
+
+    return archive.getvalue()
+
+
+def get_sample_data(scenario, seed=0):
+    """
+    Build the sample of a scenario
+    :param scenario: dict with the number of files, their size, the archive format and the nesting depth
+    :param seed: Seed of the documents content, every seed builds different documents
+    :return: tuple with the filename, the mimetype and the content of the sample
+    """
+    rnd = random.Random(seed)
+    files = [('document_{}_{}.txt'.format(seed, index), get_document(scenario['size'], rnd))
+             for index in range(scenario['files'])]
+
+    if scenario['format'] is None or scenario['depth'] == 0:
+        if len(files) != 1:
+            raise ValueError('Samples without archive contain a single file')
+        return files[0][0], 'text/plain', files[0][1]
+
+    extension, mimetype = FORMATS[scenario['format']]
+    filename = files[0][0] if scenario['format'] == 'gzip' else 'sample_{}'.format(seed)
+    content = _archive(files, scenario['format'])
+    filename += extension
+    for level in range(1, scenario['depth']):
+        # gzip can only wrap a single file, the outer levels are always zip archives
+        content = _archive([(filename, content)], 'zip')
+        filename = 'level_{}_{}.zip'.format(level, seed)
+        mimetype = 'application/zip'
+
+    return filename, mimetype, content
+
+
+def get_request(scenario, seed=0, learner_id='benchmark-learner'):
+    """
+    Build the verification request of a scenario, as the TeSLA CE platform sends it
+    :param scenario: Scenario definition
+    :param seed: Seed of the documents content
+    :param learner_id: Learner of the request
+    :return: tesla_ce_provider.models.base.Request
+    """
+    from tesla_ce_provider.models.base import Request
+
+    filename, mimetype, content = get_sample_data(scenario, seed)
+
+    return Request({
+        'id': seed,
+        'learner_id': learner_id,
+        'data': {
+            'learner_id': learner_id,
+            'data': 'data:{};base64,{}'.format(mimetype, base64.b64encode(content).decode('utf-8')),
+            'instruments': [6],
+            'metadata': {'context': {}, 'mimetype': mimetype, 'filename': filename}
+        },
+        'validations': []
+    })
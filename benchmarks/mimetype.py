@@ -0,0 +1,240 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Mimetype detection benchmark module
+
+Detects the mimetype of thousands of small files with python-magic and with the provider detection layer, and
+reports the files detected per second by every method and whether the detected mimetypes differ:
+
+    python benchmarks/mimetype.py --files 5000 --threads 4
+"""
+import argparse
+import collections
+import concurrent.futures
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCHMARKS_PATH = os.path.dirname(os.path.realpath(__file__))
+DATA_PATH = os.path.join(os.path.dirname(BENCHMARKS_PATH), 'src', 'tests', 'data', 'valid')
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_PATH), 'src'))
+sys.path.insert(0, BENCHMARKS_PATH)
+
+# the provider is run without a TeSLA CE platform
+os.environ.setdefault('DEBUG', '1')
+
+import magic  # noqa: E402
+from corpus import WORDS  # noqa: E402
+from urkund.provider import detection  # noqa: E402
+
+
+def get_text(rnd, size):
+    """
+    Get a plain text document
+    :param rnd: Random generator
+    :param size: Approximate document size in bytes
+    :return: Document content
+    """
+    sentences = []
+    length = 0
+    while length < size:
+        sentence = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(6, 16))).capitalize() + '.'
+        sentences.append(sentence)
+        length += len(sentence) + 1
+
+    return '\n'.join(sentences).encode('utf-8')
+
+
+def get_ooxml(rnd, folder):
+    """
+    Get an Office Open XML document
+    :param rnd: Random generator
+    :param folder: Folder of the document parts, word/, ppt/ or xl/
+    :return: Document content
+    """
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', '<Types/>')
+        archive.writestr('_rels/.rels', '<Relationships/>')
+        archive.writestr(folder + 'document.xml', b'<document>' + get_text(rnd, 2048) + b'</document>')
+
+    return content.getvalue()
+
+
+def get_zip(rnd):
+    """
+    Get a zip archive with a text document
+    :param rnd: Random generator
+    :return: Archive content
+    """
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('lorem.txt', get_text(rnd, 2048))
+
+    return content.getvalue()
+
+
+def read_data(filename):
+    """
+    Read a file of the test data
+    :param filename: File name
+    :return: File content
+    """
+    with open(os.path.join(DATA_PATH, filename), 'rb') as file:
+        return file.read()
+
+
+# generators of the benchmark files by extension
+GENERATORS = {
+    'txt': lambda rnd: get_text(rnd, rnd.randint(256, 4096)),
+    'pdf': lambda rnd: b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Type /Catalog >>\nendobj\n' + get_text(rnd, 1024),
+    'rtf': lambda rnd: b'{\\rtf1\\ansi\\deff0 {\\fonttbl {\\f0 Times;}}\\f0 ' + get_text(rnd, 1024) + b'}',
+    'docx': lambda rnd: get_ooxml(rnd, 'word/'),
+    'pptx': lambda rnd: get_ooxml(rnd, 'ppt/'),
+    'xlsx': lambda rnd: get_ooxml(rnd, 'xl/'),
+    'odt': lambda rnd: read_data('lorem.odt'),
+    'doc': lambda rnd: read_data('lorem.doc'),
+    'zip': get_zip,
+    'csv': lambda rnd: b'\n'.join(b','.join(w.encode() for w in rnd.sample(WORDS, 4)) for _ in range(20)),
+    'c': lambda rnd: b'#include <stdio.h>\n\nint main(void) {\n    return 0;\n}\n'
+}
+
+
+def create_files(directory, count, seed):
+    """
+    Create the benchmark files
+    :param directory: Directory where the files are created
+    :param count: Number of files
+    :param seed: Random seed
+    :return: List of file paths
+    """
+    rnd = random.Random(seed)
+    extensions = list(GENERATORS.keys())
+    paths = []
+    for index in range(count):
+        extension = extensions[index % len(extensions)]
+        path = os.path.join(directory, '{}.{}'.format(index, extension))
+        with open(path, 'wb') as file:
+            file.write(GENERATORS[extension](rnd))
+        paths.append(path)
+
+    return paths
+
+
+def detect_from_file(path):
+    """
+    Detect the mimetype of a file with the python-magic default instance, opening the file again
+    """
+    return magic.from_file(path, mime=True)
+
+
+def detect_from_buffer(path):
+    """
+    Detect the mimetype of a file from its first bytes with the python-magic default instance
+    """
+    with open(path, 'rb') as file:
+        header = file.read(detection.SNIFF_SIZE)
+        mimetype = magic.from_buffer(header, mime=True)
+        if mimetype in detection.WHOLE_FILE_MIMETYPES and len(header) == detection.SNIFF_SIZE:
+            file.seek(0)
+            mimetype = magic.from_descriptor(file.fileno(), mime=True)
+
+    return mimetype
+
+
+def detect_provider(path):
+    """
+    Detect the mimetype of a file with the provider detection layer
+    """
+    with open(path, 'rb') as file:
+        return detection.detect_mimetype(file)
+
+
+# detection methods, the first one is the baseline of the speedups
+METHODS = {
+    'magic.from_file': detect_from_file,
+    'magic.from_buffer': detect_from_buffer,
+    'detect_mimetype': detect_provider
+}
+
+
+def run_method(method, paths, threads):
+    """
+    Detect the mimetype of all the files
+    :param method: Detection function
+    :param paths: List of file paths
+    :param threads: Number of threads detecting files
+    :return: Tuple with the elapsed seconds and the detected mimetypes
+    """
+    start = time.perf_counter()
+    if threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            mimetypes = list(executor.map(method, paths))
+    else:
+        mimetypes = [method(path) for path in paths]
+
+    return time.perf_counter() - start, mimetypes
+
+
+def main(argv=None):
+    """
+    Run the benchmark from the command line
+    :param argv: Command line arguments
+    :return: Exit code, 1 if the detection layer gives a different mimetype than python-magic
+    """
+    parser = argparse.ArgumentParser(description='Mimetype detection benchmark')
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--rounds', type=int, default=3, help='Runs of every method, the fastest one is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = create_files(directory, args.files, args.seed)
+        results = {}
+        baseline = None
+        for name, method in METHODS.items():
+            elapsed, mimetypes = min((run_method(method, paths, args.threads) for _ in range(args.rounds)),
+                                     key=lambda run: run[0])
+            results[name] = mimetypes
+            if baseline is None:
+                baseline = elapsed
+            print('{:<20} {:8.3f} s {:10.0f} files/s {:6.2f}x'.format(name, elapsed, len(paths) / elapsed,
+                                                                     baseline / elapsed))
+
+        signatures = collections.Counter()
+        for path in paths:
+            with open(path, 'rb') as file:
+                header = file.read(detection.SNIFF_SIZE)
+            if detection.get_signature_mimetype(header) is not None:
+                signatures[os.path.splitext(path)[1][1:]] += 1
+        print('Detected from the signature: {:.0%} ({})'.format(
+            sum(signatures.values()) / len(paths), ', '.join(sorted(signatures.keys()))))
+
+        differences = collections.Counter()
+        for path, expected, mimetype in zip(paths, results['magic.from_buffer'], results['detect_mimetype']):
+            if expected != mimetype:
+                differences[(os.path.splitext(path)[1][1:], expected, mimetype)] += 1
+        for (extension, expected, mimetype), count in differences.items():
+            print('Different mimetype of {} .{} files: {} instead of {}'.format(count, extension, mimetype, expected))
+
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Provider benchmark module
+
+Runs UrkundProvider.verify and on_notification against the local Urkund simulator and reports throughput,
+latency percentiles, peak memory and the number of Urkund API calls of every scenario:
+
+    python benchmarks/run.py --scenario zip-10 --requests 200 --concurrency 8 --save benchmarks/baseline.json
+    python benchmarks/run.py --scenario zip-10 --requests 200 --concurrency 8 --compare benchmarks/baseline.json
+
+Every scenario runs in its own process, so its peak RSS is not affected by the previous ones.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_PATH), 'src'))
+sys.path.insert(0, BENCHMARKS_PATH)
+
+# the provider is run without a TeSLA CE platform
+os.environ.setdefault('DEBUG', '1')
+
+from corpus import SCENARIOS, FORMATS, get_request  # noqa: E402
+
+# metrics compared with the baseline, and whether a higher value is better
+COMPARED_METRICS = {
+    'throughput': True,
+    'verify_p95': False,
+    'notification_p95': False,
+    'total_p95': False,
+    'peak_rss_kib': False,
+    'http_calls': False
+}
+
+
+def get_percentile(values, percentile):
+    """
+    Get a percentile of a list of values, using the nearest rank
+    :param values: List of values
+    :param percentile: Percentile, from 0 to 100
+    :return: Percentile value, None if there are no values
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = max(0, int(round(percentile / 100.0 * len(values) + 0.5)) - 1)
+
+    return values[min(rank, len(values) - 1)]
+
+
+def get_provider(base_url, options):
+    """
+    Create a provider using the simulator
+    :param base_url: Base url of the simulator
+    :param options: Provider options
+    :return: UrkundProvider
+    """
+    from urkund import UrkundProvider
+
+    provider = UrkundProvider()
+    provider.set_logger(lambda *args, **kwargs: None)
+    provider.set_credential('URKUND_USER', 'benchmark')
+    provider.set_credential('URKUND_PASSWORD', 'benchmark')
+    provider.set_credential('URKUND_UNIT', '1')
+    provider.set_credential('URKUND_ORGANIZATION', '1')
+    provider.set_credential('URKUND_SUBORGANIZATION', None)
+    provider.set_credential('URKUND_DEFAULT_EMAIL_RECEIVER', 'noreply@tesla-ce.eu')
+    provider.config.update(options)
+    provider.config['base_url'] = base_url
+
+    return provider
+
+
+def run_request(provider, request, poll_interval, max_notifications):
+    """
+    Verify a request and process its notifications until the final result is available. Notifications are
+    processed as soon as they are created, replacing the ones with the same key as the platform does.
+    :param provider: UrkundProvider
+    :param request: Verification request
+    :param poll_interval: Seconds to wait before processing a result check notification
+    :param max_notifications: Maximum number of notifications processed
+    :return: dict with the verify, notifications and total seconds, the number of notifications and whether the
+             final result was obtained
+    """
+    from tesla_ce_provider import result
+
+    start = time.perf_counter()
+    completed = not isinstance(provider.verify(request, {}), result.VerificationDelayedResult)
+    verify_time = time.perf_counter() - start
+
+    notification_time = 0
+    processed = 0
+    while len(provider.notifications) > 0 and processed < max_notifications:
+        pending = {}
+        for notification in provider.notifications:
+            pending[notification.key] = notification
+        provider.notifications.clear()
+
+        for notification in pending.values():
+            if not notification.key.startswith('tukrund_send_data'):
+                time.sleep(poll_interval)
+            notification_start = time.perf_counter()
+            provider.on_notification(notification.key, notification.info)
+            notification_time += time.perf_counter() - notification_start
+            processed += 1
+
+    return {
+        'verify': verify_time,
+        'notifications': notification_time,
+        'total': time.perf_counter() - start,
+        'notification_count': processed,
+        'completed': completed or len(provider.delayed_results) > 0
+    }
+
+
+def run_scenario(name, scenario, args):
+    """
+    Run a scenario against a new simulator
+    :param name: Scenario name
+    :param scenario: Scenario definition
+    :param args: Command line arguments
+    :return: Scenario report
+    """
+    from urkund.provider.utils import shutdown_extraction_pools
+    from urkund.urkund_lib import clear_urkund_libs
+    from tests.simulator import UrkundSimulator
+
+    options = {}
+    for option in args.option:
+        key, value = option.split('=', 1)
+        options[key] = json.loads(value)
+
+    error_rates = {}
+    for error_rate in args.error_rate:
+        error, rate = error_rate.split('=')
+        error_rates[error if error == 'timeout' else int(error)] = float(rate)
+
+    simulator = UrkundSimulator(latency=args.latency, latency_jitter=args.latency_jitter, error_rates=error_rates,
+                                accept_after=args.analyze_after / 2, analyze_after=args.analyze_after,
+                                timeout_delay=args.timeout_delay, seed=args.seed).start()
+    clear_urkund_libs()
+
+    requests = [get_request(scenario, seed=args.seed * args.requests + index) for index in range(args.requests)]
+    providers = threading.local()
+
+    def run(request):
+        if not hasattr(providers, 'provider'):
+            providers.provider = get_provider(simulator.base_url, options)
+        provider = providers.provider
+        provider.notifications.clear()
+        provider.delayed_results.clear()
+        return run_request(provider, request, args.poll_interval, args.max_notifications)
+
+    try:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            timings = list(executor.map(run, requests))
+        elapsed = time.perf_counter() - start
+        http_calls = simulator.get_stats()
+    finally:
+        simulator.stop()
+        shutdown_extraction_pools()
+
+    report = {
+        'scenario': dict(scenario, name=name),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'completed': sum(1 for timing in timings if timing['completed']),
+        'elapsed': elapsed,
+        'throughput': args.requests / elapsed,
+        'notifications': sum(timing['notification_count'] for timing in timings),
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'http_calls': sum(http_calls.values()),
+        'http_calls_by_endpoint': http_calls
+    }
+    for metric in ('verify', 'notifications', 'total'):
+        values = [timing[metric] for timing in timings]
+        prefix = 'notification' if metric == 'notifications' else metric
+        for percentile in (50, 95, 99):
+            report['{}_p{}'.format(prefix, percentile)] = get_percentile(values, percentile)
+
+    return report
+
+
+def compare(reports, baseline, tolerance):
+    """
+    Compare the reports with a baseline
+    :param reports: Scenario reports by name
+    :param baseline: Baseline reports by name
+    :param tolerance: Allowed relative change before a metric is considered a regression
+    :return: List of regression messages
+    """
+    regressions = []
+    for name, report in reports.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            current = report.get(metric)
+            previous = baseline[name].get(metric)
+            if not current or not previous:
+                continue
+            change = (current - previous) / previous
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.1%})'.format(
+                    name, metric, previous, current, change))
+
+    return regressions
+
+
+def print_report(report):
+    """
+    Print a scenario report
+    :param report: Scenario report
+    :return:
+    """
+    print('{} ({} requests, concurrency {}, {}/{} completed)'.format(
+        report['scenario']['name'], report['requests'], report['concurrency'], report['completed'],
+        report['requests']))
+    print('  throughput     {:10.2f} requests/s'.format(report['throughput']))
+    for metric in ('verify', 'notification', 'total'):
+        print('  {:<14} p50 {:8.4f}s  p95 {:8.4f}s  p99 {:8.4f}s'.format(
+            metric, report[metric + '_p50'], report[metric + '_p95'], report[metric + '_p99']))
+    print('  peak RSS       {:10d} KiB'.format(report['peak_rss_kib']))
+    print('  HTTP calls     {:10d} {}'.format(
+        report['http_calls'], json.dumps(report['http_calls_by_endpoint'], sort_keys=True)))
+
+
+def get_scenarios(args):
+    """
+    Get the scenarios selected on the command line
+    :param args: Command line arguments
+    :return: dict of scenario definitions by name
+    """
+    if args.files is not None or args.size is not None or args.format is not None or args.depth is not None:
+        scenario = {'files': args.files or 1, 'size': args.size or 16384, 'format': args.format,
+                    'depth': args.depth if args.depth is not None else int(args.format is not None)}
+        return {'custom': scenario}
+
+    names = args.scenario or list(SCENARIOS.keys())
+    for name in names:
+        if name not in SCENARIOS:
+            raise SystemExit('Unknown scenario {}, available: {}'.format(name, ', '.join(SCENARIOS.keys())))
+
+    return {name: SCENARIOS[name] for name in names}
+
+
+def main(argv=None):
+    """
+    Run the benchmark from the command line
+    :param argv: Command line arguments
+    :return: Exit code, 1 if there are regressions
+    """
+    parser = argparse.ArgumentParser(description='UrkundProvider benchmark')
+    parser.add_argument('--scenario', action='append', help='Scenario to run, all of them if not provided: ' +
+                        ', '.join(SCENARIOS.keys()))
+    parser.add_argument('--files', type=int, help='Documents of a custom scenario')
+    parser.add_argument('--size', type=int, help='Document size in bytes of a custom scenario')
+    parser.add_argument('--format', choices=list(FORMATS.keys()), help='Archive format of a custom scenario')
+    parser.add_argument('--depth', type=int, help='Archive nesting depth of a custom scenario')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--option', action='append', default=[], metavar='OPTION=JSON',
+                        help='Provider option, e.g. compression_recursive_extract_level=5')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds the simulator adds to every response')
+    parser.add_argument('--latency-jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', action='append', default=[], metavar='CODE=RATE')
+    parser.add_argument('--timeout-delay', type=float, default=30)
+    parser.add_argument('--analyze-after', type=float, default=0, help='Seconds before a document is Analyzed')
+    parser.add_argument('--poll-interval', type=float, default=0,
+                        help='Seconds waited before processing every result check notification')
+    parser.add_argument('--max-notifications', type=int, default=100,
+                        help='Maximum notifications processed by request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='Save the reports as a baseline JSON file')
+    parser.add_argument('--compare', help='Compare the reports with a baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change of a metric considered a regression')
+    args = parser.parse_args(argv)
+
+    reports = {}
+    context = multiprocessing.get_context('spawn')
+    for name, scenario in get_scenarios(args).items():
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            reports[name] = executor.submit(run_scenario, name, scenario, args).result()
+        print_report(reports[name])
+
+    if args.save is not None:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(reports, baseline_file, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            regressions = compare(reports, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,5 @@
 #!/bin/bash
 
-/venv/bin/celery -A tesla_ce_provider inspect ping -d celery@"$HOSTNAME" --timeout=30
\ No newline at end of file
+# the worker answers with its warm up state, connection pool state and cache hit rates. Urkund is not requested, so
+# an Urkund outage does not restart live workers: use the urkund_probe command to check the Urkund API latency.
+/venv/bin/celery -A tesla_ce_provider inspect urkund_health -d celery@"$HOSTNAME" --timeout=30
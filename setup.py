@@ -44,5 +44,8 @@ setuptools.setup(
                     ],
     },
     include_package_data=True,
-    install_requires=requirements
+    install_requires=requirements,
+    extras_require={
+        'async': ['aiohttp>=3.8'],
+    }
 )
@@ -152,3 +152,27 @@ def mock_urkund_lib_all_ok(mocker, urkund_provider):
     }]
 
     mocker.patch('urkund.urkund_lib.submissions.Submissions.result', return_value=mock_module)
+
+
+@pytest.fixture
+def urkund_lib_module(tesla_ce_base_provider):
+    """
+    UrkundLib module fixture. Importing the urkund package requires the TeSLA CE client to be mocked.
+    :param tesla_ce_base_provider:
+    :return:
+    """
+    from urkund import urkund_lib
+
+    return urkund_lib
+
+
+@pytest.fixture
+def provider_utils(tesla_ce_base_provider):
+    """
+    Provider utils module fixture. Importing the urkund package requires the TeSLA CE client to be mocked.
+    :param tesla_ce_base_provider:
+    :return:
+    """
+    from urkund.provider import utils
+
+    return utils
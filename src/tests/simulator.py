@@ -0,0 +1,479 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Urkund API simulator module
+
+Local HTTP server implementing the Urkund API endpoints used by UrkundLib, with configurable latency, error rates
+and analysis durations. It is meant for tests and benchmarks without network access, run from the src folder:
+
+    python -m tests.simulator --port 8080 --latency 0.05 --analyze-after 30
+"""
+import argparse
+import base64
+import datetime
+import json
+import random
+import threading
+import time
+import urllib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ERROR_MESSAGES = {
+    400: 'Bad request',
+    404: 'Not found',
+    410: 'Service not available',
+    413: 'Request too large',
+    415: 'Media type not supported'
+}
+
+
+class UrkundSimulator:
+    """
+    UrkundSimulator class
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, latency_jitter=0, error_rates=None,
+                 accept_after=1, analyze_after=5, analysis_error_rate=0, timeout_delay=60, unit_id=1,
+                 organization_id=1, sub_organization_id=None, suffix='.test@analysis.urkund.com', seed=None):
+        """
+        :param host: Address the server listens on
+        :param port: Port the server listens on, a free port is used if 0
+        :param latency: Seconds added to every response
+        :param latency_jitter: Maximum random seconds added to the latency
+        :param error_rates: Probability of every error of the submission endpoints, by HTTP status code (400, 404,
+                            410, 413, 415) or 'timeout'
+        :param accept_after: Seconds before a submitted document is Accepted
+        :param analyze_after: Seconds before a submitted document is Analyzed
+        :param analysis_error_rate: Probability of a document ending in the Error state instead of Analyzed
+        :param timeout_delay: Seconds a response is delayed to simulate a timeout
+        :param unit_id: Id of the unit
+        :param organization_id: Id of the organization of the unit
+        :param sub_organization_id: Id of the sub organization of the organization
+        :param suffix: Suffix of the analysis addresses of the unit
+        :param seed: Seed of the random generator
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rates = dict(error_rates or {})
+        self.accept_after = accept_after
+        self.analyze_after = analyze_after
+        self.analysis_error_rate = analysis_error_rate
+        self.timeout_delay = timeout_delay
+        self.suffix = suffix
+
+        sub_organizations = []
+        if sub_organization_id is not None:
+            sub_organizations.append({'Id': sub_organization_id, 'Name': 'Simulated sub organization'})
+        self.unit = {
+            'Id': unit_id,
+            'Name': 'Simulated unit',
+            'Suffix': suffix,
+            'DateCreated': '01/01/2021 00:00:00 AM',
+            'Organizations': [
+                {'Id': organization_id, 'Name': 'Simulated organization', 'SubOrganizations': sub_organizations}
+            ]
+        }
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._receivers = {}
+        self._submissions = {}
+        self._next_id = 1
+        self._stats = {}
+
+        simulator = self
+
+        class Handler(_SimulatorHandler):
+            """ Handler bound to this simulator """
+            owner = simulator
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """
+        Base url of the simulated API
+        :return: str
+        """
+        return 'http://{}:{}/api/'.format(self._server.server_address[0], self._server.server_address[1])
+
+    def start(self):
+        """
+        Start the server in a background thread
+        :return:
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Run the server in the current thread
+        :return:
+        """
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+        Stop the server
+        :return:
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_stats(self):
+        """
+        Get the number of requests by endpoint
+        :return: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def count(self, endpoint):
+        """
+        Count a request to an endpoint
+        :param endpoint:
+        :return:
+        """
+        with self._lock:
+            self._stats[endpoint] = self._stats.get(endpoint, 0) + 1
+
+    def get_delay(self):
+        """
+        Get the latency of a response
+        :return: Seconds
+        """
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.latency_jitter)
+
+    def get_error(self):
+        """
+        Choose the error returned by a submission endpoint
+        :return: HTTP status code, 'timeout' or None
+        """
+        with self._lock:
+            for error, rate in self.error_rates.items():
+                if self._random.random() < rate:
+                    return error
+        return None
+
+    def add_receiver(self, receiver, analysis_address=None):
+        """
+        Create or update a receiver
+        :param receiver: Receiver sent to the API
+        :param analysis_address: Analysis address of the receiver, obtained from its email address if not provided
+        :return: Stored receiver
+        """
+        with self._lock:
+            if analysis_address is None:
+                analysis_address = receiver['EmailAddress'].split('@')[0] + self.suffix
+            stored = self._receivers.get(analysis_address, {'Id': len(self._receivers) + 1})
+            stored.update({
+                'AnalysisAddress': analysis_address,
+                'EmailAddress': receiver['EmailAddress'],
+                'FullName': receiver.get('FullName'),
+                'UnitId': self.unit['Id'],
+                'Organization': receiver.get('OrganizationId'),
+                'SubOrganization': receiver.get('SubOrganizationId')
+            })
+            self._receivers[analysis_address] = stored
+            return dict(stored)
+
+    def get_receiver(self, analysis_address):
+        """
+        Get a receiver. Every analysis address of the unit exists.
+        :param analysis_address:
+        :return: Receiver or None
+        """
+        with self._lock:
+            if analysis_address in self._receivers:
+                return dict(self._receivers[analysis_address])
+
+        if not analysis_address.endswith(self.suffix):
+            return None
+
+        return self.add_receiver({'EmailAddress': analysis_address, 'FullName': analysis_address}, analysis_address)
+
+    def delete_receiver(self, analysis_address):
+        """
+        Delete a receiver
+        :param analysis_address:
+        :return: Deleted receiver or None
+        """
+        with self._lock:
+            return self._receivers.pop(analysis_address, None)
+
+    def get_receivers(self):
+        """
+        Get all the receivers
+        :return: list
+        """
+        with self._lock:
+            return [dict(receiver) for receiver in self._receivers.values()]
+
+    def add_submission(self, receiver, external_id, filename, mimetype, size):
+        """
+        Store a submitted document. Sending again an external id returns the stored submission.
+        :return: Submission
+        """
+        with self._lock:
+            key = (receiver, external_id)
+            if key not in self._submissions:
+                error = self._random.random() < self.analysis_error_rate
+                self._submissions[key] = {
+                    'Id': self._next_id,
+                    'ExternalId': external_id,
+                    'Filename': filename,
+                    'MimeType': mimetype,
+                    'Size': size,
+                    'SubmittedAt': time.time(),
+                    'AnalysisError': error,
+                    'Significance': round(self._random.uniform(0, 100), 2)
+                }
+                self._next_id += 1
+
+            return self._get_submission(self._submissions[key])
+
+    def get_submissions(self, receiver, external_id=None):
+        """
+        Get the submissions of a receiver
+        :param receiver:
+        :param external_id: External id of the submission, all of them if not provided
+        :return: list
+        """
+        with self._lock:
+            return [self._get_submission(submission) for key, submission in self._submissions.items()
+                    if key[0] == receiver and (external_id is None or key[1] == external_id)]
+
+    def _get_submission(self, submission):
+        elapsed = time.time() - submission['SubmittedAt']
+        response = {
+            'Id': submission['Id'],
+            'ExternalId': submission['ExternalId'],
+            'Filename': submission['Filename'],
+            'MimeType': submission['MimeType'],
+            'Timestamp': datetime.datetime.utcfromtimestamp(submission['SubmittedAt']).strftime('%Y-%m-%dT%H:%M:%S'),
+            'Status': {'State': 'Submitted', 'ErrorCode': 0, 'Message': 'The document has been sent to URKUND.'},
+            'Document': None,
+            'Report': None,
+            'Subject': '',
+            'Message': '',
+            'Anonymous': None,
+            'AutoDeleteDocument': False
+        }
+
+        if elapsed >= self.analyze_after:
+            if submission['AnalysisError']:
+                response['Status'] = {'State': 'Error', 'ErrorCode': 5000,
+                                      'Message': 'General error during analysis process'}
+            else:
+                response['Status'] = {'State': 'Analyzed', 'ErrorCode': 0,
+                                      'Message': 'The document has been analyzed.'}
+                response['Document'] = {'Id': submission['Id'], 'Date': response['Timestamp']}
+                response['Report'] = {
+                    'Id': submission['Id'],
+                    'Significance': submission['Significance'],
+                    'MatchCount': int(submission['Significance'] * 10),
+                    'SourceCount': int(submission['Significance']),
+                    'ReportUrl': 'http://localhost/view/{}'.format(submission['Id']),
+                    'Warnings': []
+                }
+        elif elapsed >= self.accept_after:
+            response['Status'] = {'State': 'Accepted', 'ErrorCode': 0,
+                                  'Message': 'The document has been accepted by URKUND.'}
+
+        return response
+
+
+class _SimulatorHandler(BaseHTTPRequestHandler):
+    """ Request handler of the simulated Urkund API """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent together, otherwise delayed acknowledgements add latency to every response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    owner = None
+
+    def _get_path(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith('/api/'):
+            path = path[len('/api/'):]
+        return [urllib.parse.unquote(part) for part in path.strip('/').split('/')]
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return b''
+        return self.rfile.read(length)
+
+    def _send(self, status, body=None):
+        time.sleep(self.owner.get_delay())
+
+        content = b''
+        if body is not None:
+            content = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_error(self, error):
+        if error == 'timeout':
+            time.sleep(self.owner.timeout_delay)
+            error = 410
+        self._send(int(error), ERROR_MESSAGES.get(int(error), 'Error').encode('utf-8'))
+
+    def _check_auth(self):
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            self._send(401)
+            return False
+        return True
+
+    def do_GET(self):
+        """ Get units, receivers and submissions """
+        self._handle('GET')
+
+    def do_POST(self):
+        """ Create receivers and submissions """
+        self._handle('POST')
+
+    def do_PUT(self):
+        """ Update receivers """
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        """ Delete receivers """
+        self._handle('DELETE')
+
+    def _handle(self, verb):
+        body = self._read_body()
+        path = self._get_path()
+        endpoint = '{} {}'.format(verb, path[0])
+        self.owner.count(endpoint)
+
+        if not self._check_auth():
+            return
+
+        if path[0] == 'units' and verb == 'GET':
+            self._handle_units(path)
+        elif path[0] == 'receivers':
+            self._handle_receivers(verb, path, body)
+        elif path[0] == 'submissions' and len(path) >= 2:
+            self._handle_submissions(verb, path, body)
+        else:
+            self._send(404, b'Not found')
+
+    def _handle_units(self, path):
+        unit = self.owner.unit
+        if len(path) == 1:
+            self._send(200, [unit])
+        elif path[1] != str(unit['Id']):
+            self._send(404, b'Unit not found')
+        elif len(path) == 3 and path[2] == 'organizations':
+            self._send(200, unit['Organizations'])
+        else:
+            self._send(200, unit)
+
+    def _handle_receivers(self, verb, path, body):
+        if verb in ('POST', 'PUT'):
+            receiver = json.loads(body.decode('utf-8'))
+            self._send(200 if verb == 'PUT' else 202, self.owner.add_receiver(receiver))
+        elif verb == 'DELETE':
+            receiver = self.owner.delete_receiver(path[1] if len(path) > 1 else '')
+            if receiver is None:
+                self._send(404, b'Receiver not found')
+            else:
+                self._send(200, receiver)
+        elif len(path) == 1:
+            self._send(200, self.owner.get_receivers())
+        else:
+            receiver = self.owner.get_receiver(path[1])
+            if receiver is None:
+                self._send(404, b'Receiver not found')
+            else:
+                self._send(200, receiver)
+
+    def _handle_submissions(self, verb, path, body):
+        error = self.owner.get_error()
+        if error is not None:
+            self._send_error(error)
+            return
+
+        receiver = path[1]
+        if verb == 'POST' and len(path) == 3:
+            filename = base64.b64decode(self.headers.get('x-urkund-filename', '')).decode('utf-8', 'ignore')
+            submission = self.owner.add_submission(receiver, path[2], filename, self.headers.get('Content-Type'),
+                                                   len(body))
+            self._send(202, submission)
+        elif verb == 'GET':
+            external_id = path[2] if len(path) == 3 else None
+            submissions = self.owner.get_submissions(receiver, external_id)
+            if external_id is not None and len(submissions) == 0:
+                self._send(404, b'Submission not found')
+            else:
+                self._send(200, submissions)
+        else:
+            self._send(404, b'Not found')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    """
+    Run the simulator from the command line
+    :param argv: Command line arguments
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Urkund API simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    parser.add_argument('--latency-jitter', type=float, default=0, help='Maximum random seconds added to latency')
+    parser.add_argument('--error-rate', action='append', default=[], metavar='CODE=RATE',
+                        help='Probability of an error of the submission endpoints, e.g. 410=0.01 or timeout=0.01')
+    parser.add_argument('--accept-after', type=float, default=1, help='Seconds before a document is Accepted')
+    parser.add_argument('--analyze-after', type=float, default=5, help='Seconds before a document is Analyzed')
+    parser.add_argument('--analysis-error-rate', type=float, default=0,
+                        help='Probability of a document ending in the Error state')
+    parser.add_argument('--timeout-delay', type=float, default=60, help='Seconds a simulated timeout lasts')
+    parser.add_argument('--unit', type=int, default=1)
+    parser.add_argument('--organization', type=int, default=1)
+    parser.add_argument('--sub-organization', type=int, default=None)
+    parser.add_argument('--suffix', default='.test@analysis.urkund.com')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    error_rates = {}
+    for error_rate in args.error_rate:
+        error, rate = error_rate.split('=')
+        error_rates[error if error == 'timeout' else int(error)] = float(rate)
+
+    simulator = UrkundSimulator(host=args.host, port=args.port, latency=args.latency,
+                                latency_jitter=args.latency_jitter, error_rates=error_rates,
+                                accept_after=args.accept_after, analyze_after=args.analyze_after,
+                                analysis_error_rate=args.analysis_error_rate, timeout_delay=args.timeout_delay,
+                                unit_id=args.unit, organization_id=args.organization,
+                                sub_organization_id=args.sub_organization, suffix=args.suffix, seed=args.seed)
+    print('Urkund simulator listening on {}'.format(simulator.base_url))
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
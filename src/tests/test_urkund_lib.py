@@ -0,0 +1,510 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund lib tests module """
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class _UnitHandler(BaseHTTPRequestHandler):
+    """
+    Minimal keep-alive handler answering GET with an unit, submissions or an error on fail paths, and POST with a
+    submission
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if 'fail' in self.path:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'Id': 1, 'Suffix': '.test@analysis.urkund.com', 'Organizations': []}).encode('utf-8')
+        if 'stale' in self.path and getattr(self, 'served', False):
+            # reused connections are closed without an answer, as a server dropping idle keep-alive connections
+            self.close_connection = True
+            return
+        self.served = True
+        if self.path.startswith('/api/submissions/'):
+            parts = self.path.split('/')[3:]
+            if len(parts) == 1 and 'nobulk' in parts[0]:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            external_ids = parts[1:] if len(parts) > 1 else ['a', 'b']
+            body = json.dumps([{'ExternalId': external_id, 'Status': {'State': 'Analyzed'}}
+                               for external_id in external_ids]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        received = self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'Status': {'State': 'Submitted'}, 'Filename': self.headers['x-urkund-filename'],
+                           'Size': len(received)}).encode('utf-8')
+        self.send_response(202)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def local_api():
+    '''
+    Local HTTP server fixture
+    :return: base url of the server
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _UnitHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/api/'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_request_reuses_connections(urkund_lib_module, local_api):
+    '''
+    Test that the pooled session is shared and connections are reused
+    :param urkund_lib_module:
+    :param local_api:
+    :return:
+    '''
+    Request = urkund_lib_module.Request
+    Units = urkund_lib_module.Units
+
+    request_a = Request(base_url=local_api, user='user_a', password='password_a', pool_size=2)
+    request_b = Request(base_url=local_api, user='user_b', password='password_b', pool_size=2)
+
+    for _ in range(5):
+        assert Units(request=request_a).get_all()['Id'] == 1
+        assert Units(request=request_b).get_all()['Id'] == 1
+
+    stats = request_a.get_stats()
+    assert stats['pool'] == request_b.get_stats()['pool']
+    assert stats['pool']['requests'] == 10
+    assert stats['pool']['connections_opened'] == 1
+    assert stats['pool']['connections_reused'] == 9
+
+
+def test_send_file_handle(urkund_lib_module, local_api, tmp_path):
+    '''
+    Test submissions are streamed from file handles
+    :param urkund_lib_module:
+    :param local_api:
+    :param tmp_path:
+    :return:
+    '''
+    filename = tmp_path / 'large.txt'
+    filename.write_bytes(b'lorem ipsum ' * 100000)
+
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password')
+    submissions = urkund_lib_module.Submissions(organization=1, request=request)
+
+    with open(filename, 'rb') as file_handle:
+        file = {'filename': str(filename), 'mimetype': 'text/plain', 'content': file_handle}
+        response = submissions.send(external_id='1_0', file=file, analysis_email='receiver@analysis.urkund.com',
+                                    email='learner@analysis.urkund.com')
+
+    assert response['Status']['State'] == 'Submitted'
+    assert response['Size'] == 1200000
+
+
+def test_metadata_cache(urkund_lib_module, local_api):
+    '''
+    Test units are cached between instances of the same credentials and can be invalidated
+    :param urkund_lib_module:
+    :param local_api:
+    :return:
+    '''
+    request = urkund_lib_module.Request(base_url=local_api, user='user_cache', password='password', pool_size=3)
+    requests_before = request.get_stats()['pool']['requests']
+
+    for _ in range(3):
+        units = urkund_lib_module.Units(request=request)
+        assert units.get(1)['Suffix'] == '.test@analysis.urkund.com'
+    assert request.get_stats()['pool']['requests'] == requests_before + 1
+
+    units.invalidate_cache()
+    units.get(1)
+    assert request.get_stats()['pool']['requests'] == requests_before + 2
+
+    units = urkund_lib_module.Units(request=request, cache_ttl=0)
+    units.get(1)
+    assert request.get_stats()['pool']['requests'] == requests_before + 3
+
+    # other credentials of the same user do not get the cached units
+    other_request = urkund_lib_module.Request(base_url=local_api, user='user_cache', password='wrong', pool_size=3)
+    urkund_lib_module.Units(request=other_request).get(1)
+    assert request.get_stats()['pool']['requests'] == requests_before + 4
+
+
+def test_circuit_breaker_and_rate_limiter(urkund_lib_module, local_api):
+    '''
+    Test the circuit opens after repeated failures and requests over the rate limit are rejected
+    :param urkund_lib_module:
+    :param local_api:
+    :return:
+    '''
+    import time
+    from urkund.urkund_lib.exceptions import CircuitOpen, InvalidResponse, RateLimited
+
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password', rate_limit=0,
+                                        circuit_failure_threshold=2, circuit_reset_timeout=0.2)
+    for _ in range(2):
+        with pytest.raises(InvalidResponse):
+            request.make('GET', 'fail')
+    requests_before = request.get_stats()['pool']['requests']
+
+    with pytest.raises(CircuitOpen):
+        request.make('GET', 'units/1')
+    stats = request.get_stats()
+    assert stats['pool']['requests'] == requests_before
+    assert stats['circuit_breaker']['state'] == 'open'
+    assert stats['circuit_breaker']['rejected'] == 1
+    assert request.get_retry_after() > 0
+
+    # after the reset timeout a trial request closes the circuit
+    time.sleep(0.3)
+    assert request.make('GET', 'units/1')['Id'] == 1
+    assert request.get_stats()['circuit_breaker']['state'] == 'closed'
+
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password', rate_limit=1,
+                                        rate_limit_burst=1, rate_limit_wait=0)
+    request.make('GET', 'units/1')
+    with pytest.raises(RateLimited):
+        request.make('GET', 'units/1')
+    assert request.get_stats()['rate_limiter']['throttled'] == 1
+
+    # requests rejected by the circuit do not take tokens, and a throttled trial request does not block the circuit
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password', rate_limit=2,
+                                        rate_limit_burst=1, rate_limit_wait=0, circuit_failure_threshold=1,
+                                        circuit_reset_timeout=0.2)
+    with pytest.raises(InvalidResponse):
+        request.make('GET', 'fail')
+    with pytest.raises(CircuitOpen):
+        request.make('GET', 'units/1')
+    time.sleep(0.3)
+    with pytest.raises(RateLimited):
+        request.make('GET', 'units/1')
+    time.sleep(0.3)
+    assert request.make('GET', 'units/1')['Id'] == 1
+    assert request.get_stats()['circuit_breaker']['state'] == 'closed'
+
+
+def test_bulk_results(mocker, urkund_lib_module, local_api):
+    '''
+    Test results of many submissions are requested by receiver, falling back to single requests
+    :param mocker:
+    :param urkund_lib_module:
+    :param local_api:
+    :return:
+    '''
+    import time
+    from urkund.urkund_lib.exceptions import Timeout
+
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password', rate_limit=0)
+    submissions = urkund_lib_module.Submissions(organization=1, request=request)
+
+    receiver = 'receiver@analysis.urkund.com'
+    pairs = [(receiver, 'a'), (receiver, 'b'), (receiver, 'c'), (receiver, 'a')]
+    results = submissions.results(pairs, bulk=True)
+    assert sorted(results.keys()) == sorted(set(pairs))
+    assert request.get_stats()['pool']['requests'] == 3
+
+    # receivers with enough pending submissions are listed
+    results = submissions.results(pairs, bulk=True, bulk_min_submissions=2)
+    assert sorted(results.keys()) == sorted(set(pairs))
+    assert all(results[pair][0]['ExternalId'] == pair[1] for pair in results)
+    assert request.get_stats()['pool']['requests'] == 5
+
+    # receivers whose listing is much larger than the pending submissions are not listed again
+    submissions._listing_sizes[receiver] = 100
+    submissions.results(pairs, bulk=True, bulk_min_submissions=2)
+    assert request.get_stats()['pool']['requests'] == 8
+    del submissions._listing_sizes[receiver]
+
+    # receivers which can not be listed are requested one by one
+    receiver = 'nobulk@analysis.urkund.com'
+    results = submissions.results([(receiver, 'a'), (receiver, 'b')], bulk=True, bulk_min_submissions=2)
+    assert results[(receiver, 'b')][0]['ExternalId'] == 'b'
+    assert request.get_stats()['pool']['requests'] == 11
+
+    # listings are not requested again until the backoff ends
+    receiver = 'receiver@analysis.urkund.com'
+    submissions.results([(receiver, 'a'), (receiver, 'b')], bulk=True, bulk_min_submissions=2)
+    assert request.get_stats()['pool']['requests'] == 13
+    mocker.patch('time.monotonic', return_value=time.monotonic() + urkund_lib_module.submissions.BULK_BACKOFF)
+    submissions.results([(receiver, 'a'), (receiver, 'b')], bulk=True, bulk_min_submissions=2)
+    assert request.get_stats()['pool']['requests'] == 14
+
+    # transient errors of a listing are returned for each submission of the receiver
+    mocker.patch.object(request, 'make', side_effect=Timeout())
+    results = submissions.results([(receiver, 'a'), (receiver, 'b'), ('other@analysis.urkund.com', 'c')], bulk=True,
+                                  bulk_min_submissions=2)
+    assert len(results) == 3
+    assert all(isinstance(value, Timeout) for value in results.values())
+    assert request.make.call_count == 2
+
+
+def test_request_timeouts(urkund_lib_module, local_api):
+    '''
+    Test timeouts by operation, scaled with the upload size and limited by the deadline
+    :param urkund_lib_module:
+    :param local_api:
+    :return:
+    '''
+    import time
+    from urkund.urkund_lib.exceptions import Timeout
+
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password', rate_limit=0,
+                                        timeouts={'result': (1, 2)}, upload_min_rate=1000)
+
+    assert request.get_timeout('result') == (1, 2)
+    assert request.get_timeout('units') == (5, 10)
+    assert request.get_timeout('upload', size=0) == (5, 20)
+    assert request.get_timeout('upload', size=10000) == (5, 30)
+
+    connect, read = request.get_timeout('upload', size=10000, deadline=time.monotonic() + 3)
+    assert connect <= 3 and read <= 3
+
+    with pytest.raises(Timeout):
+        request.make('GET', 'units/1', operation='units', deadline=time.monotonic() - 1)
+    assert request.make('GET', 'units/1', operation='units', deadline=time.monotonic() + 5)['Id'] == 1
+
+
+def test_request_connection_errors(urkund_lib_module, local_api):
+    '''
+    Test that GET requests are sent again on closed pooled connections and transport errors are wrapped
+    :param urkund_lib_module:
+    :param local_api:
+    :return:
+    '''
+    import socket
+    from urkund.urkund_lib.exceptions import ConnectionFailed
+
+    request = urkund_lib_module.Request(base_url=local_api, user='user', password='password', rate_limit=0,
+                                        pool_size=1)
+    for _ in range(3):
+        assert request.make('GET', 'units/stale', operation='units')['Id'] == 1
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        closed_url = 'http://127.0.0.1:{}/api/'.format(sock.getsockname()[1])
+    request = urkund_lib_module.Request(base_url=closed_url, user='user', password='password', rate_limit=0,
+                                        circuit_failure_threshold=0)
+    with pytest.raises(ConnectionFailed):
+        request.make('GET', 'units/1', operation='units')
+
+
+def test_async_client(urkund_lib_module, local_api, tmp_path):
+    '''
+    Test the async client resources and their exceptions
+    :param urkund_lib_module:
+    :param local_api:
+    :param tmp_path:
+    :return:
+    '''
+    pytest.importorskip('aiohttp')
+    import asyncio
+    import socket
+    from urkund.urkund_lib import aio
+    from urkund.urkund_lib.exceptions import ConnectionFailed, InvalidResponse
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        closed_url = 'http://127.0.0.1:{}/api/'.format(sock.getsockname()[1])
+
+    filename = tmp_path / 'large.txt'
+    filename.write_bytes(b'lorem ipsum ' * 1000)
+
+    async def run():
+        request = aio.AsyncRequest(base_url=local_api, user='user_async', password='password', rate_limit=0)
+        units = aio.AsyncUnits(request=request)
+        submissions = aio.AsyncSubmissions(organization=1, request=request)
+        try:
+            assert (await units.get(1))['Suffix'] == '.test@analysis.urkund.com'
+            with pytest.raises(InvalidResponse):
+                await request.make('GET', 'fail')
+
+            with open(filename, 'rb') as file_handle:
+                file = {'filename': str(filename), 'mimetype': 'text/plain', 'content': file_handle}
+                response = await submissions.send(external_id='1_0', file=file,
+                                                  analysis_email='receiver@analysis.urkund.com',
+                                                  email='learner@analysis.urkund.com')
+            assert response['Size'] == 12000
+
+            receiver = 'receiver@analysis.urkund.com'
+            results = await submissions.results([(receiver, 'a'), (receiver, 'b'), (receiver, 'c')], bulk=True,
+                                                bulk_min_submissions=2)
+            assert sorted(results.keys()) == [(receiver, 'a'), (receiver, 'b'), (receiver, 'c')]
+            assert request.get_stats()['pool']['requests'] == 5
+        finally:
+            await request.close()
+
+        # connection errors are raised as Urkund exceptions and returned for each submission
+        request = aio.AsyncRequest(base_url=closed_url, user='user_async', password='password', rate_limit=0,
+                                   circuit_failure_threshold=0)
+        submissions = aio.AsyncSubmissions(organization=1, request=request)
+        try:
+            with pytest.raises(ConnectionFailed):
+                await request.make('GET', 'units/1')
+            results = await submissions.results([('receiver@analysis.urkund.com', 'a')])
+            assert isinstance(results[('receiver@analysis.urkund.com', 'a')], ConnectionFailed)
+        finally:
+            await request.close()
+
+    asyncio.run(run())
+    assert urkund_lib_module.AsyncUrkundLib is aio.AsyncUrkundLib
+
+
+def test_urkund_lib_registry(mocker, urkund_lib_module):
+    '''
+    Test UrkundLib instances are shared by credentials and validated again after an Unauthorized response
+    :param mocker:
+    :param urkund_lib_module:
+    :return:
+    '''
+    unit = {'Id': 1, 'Suffix': '.test@analysis.urkund.com', 'Organizations': [{'Id': 2, 'SubOrganizations': []}]}
+    mocker.patch('urkund.urkund_lib.units.Units.get', return_value=unit)
+    urkund_lib_module.clear_urkund_libs()
+
+    urkund_lib = urkund_lib_module.get_urkund_lib(user='user', password='password', unit=1, organization=2)
+    assert urkund_lib is urkund_lib_module.get_urkund_lib(user='user', password='password', unit=1, organization=2)
+    other_lib = urkund_lib_module.get_urkund_lib(user='user', password='other', unit=1)
+    assert other_lib is not urkund_lib
+    assert other_lib.config['organization'] is None and urkund_lib.config['organization'] == 2
+    with pytest.raises(TypeError):
+        urkund_lib.config['unit'] = 3
+
+    assert urkund_lib.receivers.get_suffix() == '.test@analysis.urkund.com'
+    assert urkund_lib_module.units.Units.get.call_count == 2
+
+    # a rejected request forces a new validation before the next use
+    urkund_lib.request.on_unauthorized()
+    assert not urkund_lib.is_valid()
+    assert urkund_lib.receivers is not None
+    assert urkund_lib_module.units.Units.get.call_count == 3
+    urkund_lib_module.clear_urkund_libs()
+
+
+def test_simulator(urkund_lib_module):
+    '''
+    Test the Urkund simulator implements the submission workflow and the configured errors
+    :param urkund_lib_module:
+    :return:
+    '''
+    from .simulator import UrkundSimulator
+
+    simulator = UrkundSimulator(accept_after=0.2, analyze_after=0.4, organization_id=2, seed=1).start()
+    try:
+        urkund_lib = urkund_lib_module.UrkundLib(user='user', password='password', unit=1, organization=2,
+                                                 base_url=simulator.base_url, cache_ttl=0)
+        assert urkund_lib.config['base_url'] == simulator.base_url
+        receiver = urkund_lib.receivers.get_by_email('learner@tesla-ce.eu')
+        analysis_email = receiver['AnalysisAddress']
+        assert analysis_email == 'learner.test@analysis.urkund.com'
+
+        file = {'filename': 'doc.txt', 'mimetype': 'text/plain', 'content': b'simulated document'}
+        sent = urkund_lib.submissions.send('ext-1', file, analysis_email, 'learner@tesla-ce.eu')
+        assert sent['Status']['State'] == 'Submitted' and sent['Filename'] == 'doc.txt'
+
+        states = []
+        while 'Analyzed' not in states:
+            states.append(urkund_lib.submissions.result('ext-1', analysis_email)[0]['Status']['State'])
+            time.sleep(0.1)
+        assert states[0] == 'Submitted' and 'Accepted' in states
+
+        report = urkund_lib.submissions.result('ext-1', analysis_email)[0]['Report']
+        assert 0 <= report['Significance'] <= 100
+
+        simulator.error_rates = {415: 1}
+        with pytest.raises(urkund_lib_module.exceptions.MediaTypeNotSupported):
+            urkund_lib.submissions.send('ext-2', file, analysis_email, 'learner@tesla-ce.eu')
+        assert simulator.get_stats()['POST submissions'] == 2
+    finally:
+        simulator.stop()
+
+
+def test_prometheus_metrics(urkund_lib_module):
+    '''
+    Test Urkund usage metrics are served and pushed in the Prometheus text format
+    :param urkund_lib_module:
+    :return:
+    '''
+    import requests
+    from urkund.urkund_lib import metrics
+    from .simulator import UrkundSimulator
+
+    metrics.registry.reset()
+    simulator = UrkundSimulator(organization_id=2, error_rates={413: 1}).start()
+    try:
+        urkund_lib = urkund_lib_module.UrkundLib(user='user', password='password', unit=1, organization=2,
+                                                 base_url=simulator.base_url)
+        file = {'filename': 'doc.txt', 'mimetype': 'text/plain', 'content': b'simulated document'}
+        with pytest.raises(urkund_lib_module.exceptions.RequestTooLarge):
+            urkund_lib.submissions.send('ext-1', file, 'learner.test@analysis.urkund.com', 'learner@tesla-ce.eu')
+        simulator.error_rates = {}
+        urkund_lib.submissions.send('ext-1', file, 'learner.test@analysis.urkund.com', 'learner@tesla-ce.eu')
+    finally:
+        simulator.stop()
+
+    server = metrics.start_http_server(0, '127.0.0.1')
+    try:
+        response = requests.get('http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+    lines = response.text.splitlines()
+    assert 'urkund_submissions_total{state="Submitted"} 1' in lines
+    assert 'urkund_exceptions_total{endpoint="POST submissions",exception="RequestTooLarge"} 1' in lines
+    assert 'urkund_http_responses_total{endpoint="POST submissions",status="413"} 1' in lines
+    assert 'urkund_span_seconds_bucket{span="http",detail="POST submissions",le="+Inf"} 2' in lines
+    assert 'urkund_span_seconds_count{span="http",detail="POST submissions"} 2' in lines
+
+    pushed = []
+
+    class _PushHandler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            pushed.append((self.path, self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    gateway = ThreadingHTTPServer(('127.0.0.1', 0), _PushHandler)
+    threading.Thread(target=gateway.serve_forever, daemon=True).start()
+    try:
+        pusher = metrics.MetricsPusher('http://127.0.0.1:{}/'.format(gateway.server_address[1]), 'urkund',
+                                       grouping_key={'instance': 'host-1'}, interval=60).start()
+        pusher.stop()
+    finally:
+        gateway.shutdown()
+        gateway.server_close()
+    assert pusher.errors == 0
+    assert pushed[0][0] == '/metrics/job/urkund/instance/host-1'
+    assert 'urkund_submissions_total{state="Submitted"} 1' in pushed[0][1].splitlines()
@@ -0,0 +1,341 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund utils tests module """
+import gzip
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'valid')
+
+
+def _get_tree(provider_utils, sample_data, mimetype, filename, max_recursive_level=3, stream_threshold=None):
+    '''
+    Build the files tree of a sample
+    :return:
+    '''
+    from urkund import UrkundProvider
+
+    return provider_utils.get_sample_tree_files(sample_data, {}, mimetype, filename, 0, max_recursive_level,
+                                                UrkundProvider.compressed_mimetypes,
+                                                UrkundProvider.accepted_mimetypes_urkund,
+                                                stream_threshold=stream_threshold)
+
+
+def test_tree_nested_archives(provider_utils):
+    '''
+    Test nested zip, tar.gz and gz archives are read from memory
+    :param provider_utils:
+    :return:
+    '''
+    with open(os.path.join(DATA_PATH, 'lorem.txt.zip'), 'rb') as file:
+        inner_zip = file.read()
+    with open(os.path.join(DATA_PATH, 'lorem.docx'), 'rb') as file:
+        docx = file.read()
+
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode='w:gz') as archive:
+        info = tarfile.TarInfo('docs/lorem.docx')
+        info.size = len(docx)
+        archive.addfile(info, io.BytesIO(docx))
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, mode='w') as archive:
+        archive.writestr('inner.zip', inner_zip)
+        archive.writestr('docs.tar.gz', tar_buffer.getvalue())
+        archive.writestr('notes.txt.gz', gzip.compress(b'lorem ipsum dolor sit amet'))
+
+    tree = _get_tree(provider_utils, zip_buffer.getvalue(), 'application/zip', 'sample.zip')
+    files = {t_file['filename']: t_file for t_file in tree}
+
+    assert sorted(files.keys()) == ['sample.zip/docs.tar.gz/docs/lorem.docx', 'sample.zip/inner.zip/lorem.doc',
+                                    'sample.zip/inner.zip/lorem.txt', 'sample.zip/notes.txt.gz/notes.txt']
+    assert all([t_file['status'] == 'ACCEPTED' for t_file in tree])
+    assert files['sample.zip/inner.zip/lorem.doc']['mimetype'] == 'application/msword'
+    assert files['sample.zip/docs.tar.gz/docs/lorem.docx']['content'] == docx
+    assert files['sample.zip/notes.txt.gz/notes.txt']['content'] == b'lorem ipsum dolor sit amet'
+
+
+def test_tree_max_recursive_level(provider_utils):
+    '''
+    Test archives deeper than the maximum level are rejected
+    :param provider_utils:
+    :return:
+    '''
+    with open(os.path.join(DATA_PATH, 'lorem.txt.zip'), 'rb') as file:
+        tree = _get_tree(provider_utils, file.read(), 'application/zip', 'lorem.txt.zip', max_recursive_level=1)
+
+    assert len(tree) == 2
+    assert all([t_file['error'] == 'MAX_RECURSIVE_LEVEL' for t_file in tree])
+
+
+def test_tree_malformed_files(mocker, provider_utils):
+    '''
+    Test a malformed content file, a content file without text or a file whose mimetype can not be detected are
+    rejected and the rest of the sample is processed
+    :param mocker:
+    :param provider_utils:
+    :return:
+    '''
+    from urkund import UrkundProvider
+
+    def get_tree(content, context):
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, mode='w') as archive:
+            archive.writestr('content.txt', content)
+            archive.writestr('attachment.txt', b'Lorem ipsum dolor sit amet. ' * 100)
+        return list(provider_utils.iter_sample_tree_files(zip_buffer.getvalue(), context, 'application/zip',
+                                                          'sample.zip', 0, 3, UrkundProvider.compressed_mimetypes,
+                                                          UrkundProvider.accepted_mimetypes_urkund))
+
+    tree = get_tree(b'{"online_text": "Lorem ipsum"}', {'type': 'assign_online'})
+    assert [(t_file['filename'], t_file['status']) for t_file in tree] == [
+        ('assign_online.txt', 'ACCEPTED'), ('sample.zip/attachment.txt', 'ACCEPTED')]
+    assert tree[0]['content'] == b'Lorem ipsum'
+
+    for content in (b'{"online_text": ', b'{"message": "Lorem ipsum"}'):
+        tree = get_tree(content, {'type': 'assign_online'})
+        assert [(t_file['filename'], t_file['status']) for t_file in tree] == [
+            ('sample.zip/content.txt', 'REJECTED'), ('sample.zip/attachment.txt', 'ACCEPTED')]
+        assert tree[0]['error'] == 'EXTRACTION_ERROR'
+        assert tree[0]['content'] is None
+
+    mocker.patch.object(provider_utils.detection, 'detect_mimetype', side_effect=RuntimeError('magic'))
+    tree = get_tree(b'{}', {})
+    assert [(t_file['filename'], t_file['error']) for t_file in tree] == [
+        ('sample.zip/content.txt', 'EXTRACTION_ERROR'), ('sample.zip/attachment.txt', 'EXTRACTION_ERROR')]
+
+
+def test_poll_scheduler(provider_utils):
+    '''
+    Test the result checks countdown
+    :param provider_utils:
+    :return:
+    '''
+    import time
+    from urkund import UrkundProvider
+    from urkund.provider.scheduler import AnalysisDurations, PollScheduler
+
+    config = dict(UrkundProvider.config, countdown_jitter=0)
+    durations = AnalysisDurations()
+    scheduler = PollScheduler(config, durations)
+    pending = [{'external_id': '1_0', 'mimetype': 'text/plain', 'size': 1000, 'state': 'Submitted',
+                'submitted_at': time.time()}]
+
+    # exponential backoff with a maximum
+    assert scheduler.next_countdown(0, pending) == 5 * 60
+    assert scheduler.next_countdown(1, pending) == 10 * 60
+    assert scheduler.next_countdown(10, pending) == 60 * 60
+
+    # accepted documents are checked sooner
+    pending[0]['state'] = 'Accepted'
+    assert scheduler.next_countdown(1, pending) == 5 * 60
+
+    # learn the analysis duration of the documents
+    scheduler.add_analyzed({'mimetype': 'text/plain', 'size': 2000, 'submitted_at': time.time() - 120})
+    assert 119 < scheduler.next_countdown(1, pending) <= 120
+
+
+def test_worker_warm_up_and_health(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test the worker warm up and the health report
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import requests
+    from urkund.provider import worker
+    from urkund.urkund_lib.request import Request
+
+    timings = worker.warm_up(urkund_provider)
+    assert 'error' not in timings
+    assert set(timings.keys()) == {'mimetype', 'urkund_lib', 'receiver'}
+
+    # the health report does not depend on Urkund
+    mocker.patch('urkund.urkund_lib.request.Request.make', side_effect=ConnectionError('down'))
+    report = worker.health(urkund_provider)
+    assert report['status'] == 'ok'
+    assert report['warm']
+    assert 'urkund_latency' not in report
+    assert Request.make.call_count == 0
+    assert set(['pool', 'circuit_breaker', 'rate_limiter']).issubset(report.keys())
+    assert 'hit_rate' in report['caches']['metadata']
+    assert report['magic']['created'] >= 1
+
+    report = worker.health(urkund_provider, probe=True)
+    assert report['status'] == 'error'
+
+    mocker.patch('urkund.urkund_lib.request.Request.make', return_value={'Id': 1})
+    report = worker.health(urkund_provider, probe=True)
+    assert report['status'] == 'ok'
+    assert report['urkund_latency'] >= 0
+
+    # failed probes do not count for the circuit breaker of the tasks
+    mocker.stopall()
+    urkund_lib = urkund_provider._get_urkund_lib()
+    circuit_breaker = urkund_lib.get_stats()['circuit_breaker']
+    mocker.patch('requests.Session.request', side_effect=requests.exceptions.ConnectionError('down'))
+    for _ in range(10):
+        assert worker.health(urkund_provider, probe=True)['status'] == 'error'
+    assert urkund_lib.get_stats()['circuit_breaker'] == circuit_breaker
+
+
+def test_metrics_spans(mocker, provider_utils):
+    '''
+    Test the stages of the tree extraction are measured, and spans are sent to Sentry when tracing is enabled
+    :param mocker:
+    :param provider_utils:
+    :return:
+    '''
+    import time
+    from urkund.urkund_lib import metrics
+
+    metrics.registry.reset()
+    with open(os.path.join(DATA_PATH, 'lorem.txt.zip'), 'rb') as file:
+        tree = _get_tree(provider_utils, file.read(), 'application/zip', 'lorem.txt.zip')
+
+    spans = metrics.span_seconds.collect()
+    assert spans[('tree_files', '')]['count'] == 1
+    assert spans[('extract', 'application/zip')]['count'] == len(tree)
+    assert spans[('mimetype', '')]['count'] == len(tree)
+    assert sum(spans[('mimetype', '')]['buckets']) == len(tree)
+
+    # lazy trees only count the time spent extracting the files
+    from urkund import UrkundProvider
+    from .utils import get_request
+
+    metrics.registry.reset()
+    sample = get_request(filename='valid/lorem.txt.zip', mimetype='application/zip')
+    checked = provider_utils.check_sample_file(sample, 3, UrkundProvider.accepted_mimetypes,
+                                               UrkundProvider.compressed_mimetypes,
+                                               UrkundProvider.accepted_mimetypes_urkund, lazy=True)
+    for _ in checked['tree_file']:
+        time.sleep(0.1)
+    spans = metrics.span_seconds.collect()
+    assert spans[('tree_files', '')]['count'] == 1
+    assert spans[('tree_files', '')]['sum'] < 0.1
+
+    start_span = mocker.patch('sentry_sdk.start_span')
+    metrics.set_tracing(True)
+    try:
+        with metrics.span('stage', 'detail'):
+            pass
+        start_span.assert_called_once_with(op='urkund.stage')
+        with pytest.raises(ValueError):
+            with metrics.span('stage', 'detail'):
+                raise ValueError()
+    finally:
+        metrics.set_tracing(False)
+
+    assert metrics.span_seconds.collect()[('stage', 'detail')]['count'] == 2
+    assert metrics.registry.get_stats()['urkund_span_errors_total'] == {'stage,detail,ValueError': 1}
+
+
+def test_tree_parallel_extraction(provider_utils):
+    '''
+    Test sibling archives extracted by the process pool give the same tree as the serial extraction
+    :param provider_utils:
+    :return:
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from urkund import UrkundProvider
+
+    with open(os.path.join(DATA_PATH, 'lorem.txt.zip'), 'rb') as file:
+        inner_zip = file.read()
+    with open(os.path.join(DATA_PATH, 'lorem.docx'), 'rb') as file:
+        docx = file.read()
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, mode='w') as archive:
+        archive.writestr('first.zip', inner_zip)
+        archive.writestr('lorem.docx', docx)
+        archive.writestr('second.zip', inner_zip)
+        archive.writestr('notes.txt.gz', gzip.compress(b'lorem ipsum dolor sit amet'))
+
+    serial = _get_tree(provider_utils, zip_buffer.getvalue(), 'application/zip', 'sample.zip', stream_threshold=64)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        tree = provider_utils.iter_sample_tree_files(zip_buffer.getvalue(), {}, 'application/zip', 'sample.zip', 0, 3,
+                                                     UrkundProvider.compressed_mimetypes,
+                                                     UrkundProvider.accepted_mimetypes_urkund, stream_threshold=64,
+                                                     executor=executor)
+        parallel = list(tree)
+
+    def _read(t_file):
+        content = t_file['content']
+        if hasattr(content, 'read'):
+            content.seek(0)
+            return content.read()
+        return content
+
+    assert [(t_file['filename'], t_file['mimetype'], t_file['status']) for t_file in parallel] == \
+        [(t_file['filename'], t_file['mimetype'], t_file['status']) for t_file in serial]
+    assert [_read(t_file) for t_file in parallel] == [_read(t_file) for t_file in serial]
+    assert len(parallel) == 6
+
+
+def test_mimetype_signatures(provider_utils):
+    '''
+    Test the mimetypes detected from the signature of the common document formats are the ones given by libmagic
+    :param provider_utils:
+    :return:
+    '''
+    import magic
+
+    detection = provider_utils.detection
+
+    samples = {}
+    for filename in os.listdir(DATA_PATH):
+        with open(os.path.join(DATA_PATH, filename), 'rb') as file:
+            samples[filename] = file.read()
+    samples['lorem.pdf'] = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Type /Catalog >>\nendobj\n'
+    samples['lorem.rtf'] = b'{\\rtf1\\ansi\\deff0 {\\fonttbl {\\f0 Times;}}\\f0 Lorem ipsum}'
+    samples['notes.txt'] = 'Lorem ipsum dolor sit amet, café.\nSed do eiusmod tempor.\n'.encode('utf-8')
+    samples['main.c'] = b'Lorem ipsum\nstruct lorem {\n    int ipsum;\n};\n'
+    samples['values.csv'] = b'Lorem ipsum,dolor,sit\namet,consectetur,adipiscing\nsed,do,eiusmod\n'
+    for name, folder in [('lorem.pptx', 'ppt/'), ('lorem.xlsx', 'xl/')]:
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, mode='w') as archive:
+            archive.writestr('[Content_Types].xml', '<Types/>')
+            archive.writestr('_rels/.rels', '<Relationships/>')
+            archive.writestr(folder + 'document.xml', '<document/>')
+        samples[name] = zip_buffer.getvalue()
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, mode='w') as archive:
+        archive.writestr('word/notes.txt', 'Lorem ipsum')
+    samples['word.zip'] = zip_buffer.getvalue()
+
+    fast_paths = 0
+    for filename, content in samples.items():
+        header = content[:detection.SNIFF_SIZE]
+        mimetype = detection.get_signature_mimetype(header)
+        expected = magic.from_buffer(header, mime=True)
+        if mimetype is not None:
+            fast_paths += 1
+            assert mimetype == expected, filename
+        if expected not in detection.WHOLE_FILE_MIMETYPES:
+            assert detection.detect_mimetype(content) == expected, filename
+            assert detection.detect_mimetype(io.BytesIO(content)) == expected, filename
+
+    assert detection.detect_mimetype(samples['lorem.doc']) == magic.from_buffer(samples['lorem.doc'], mime=True)
+    assert detection.get_signature_mimetype(samples['main.c'][:detection.SNIFF_SIZE]) is None
+    assert detection.get_signature_mimetype(samples['values.csv'][:detection.SNIFF_SIZE]) is None
+    # plain text and archives which are not Office Open XML packages are left to libmagic
+    assert detection.get_signature_mimetype(samples['notes.txt'][:detection.SNIFF_SIZE]) is None
+    assert detection.get_signature_mimetype(samples['word.zip'][:detection.SNIFF_SIZE]) is None
+    assert fast_paths == 6
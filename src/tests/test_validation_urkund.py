@@ -13,7 +13,7 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE TFR validation tests module """
-from .utils import get_request
+from .utils import get_request, get_zip_request
 
 
 def test_send_zip_filename(mock_urkund_lib_all_ok, urkund_provider):
@@ -95,3 +95,573 @@ def test_verify_txt_filename(mock_urkund_lib_all_ok, urkund_provider):
     result = urkund_provider.on_notification(key, info)
 
     assert result is None
+
+
+def test_send_zip_multiple_files(mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test send zip with multiple files keeps external ids ordered
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    filename = 'valid/lorem.txt.zip'
+    sample = get_request(filename=filename, mimetype='application/zip')
+
+    model = {}
+    response = urkund_provider.verify(sample, model)
+
+    from tesla_ce_provider import result
+    assert isinstance(response, result.VerificationDelayedResult)
+
+    info = urkund_provider.notifications[-1].info
+    assert info['total_files'] == 2
+    assert [ext['external_id'] for ext in info['external_ids']] == ['{}_0'.format(sample.request_id),
+                                                                    '{}_1'.format(sample.request_id)]
+    assert sorted([ext['filename'].split('/')[-1] for ext in info['external_ids']]) == ['lorem.doc', 'lorem.txt']
+
+
+def test_verify_poll_deadline(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test result polls exceeding the deadline are left for the next notification
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import time
+    from urkund.urkund_lib.submissions import Submissions
+
+    analyzed = Submissions.result(external_id='1610712121.915711_0', analysis_email='')
+
+    def slow_result(external_id, analysis_email, deadline=None):
+        if external_id.endswith('_1'):
+            time.sleep(1)
+        return analyzed
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.result', side_effect=slow_result)
+    mocker.patch.dict(urkund_provider.config, {'poll_deadline': 0.2})
+
+    info = {
+        'request_id': '',
+        'learner_id': '',
+        'external_ids': [{
+            'external_id': '1610712121.915711_{}'.format(idx),
+            'analysis_email': 'rmunozber.uoc@analysis.urkund.com',
+            'filename': 'lorem_{}.txt'.format(idx)
+        } for idx in range(2)],
+        'processed_external_ids': {
+            'errors': [],
+            'corrects': []
+        },
+        'errors': [],
+        'countdown': 5,
+        'total_files': 2
+    }
+
+    urkund_provider.on_notification('tukrund_check_data', info)
+
+    assert len(urkund_provider.delayed_results) == 0
+    assert len(urkund_provider.notifications) == 1
+
+    # only the pending document is checked again, the analysed one is kept
+    new_info = urkund_provider.notifications[0].info
+    assert [res['external_id'] for res in new_info['external_ids']] == ['1610712121.915711_1']
+    assert [res['filename'] for res in new_info['processed_external_ids']['corrects']] == ['lorem_0.txt']
+    assert new_info['total_files'] == 2
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.result', return_value=analyzed)
+    urkund_provider.on_notification('tukrund_check_data', new_info)
+
+    assert Submissions.result.call_count == 1
+    assert len(urkund_provider.delayed_results) == 1
+    audit = urkund_provider.delayed_results[0].result.audit
+    assert audit is not None
+
+
+def test_send_raw_content(mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test files are sent to Urkund with the decoded content
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import os
+    from urkund.urkund_lib.submissions import Submissions
+
+    filename = 'valid/lorem.txt.zip'
+    sample = get_request(filename=filename, mimetype='application/zip')
+
+    urkund_provider.verify(sample, {})
+
+    data_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'valid')
+    for call in Submissions.send.call_args_list:
+        file = call.kwargs['file']
+        with open(os.path.join(data_path, file['filename'].split('/')[-1]), 'rb') as fh:
+            assert bytes(file['content']) == fh.read()
+
+
+def test_send_duplicated_files(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test duplicated documents are sent once, inside a request and between requests of the same learner
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from urkund.urkund_lib.submissions import Submissions
+    mocker.patch.dict(urkund_provider.config, {'cross_request_deduplication': True})
+
+    sample = get_request(filename='valid/duplicated.zip', mimetype='application/zip')
+    urkund_provider.verify(sample, {})
+
+    assert Submissions.send.call_count == 2
+    info = urkund_provider.notifications[-1].info
+    assert info['total_files'] == 3
+    assert len(info['external_ids']) == 3
+    assert len(set([ext['external_id'] for ext in info['external_ids']])) == 2
+
+    # a new request of the same learner does not send the documents again
+    sample = get_request(filename='valid/lorem.txt', mimetype='text/plain', learner_id=sample.learner_id)
+    urkund_provider.verify(sample, {})
+
+    assert Submissions.send.call_count == 2
+    cached_info = urkund_provider.notifications[-1].info
+    assert cached_info['external_ids'][0]['external_id'] in [ext['external_id'] for ext in info['external_ids']]
+
+
+def test_send_timeout_retry(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test only the files which timed out are sent again, inline or from a notification
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from urkund import UrkundProvider
+    from urkund.urkund_lib.exceptions import Timeout
+    from urkund.urkund_lib.submissions import Submissions
+    from tesla_ce_provider import result
+
+    submitted = Submissions.send.return_value
+    timeouts = {}
+
+    def timeout_once(external_id, file, analysis_email, email, deadline=None):
+        if external_id.endswith('_1') and external_id not in timeouts:
+            timeouts[external_id] = True
+            raise Timeout('Timeout')
+        return submitted
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', side_effect=timeout_once)
+    mocker.patch.dict(urkund_provider.config, {'timeout_between_retries': 0, 'timeout_retry_mode': 'inline'})
+
+    sample = get_request(filename='valid/duplicated.zip', mimetype='application/zip')
+    response = urkund_provider.verify(sample, {})
+
+    assert isinstance(response, result.VerificationDelayedResult)
+    assert Submissions.send.call_count == 3
+    assert len(urkund_provider.notifications[-1].info['external_ids']) == 3
+    assert UrkundProvider.config is not urkund_provider.config
+
+    # the default delayed mode hands the file off to a notification which sends it with the same external id
+    timeouts.clear()
+    Submissions.send.reset_mock()
+    mocker.patch.dict(urkund_provider.config, {'timeout_retry_mode': UrkundProvider.config['timeout_retry_mode']})
+
+    sample = get_request(filename='valid/duplicated.zip', mimetype='application/zip')
+    urkund_provider.verify(sample, {})
+
+    assert Submissions.send.call_count == 2
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_send_data')
+    assert [pending['external_id'] for pending in notification.info['pending_files']] == \
+        ['{}_1'.format(sample.request_id)]
+    assert 'content' not in notification.info['pending_files'][0]
+
+    # the pending file is extracted again from the request downloaded from TeSLA CE
+    mocker.patch.object(urkund_provider, '_get_request', return_value=sample)
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    urkund_provider._get_request.assert_called_once_with(sample.request_id)
+    assert Submissions.send.call_count == 3
+    assert Submissions.send.call_args.kwargs['external_id'] == '{}_1'.format(sample.request_id)
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_check_data')
+    assert len(notification.info['external_ids']) == 3
+    assert 'pending_files' not in notification.info
+
+
+def test_send_throttled(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test files rejected by the rate limiter or the circuit breaker are sent later from a notification, until the
+    retries run out
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from urkund.urkund_lib.exceptions import CircuitOpen
+    from urkund.urkund_lib.submissions import Submissions
+    from tesla_ce_provider import message, result
+
+    submitted = Submissions.send.return_value
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', side_effect=CircuitOpen('open'))
+
+    sample = get_request(filename='valid/lorem.txt', mimetype='text/plain')
+    response = urkund_provider.verify(sample, {})
+
+    assert isinstance(response, result.VerificationDelayedResult)
+    assert Submissions.send.call_count == 1
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_send_data')
+    assert len(notification.info['external_ids']) == 0
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', return_value=submitted)
+    mocker.patch.object(urkund_provider, '_get_request', return_value=sample)
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_check_data')
+    assert notification.info['external_ids'][0]['external_id'] == '{}_0'.format(sample.request_id)
+
+    # files throttled in every attempt are reported as timed out
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', side_effect=CircuitOpen('open'))
+    mocker.patch.dict(urkund_provider.config, {'max_timeout_retries': 1})
+    sample = get_request(filename='valid/lorem.txt', mimetype='text/plain')
+    urkund_provider._get_request.return_value = sample
+    urkund_provider.verify(sample, {})
+    notification = urkund_provider.notifications[-1]
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    assert urkund_provider.notifications[-1] is notification
+    delayed = urkund_provider.delayed_results[-1]
+    assert delayed.request_id == sample.request_id
+    assert delayed.result.message_code == message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value
+
+
+def test_poll_aggregation(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test the checks of the requests of a receiver are aggregated in a single notification per tick
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from urkund.provider.aggregation import get_pending_index, get_poll_key
+    from urkund.urkund_lib.submissions import Submissions
+    backend = 'urkund.provider.aggregation.PendingIndex'
+    mocker.patch.dict(urkund_provider.config, {'poll_aggregation': True, 'poll_aggregation_tick': 3600,
+                                               'countdown_jitter': 0})
+
+    # without a shared index every request keeps its own check
+    samples = [get_request(filename='valid/lorem.txt', mimetype='text/plain') for _ in range(2)]
+    for sample in samples:
+        urkund_provider.verify(sample, {})
+    assert [notification.key.startswith('tukrund_check_data') for notification in urkund_provider.notifications] \
+        == [True, True]
+    assert urkund_provider.notifications[0].info['request_id'] == samples[0].request_id
+
+    urkund_provider.notifications.clear()
+    mocker.patch.dict(urkund_provider.config, {'poll_aggregation_backend': backend})
+    for sample in samples:
+        urkund_provider.verify(sample, {})
+
+    # the check of the tick is scheduled once, with a key shared by all the workers
+    assert len(urkund_provider.notifications) == 1
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_poll_data')
+    assert notification.key == get_poll_key('rmunozber.uoc@analysis.urkund.com', notification.info['tick'])
+    assert set(notification.info.keys()) == {'analysis_email', 'tick'}
+
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    assert Submissions.result.call_count == 2
+    assert sorted([delayed.request_id for delayed in urkund_provider.delayed_results]) == \
+        sorted([sample.request_id for sample in samples])
+    assert get_pending_index(backend).get_stats()['requests'] == 0
+
+    # checks of requests already taken by another notification are skipped
+    urkund_provider.on_notification(notification.key, notification.info)
+    assert Submissions.result.call_count == 2
+
+    # requests whose results can not be requested are checked again in a later tick
+    for sample in samples:
+        urkund_provider.verify(sample, {})
+    notification = urkund_provider.notifications[-1]
+    mocker.patch.object(urkund_provider, '_get_results', side_effect=RuntimeError('failed'))
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    requests_info = get_pending_index(backend).pop('rmunozber.uoc@analysis.urkund.com',
+                                                   urkund_provider.notifications[-1].info['tick'])
+    assert sorted([request_info['request_id'] for request_info in requests_info]) == \
+        sorted([sample.request_id for sample in samples])
+    assert all(request_info['poll_attempt'] == 1 for request_info in requests_info)
+
+
+def test_max_poll_attempts(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test the pending documents of a request are reported as timed out once the checks run out
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from tesla_ce_provider import message
+    from urkund.urkund_lib.exceptions import Timeout
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.result', side_effect=Timeout())
+    mocker.patch.dict(urkund_provider.config, {'max_poll_attempts': 2})
+
+    sample = get_request(filename='valid/lorem.txt', mimetype='text/plain')
+    urkund_provider.verify(sample, {})
+    notification = urkund_provider.notifications[-1]
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    assert len(urkund_provider.delayed_results) == 0
+    notification = urkund_provider.notifications[-1]
+    assert notification.info['poll_attempt'] == 1
+    urkund_provider.on_notification(notification.key, notification.info)
+
+    assert urkund_provider.notifications[-1] is notification
+    audit = urkund_provider.delayed_results[-1].result.audit
+    assert audit is not None
+    assert [error['code'] for error in audit['documents']['errors']] == [
+        message.provider.Provider.PROVIDER_EXTERNAL_SERVICE_TIMEOUT.value]
+
+
+def test_verify_deadline(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test files not sent before the verify deadline are sent later from a notification
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import time
+    from urkund.urkund_lib.exceptions import Timeout
+    from urkund.urkund_lib.submissions import Submissions
+
+    submitted = Submissions.send.return_value
+
+    def send(external_id, file, analysis_email, email, deadline=None):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise Timeout('Deadline exceeded')
+        time.sleep(0.3)
+        return submitted
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', side_effect=send)
+    mocker.patch.dict(urkund_provider.config, {'verify_deadline': 0.2, 'max_parallel_submissions': 1})
+
+    sample = get_request(filename='valid/duplicated.zip', mimetype='application/zip')
+    urkund_provider.verify(sample, {})
+
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_send_data')
+    assert set([ext['external_id'] for ext in notification.info['external_ids']]) == \
+        {'{}_0'.format(sample.request_id)}
+    assert [pending['external_id'] for pending in notification.info['pending_files']] == \
+        ['{}_1'.format(sample.request_id)]
+
+
+def test_send_lazy_tree(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test files of mixed sizes are sent in archive order while they are extracted, with a bounded number of
+    extracted files waiting to be sent
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import threading
+    import time
+    from urkund.provider import utils
+    from urkund.urkund_lib.submissions import Submissions
+
+    files = [('doc_{}.txt'.format(idx), 'Lorem ipsum dolor sit amet number {}. '.format(idx).encode() *
+              (500 if idx % 3 == 0 else 5)) for idx in range(9)]
+    submitted = Submissions.send.return_value
+    lock = threading.Lock()
+    counters = {'extracted': 0, 'sent': 0, 'max_waiting': 0}
+    sent_files = {}
+    get_mimetype = utils.get_mimetype
+
+    def extract(content):
+        with lock:
+            counters['extracted'] += 1
+            counters['max_waiting'] = max(counters['max_waiting'], counters['extracted'] - counters['sent'])
+        return get_mimetype(content)
+
+    def send(external_id, file, analysis_email, email, deadline=None):
+        content = file['content']
+        sent_files[file['filename']] = (hasattr(content, 'read'), content.read() if hasattr(content, 'read')
+                                        else bytes(content))
+        time.sleep(0.05)
+        with lock:
+            counters['sent'] += 1
+        return submitted
+
+    mocker.patch('urkund.provider.utils.get_mimetype', side_effect=extract)
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', side_effect=send)
+    mocker.patch.dict(urkund_provider.config, {'max_parallel_submissions': 2, 'upload_stream_threshold': 1024})
+
+    sample = get_zip_request(files)
+    urkund_provider.verify(sample, {})
+
+    info = urkund_provider.notifications[-1].info
+    assert info['total_files'] == len(files)
+    assert [ext['filename'] for ext in info['external_ids']] == ['sample.zip/{}'.format(name) for name, _ in files]
+    assert [ext['external_id'] for ext in info['external_ids']] == \
+        ['{}_{}'.format(sample.request_id, idx) for idx in range(len(files))]
+    for name, content in files:
+        streamed, sent_content = sent_files['sample.zip/{}'.format(name)]
+        assert sent_content == content
+        assert streamed == (len(content) > 1024)
+
+    # extraction stops while the maximum number of files are being sent
+    assert counters['max_waiting'] <= 2
+
+
+def test_send_corrupt_archive_member(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test a corrupt nested archive is rejected once the files extracted before it are sent
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import io
+    import zipfile
+    from tesla_ce_provider import message, result
+    from urkund.provider import utils
+    from urkund.urkund_lib.submissions import Submissions
+
+    nested = io.BytesIO()
+    with zipfile.ZipFile(nested, mode='w') as archive:
+        archive.writestr('c.txt', b'Lorem ipsum dolor sit amet. ' * 100)
+
+    for processes in (0, 1):
+        Submissions.send.reset_mock()
+        mocker.patch.dict(urkund_provider.config, {'extraction_processes': processes})
+        sample = get_zip_request([('a.txt', b'Lorem ipsum dolor sit amet. ' * 100),
+                                  ('b.zip', nested.getvalue()[:100])])
+        try:
+            response = urkund_provider.verify(sample, {})
+        finally:
+            utils.shutdown_extraction_pools()
+
+        assert isinstance(response, result.VerificationDelayedResult)
+        assert Submissions.send.call_count == 1
+        notification = urkund_provider.notifications[-1]
+        assert notification.key.startswith('tukrund_check_data')
+        assert [ext['filename'] for ext in notification.info['external_ids']] == ['sample.zip/a.txt']
+        assert notification.info['processed_external_ids']['errors'] == [{
+            "code": message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
+            "filename": 'sample.zip/b.zip',
+            "urkund_code": None,
+            "urkund_message": None
+        }]
+        assert notification.info['total_files'] == 2
+
+
+def test_send_unexpected_error(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test an unexpected error sending a file only rejects that file and the rest of sent files are checked
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from tesla_ce_provider import message, result
+    from urkund.urkund_lib.submissions import Submissions
+
+    submitted = Submissions.send.return_value
+
+    def send(**kwargs):
+        if kwargs['file']['filename'].endswith('b.txt'):
+            raise ValueError('unexpected')
+        return submitted
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.send', side_effect=send)
+    sample = get_zip_request([('a.txt', b'Lorem ipsum dolor sit amet. ' * 100),
+                              ('b.txt', b'Consectetur adipiscing elit. ' * 100)])
+    response = urkund_provider.verify(sample, {})
+
+    assert isinstance(response, result.VerificationDelayedResult)
+    assert Submissions.send.call_count == 2
+    notification = urkund_provider.notifications[-1]
+    assert notification.key.startswith('tukrund_check_data')
+    assert [ext['filename'] for ext in notification.info['external_ids']] == ['sample.zip/a.txt']
+    errors = notification.info['processed_external_ids']['errors']
+    assert [(error['code'], error['filename']) for error in errors] == [
+        (message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value, 'sample.zip/b.txt')]
+
+
+def test_get_request_timeout(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test the sample of a request sent again is downloaded with the configured timeout
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    import tesla_ce_provider
+
+    sample = get_request(filename='valid/lorem.txt', mimetype='text/plain')
+    client = mocker.patch.object(tesla_ce_provider, 'client')
+    client.provider.verification.get_provider_request_result.return_value = {
+        'request': {'data': 'http://storage/sample.json'}}
+    get = mocker.patch('requests.get')
+    get.return_value.json.return_value = sample.data
+
+    mocker.patch.dict(urkund_provider.config, {'sample_download_timeout': [2, 30]})
+    urkund_provider._get_request(1)
+
+    get.assert_called_once_with('http://storage/sample.json', verify=mocker.ANY, timeout=(2, 30))
+
+
+def test_check_permanent_error(mocker, mock_urkund_lib_all_ok, urkund_provider):
+    '''
+    Test a document whose result can not be checked is rejected and the rest are still checked
+    :param mocker:
+    :param mock_urkund_lib_all_ok:
+    :param urkund_provider:
+    :return:
+    '''
+    from tesla_ce_provider import message
+    from urkund.urkund_lib.exceptions import NotFound, NotAvailable
+    from urkund.urkund_lib.submissions import Submissions
+
+    analyzed = Submissions.result(external_id='1610712121.915711_0', analysis_email='')
+
+    def result(external_id, analysis_email, deadline=None):
+        if external_id.endswith('_1'):
+            raise NotFound('unknown submission')
+        if external_id.endswith('_2'):
+            raise NotAvailable('gone')
+        return analyzed
+
+    mocker.patch('urkund.urkund_lib.submissions.Submissions.result', side_effect=result)
+    info = {
+        'request_id': '',
+        'learner_id': '',
+        'external_ids': [{
+            'external_id': '1610712121.915711_{}'.format(idx),
+            'analysis_email': 'rmunozber.uoc@analysis.urkund.com',
+            'filename': 'lorem_{}.txt'.format(idx)
+        } for idx in range(3)],
+        'processed_external_ids': {
+            'errors': [],
+            'corrects': []
+        },
+        'errors': [],
+        'countdown': 5,
+        'total_files': 3
+    }
+
+    urkund_provider.on_notification('tukrund_check_data', info)
+
+    assert len(urkund_provider.delayed_results) == 0
+    new_info = urkund_provider.notifications[-1].info
+    assert [res['filename'] for res in new_info['external_ids']] == ['lorem_2.txt']
+    assert [res['filename'] for res in new_info['processed_external_ids']['corrects']] == ['lorem_0.txt']
+    errors = new_info['processed_external_ids']['errors']
+    assert [(error['code'], error['filename']) for error in errors] == [
+        (message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value, 'lorem_1.txt')]
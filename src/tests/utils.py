@@ -17,8 +17,10 @@ Test util module
 '''
 import uuid
 from datetime import datetime
+import io
 import os
 import base64
+import zipfile
 
 
 def get_request(filename, mimetype, learner_id=None):
@@ -60,3 +62,41 @@ def get_request(filename, mimetype, learner_id=None):
         'data': sample_data,
         'validations': []
     })
+
+
+def get_zip_request(files, learner_id=None):
+    '''
+    Get request with a zip sample
+    :param files: List of member names and contents
+    :param learner_id:
+    :return:
+    '''
+    from tesla_ce_provider.models.base import Request
+
+    if learner_id is None:
+        learner_id = str(uuid.uuid4())
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode='w') as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+
+    now = datetime.now()
+    request_id = datetime.timestamp(now)
+
+    sample_data = {
+        "learner_id": learner_id,
+        "data": "data:application/zip;base64,{}".format(base64.b64encode(buffer.getvalue()).decode('utf-8')),
+        "instruments": [6],
+        "metadata": {
+            "context": {},
+            "mimetype": 'application/zip',
+            "filename": 'sample.zip'
+        }
+    }
+    return Request({
+        'id': request_id,
+        'learner_id': learner_id,
+        'data': sample_data,
+        'validations': []
+    })
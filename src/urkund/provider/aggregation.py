@@ -0,0 +1,160 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund result checks aggregation module """
+import abc
+import hashlib
+import importlib
+import math
+import os
+import socket
+import threading
+
+
+def get_tick(when, tick_seconds):
+    """
+    Get the tick in which a check has to be done. Ticks are numbered from the epoch.
+    :param when: Timestamp of the check
+    :type when: float
+    :param tick_seconds: Seconds between ticks
+    :type tick_seconds: float
+    :return: First tick not before the check
+    :rtype: int
+    """
+    return int(math.ceil(when / tick_seconds))
+
+
+def get_worker_id():
+    """
+    Get the identifier of the worker process
+    :return: Host name and process id
+    :rtype: str
+    """
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def get_poll_key(analysis_email, tick):
+    """
+    Get the notification key of the aggregated checks of a receiver in a tick. Every worker uses the same key, so
+    there is a single check per receiver and tick.
+    :param analysis_email: Analysis address of the receiver
+    :type analysis_email: str
+    :param tick: Tick of the checks
+    :type tick: int
+    :return: Notification key
+    :rtype: str
+    """
+    receiver_hash = hashlib.sha1(analysis_email.encode('utf-8')).hexdigest()[:12]
+    return "tukrund_poll_data_{}_{}".format(receiver_hash, tick)
+
+
+class BasePendingIndex(abc.ABC):
+    """
+    Base class for the index of requests waiting for a result check, by receiver and tick. Check notifications only
+    hold the receiver and the tick, the requests are taken from the index when the check runs. The provider only
+    ships the in-process PendingIndex, requests are shared between workers by an implementation on a shared store,
+    importable by its full class name.
+    """
+
+    @abc.abstractmethod
+    def add(self, analysis_email, tick, info):
+        """
+        Add a request to the checks of a receiver in a tick
+        :param analysis_email: Analysis address of the receiver
+        :type analysis_email: str
+        :param tick: Tick of the check
+        :type tick: int
+        :param info: Request information
+        :type info: dict
+        :return: True if it is the first request of the receiver in the tick, so the check has to be scheduled
+        :rtype: bool
+        """
+
+    @abc.abstractmethod
+    def pop(self, analysis_email, tick):
+        """
+        Take the requests of a receiver in a tick, and the ones of previous ticks not checked yet
+        :param analysis_email: Analysis address of the receiver
+        :type analysis_email: str
+        :param tick: Tick of the check
+        :type tick: int
+        :return: Requests information
+        :rtype: list
+        """
+
+    def get_stats(self):
+        """
+        Get pending index statistics
+        :return: Pending index statistics
+        :rtype: dict
+        """
+        return {}
+
+
+class PendingIndex(BasePendingIndex):
+    """
+    In process pending index. Every worker process has its own index, the check of a tick only finds the requests
+    added by the worker process that runs it, so it is only used when it is set as the backend of a single worker
+    process.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, analysis_email, tick, info):
+        with self._lock:
+            first = (analysis_email, tick) not in self._buffers
+            self._buffers.setdefault((analysis_email, tick), []).append(info)
+
+            return first
+
+    def pop(self, analysis_email, tick):
+        with self._lock:
+            requests = []
+            for key in sorted(self._buffers.keys(), key=lambda buffer_key: buffer_key[1]):
+                if key[0] == analysis_email and key[1] <= tick:
+                    requests.extend(self._buffers.pop(key))
+
+            return requests
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'buffers': len(self._buffers),
+                'requests': sum([len(buffer) for buffer in self._buffers.values()])
+            }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_pending_index(backend=None):
+    """
+    Get the process wide pending index
+    :param backend: Full class name of the index implementation. In process index if not provided.
+    :type backend: str
+    :return: Pending index
+    :rtype: BasePendingIndex
+    """
+    with _indexes_lock:
+        if backend not in _indexes:
+            if backend is None:
+                _indexes[backend] = PendingIndex()
+            else:
+                module_name, class_name = backend.rsplit('.', 1)
+                _indexes[backend] = getattr(importlib.import_module(module_name), class_name)()
+
+        return _indexes[backend]
@@ -0,0 +1,162 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund submissions cache module """
+import abc
+import hashlib
+import importlib
+import threading
+from collections import OrderedDict
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_content_hash(content):
+    """
+    Get the hash of a file content
+    :param content: File content or file handle
+    :type content: bytes | file
+    :return: Hex digest
+    :rtype: str
+    """
+    content_hash = hashlib.sha256()
+    if hasattr(content, 'read'):
+        content.seek(0)
+        for chunk in iter(lambda: content.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+        content.seek(0)
+    else:
+        content_hash.update(content)
+
+    return content_hash.hexdigest()
+
+
+def get_cache_key(content_hash, analysis_email, learner_id=None):
+    """
+    Get the cache key of a submission
+    :param content_hash: Hash of the submitted content
+    :param analysis_email: Analysis address of the receiver
+    :param learner_id: Learner the submission belongs to
+    :return: Cache key
+    :rtype: str
+    """
+    return "{}:{}:{}".format(analysis_email, learner_id, content_hash)
+
+
+class BaseSubmissionCache(abc.ABC):
+    """
+    Base class for submission caches. Values are dicts with the external_id and analysis_email of the submission
+    and its report once analysed. The provider only ships the in-process LRUSubmissionCache, documents are
+    deduplicated between workers by an implementation on a shared store, importable by its full class name.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """
+        Get a cached submission
+        :param key: Cache key
+        :return: Cached submission or None
+        :rtype: dict
+        """
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        """
+        Store a submission
+        :param key: Cache key
+        :param value: Submission
+        :type value: dict
+        """
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """
+        Remove a submission
+        :param key: Cache key
+        """
+
+    def get_stats(self):
+        """
+        Get cache statistics
+        :return: Cache statistics
+        :rtype: dict
+        """
+        return {}
+
+
+class LRUSubmissionCache(BaseSubmissionCache):
+    """
+    In process least recently used submission cache. Every worker process has its own cache, documents sent by other
+    workers are not deduplicated.
+    """
+
+    def __init__(self, max_size=1024):
+        self._max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._items.move_to_end(key)
+            return dict(self._items[key])
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = dict(value)
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'hits': self._hits,
+                'misses': self._misses
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_submission_cache(backend=None, max_size=1024):
+    """
+    Get the process wide submission cache
+    :param backend: Full class name of the cache implementation. In process LRU cache if not provided.
+    :type backend: str
+    :param max_size: Maximum number of submissions kept by the LRU cache
+    :type max_size: int
+    :return: Submission cache
+    :rtype: BaseSubmissionCache
+    """
+    with _caches_lock:
+        if backend not in _caches:
+            if backend is None:
+                _caches[backend] = LRUSubmissionCache(max_size=max_size)
+            else:
+                module_name, class_name = backend.rsplit('.', 1)
+                _caches[backend] = getattr(importlib.import_module(module_name), class_name)()
+
+        return _caches[backend]
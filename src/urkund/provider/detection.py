@@ -0,0 +1,211 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund mimetype detection module """
+import os
+import struct
+import threading
+import magic
+
+# bytes used to detect the mimetype of a file
+SNIFF_SIZE = 8192
+# mimetypes of containers that libmagic can only refine looking at the whole file
+WHOLE_FILE_MIMETYPES = ['application/x-ole-storage', 'application/CDFV2']
+
+ZIP_SIGNATURE = b'PK\x03\x04'
+# OpenDocument mimetypes stored uncompressed as the first member of the zip container
+ODF_MIMETYPES = [
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.oasis.opendocument.text-template',
+    'application/vnd.oasis.opendocument.text-master',
+    'application/vnd.oasis.opendocument.presentation',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.graphics',
+    'application/vnd.oasis.opendocument.formula'
+]
+# first members of an Office Open XML package
+OOXML_FIRST_MEMBERS = (b'[Content_Types].xml', b'_rels/.rels')
+# Office Open XML mimetypes by the name prefix of the zip members
+OOXML_MIMETYPES = [
+    (b'word/', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    (b'ppt/', 'application/vnd.openxmlformats-officedocument.presentationml.presentation'),
+    (b'xl/', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+]
+
+
+def _iter_zip_member_names(header):
+    """
+    Get the names of the zip members whose local file header is in the first bytes of the file. Members may not
+    know their size until the data descriptor after their data, so the local file headers are searched.
+    :param header: First bytes of the file
+    :type header: bytes
+    :return: Generator of member names
+    :rtype: generator
+    """
+    position = header.find(ZIP_SIGNATURE)
+    while 0 <= position and position + 30 <= len(header):
+        name_length = struct.unpack_from('<H', header, position + 26)[0]
+        yield header[position + 30:position + 30 + name_length]
+        position = header.find(ZIP_SIGNATURE, position + 30 + name_length)
+
+
+def get_zip_mimetype(header):
+    """
+    Get the mimetype of an OpenDocument or Office Open XML zip container from the members in its first bytes
+    :param header: First bytes of the file
+    :type header: bytes
+    :return: Mimetype, None if it cannot be decided from the member names
+    :rtype: str
+    """
+    if len(header) < 30:
+        return None
+    method, compressed_size, name_length, extra_length = struct.unpack_from('<H8xI4xHH', header, 8)
+    name = header[30:30 + name_length]
+
+    # OpenDocument
+    if name == b'mimetype':
+        start = 30 + name_length + extra_length
+        mimetype = header[start:start + compressed_size].decode('ascii', 'replace')
+        if method == 0 and mimetype in ODF_MIMETYPES:
+            return mimetype
+        return None
+
+    # Office Open XML
+    if name not in OOXML_FIRST_MEMBERS:
+        return None
+    for name in _iter_zip_member_names(header):
+        for prefix, mimetype in OOXML_MIMETYPES:
+            if name.startswith(prefix):
+                return mimetype
+
+    return None
+
+
+def get_signature_mimetype(header):
+    """
+    Get the mimetype of the most common document formats from its signature
+    :param header: First bytes of the file
+    :type header: bytes
+    :return: Mimetype, None if it must be detected by libmagic
+    :rtype: str
+    """
+    if header.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if header.startswith(ZIP_SIGNATURE):
+        return get_zip_mimetype(header)
+    if header.startswith(b'{\\rtf') and len(header) > 5:
+        return 'text/rtf'
+
+    return None
+
+
+class MagicPool:
+    """
+    Reusable libmagic instances. Every caller takes an instance of its own, so threads and greenlets do not wait on
+    a shared instance, and the magic database is loaded once per instance instead of on every detection.
+    """
+
+    def __init__(self):
+        self._free = []
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take an instance from the pool, creating it if there are no free instances
+        :return: libmagic instance returning mimetypes
+        :rtype: magic.Magic
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self._created += 1
+
+        return magic.Magic(mime=True)
+
+    def release(self, instance):
+        """
+        Return an instance to the pool
+        :param instance: Instance taken with acquire
+        :type instance: magic.Magic
+        """
+        with self._lock:
+            self._free.append(instance)
+
+    def reset(self):
+        """
+        Forget the lock state inherited from the parent process after a fork
+        """
+        self._lock = threading.Lock()
+
+    def get_stats(self):
+        """
+        Get pool statistics
+        :return: Pool statistics
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'created': self._created,
+                'free': len(self._free)
+            }
+
+
+# libmagic instances of the worker process
+magic_pool = MagicPool()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=magic_pool.reset)
+
+
+def preload():
+    """
+    Load a libmagic instance, so the first detection does not load the magic database
+    """
+    magic_pool.release(magic_pool.acquire())
+
+
+def detect_mimetype(content):
+    """
+    Get the mimetype of a file from its first bytes. PDF, RTF, OpenDocument and Office Open XML documents are
+    identified by their signature, the rest, plain text included, by a pooled libmagic instance. Containers that
+    libmagic can only identify from the whole file (for instance .doc files) are checked again with the full content.
+    :param content: File content or file handle
+    :type content: bytes | file
+    :return: Mimetype
+    :rtype: str
+    """
+    if hasattr(content, 'read'):
+        content.seek(0)
+        header = content.read(SNIFF_SIZE)
+        content.seek(0)
+    else:
+        header = bytes(content[:SNIFF_SIZE])
+
+    mimetype = get_signature_mimetype(header)
+    if mimetype is not None:
+        return mimetype
+
+    instance = magic_pool.acquire()
+    try:
+        mimetype = instance.from_buffer(header)
+        if mimetype in WHOLE_FILE_MIMETYPES and len(header) == SNIFF_SIZE:
+            if hasattr(content, 'read'):
+                mimetype = instance.from_descriptor(content.fileno())
+                content.seek(0)
+            else:
+                mimetype = instance.from_buffer(bytes(content))
+    finally:
+        magic_pool.release(instance)
+
+    return mimetype
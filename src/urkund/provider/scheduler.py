@@ -0,0 +1,140 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund result polling scheduler module """
+import random
+import threading
+import time
+
+# weight of the last observed duration in the analysis duration estimation
+DURATION_SMOOTHING = 0.3
+
+
+def get_size_bucket(size):
+    """
+    Get the size bucket of a document. Buckets double its size from 64 KiB.
+    :param size: Document size in bytes
+    :type size: int
+    :return: Size bucket
+    :rtype: int
+    """
+    return max(0, int(size or 0).bit_length() - 16)
+
+
+class AnalysisDurations:
+    """
+    Observed Urkund analysis durations by mimetype and document size
+    """
+
+    def __init__(self):
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def add(self, mimetype, size, duration):
+        """
+        Add an observed analysis duration
+        :param mimetype: Document mimetype
+        :type mimetype: str
+        :param size: Document size in bytes
+        :type size: int
+        :param duration: Seconds from the submission to the analysis
+        :type duration: float
+        """
+        key = (mimetype, get_size_bucket(size))
+        with self._lock:
+            if key in self._durations:
+                duration = (1 - DURATION_SMOOTHING) * self._durations[key] + DURATION_SMOOTHING * duration
+            self._durations[key] = duration
+
+    def estimate(self, mimetype, size):
+        """
+        Get the expected analysis duration of a document
+        :param mimetype: Document mimetype
+        :type mimetype: str
+        :param size: Document size in bytes
+        :type size: int
+        :return: Expected seconds from the submission to the analysis, None if unknown
+        :rtype: float
+        """
+        with self._lock:
+            return self._durations.get((mimetype, get_size_bucket(size)))
+
+
+# durations observed by the worker process
+analysis_durations = AnalysisDurations()
+
+
+class PollScheduler:
+    """
+    Decide when the pending documents of a request are checked again. The countdown grows exponentially with
+    the number of checks, is shortened for documents in a more advanced state and when the observed analysis
+    durations say the documents should be ready sooner, and has a random jitter so the checks of requests sent
+    at the same time are spread.
+    """
+
+    def __init__(self, config, durations=None):
+        """
+        :param config: Provider configuration
+        :type config: dict
+        :param durations: Observed analysis durations
+        :type durations: AnalysisDurations
+        """
+        self._config = config
+        self._durations = durations
+        if self._durations is None:
+            self._durations = analysis_durations
+
+    def next_countdown(self, attempt, pending):
+        """
+        Get the seconds to wait before the next check
+        :param attempt: Number of checks already done
+        :type attempt: int
+        :param pending: Pending documents
+        :type pending: list
+        :return: Seconds to wait
+        :rtype: float
+        """
+        countdown_min = self._config['countdown_min'] * 60
+        countdown_max = self._config['countdown_max'] * 60
+
+        countdown = self._config['countdown_initial'] * 60 * (self._config['countdown_multiplier'] ** attempt)
+
+        # documents in a more advanced state are checked sooner
+        state_factors = self._config['countdown_state_factors']
+        factors = [state_factors.get(res.get('state'), 1) for res in pending]
+        if len(factors) > 0:
+            countdown *= min(factors)
+
+        # check when the first document is expected to be analysed
+        now = time.time()
+        for res in pending:
+            if 'submitted_at' not in res:
+                continue
+            expected = self._durations.estimate(res.get('mimetype'), res.get('size'))
+            if expected is not None:
+                countdown = min(countdown, max(expected - (now - res['submitted_at']), countdown_min))
+
+        jitter = self._config['countdown_jitter']
+        countdown *= random.uniform(1 - jitter, 1 + jitter)
+
+        return min(max(countdown, countdown_min), countdown_max)
+
+    def add_analyzed(self, res):
+        """
+        Learn from an analysed document
+        :param res: Analysed document
+        :type res: dict
+        """
+        if 'submitted_at' in res:
+            self._durations.add(res.get('mimetype'), res.get('size'), time.time() - res['submitted_at'])
@@ -13,14 +13,34 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE Urkund Plagiarism module """
+import copy
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import requests
 from tesla_ce_provider import BaseProvider, result, message
+from tesla_ce_provider.models.base import Request
 from tesla_ce_provider.provider.audit.tp import PlagiarismAudit
 from . import utils
-from ..urkund_lib import UrkundLib
+from .aggregation import get_pending_index, get_poll_key, get_tick
+from .cache import get_cache_key, get_content_hash, get_submission_cache
+from .scheduler import PollScheduler
+from ..urkund_lib import get_urkund_lib, metrics
 from ..urkund_lib.exceptions import BaseUrkundLibException, MediaTypeNotSupported, RequestTooLarge, BadRequest, Timeout
+from ..urkund_lib.exceptions import CircuitOpen, ConnectionFailed, InvalidResponse, NotAvailable, RateLimited
+
+# Urkund usage metrics of the worker process
+poll_outcomes = metrics.registry.counter('urkund_polls_total', 'Result checks of sent documents by outcome',
+                                         ('outcome',))
+analysis_seconds = metrics.registry.histogram('urkund_analysis_seconds',
+                                              'Seconds from the submission of a document to its analysis',
+                                              buckets=(30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 43200))
+# errors of a result check which are checked again later, the rest reject the document
+TRANSIENT_CHECK_ERRORS = (Timeout, ConnectionFailed, RateLimited, CircuitOpen, NotAvailable, InvalidResponse)
+request_documents = metrics.registry.histogram('urkund_request_documents', 'Documents of the verification requests',
+                                               buckets=(1, 2, 5, 10, 20, 50, 100, 200))
 
 
 class UrkundProvider(BaseProvider):
@@ -47,6 +67,7 @@ class UrkundProvider(BaseProvider):
         'application/gzip',
         'application/x-tar',
         'application/x-bzip2',
+        'application/x-xz',
         'application/x-7z-compressed',
         'application/x-rar-compressed',
         'application/x-lzma'
@@ -59,17 +80,57 @@ class UrkundProvider(BaseProvider):
 
     config = {
         'compression_recursive_extract_level': 3,
-        'timeout_retries': 0,
         'max_timeout_retries': 3,
         'timeout_between_retries': 60,
+        'timeout_retry_mode': 'delayed',
+        'sample_download_timeout': (5, 60),
         'countdown_multiplier': 2,
-        'countdown_initial': 5
+        'countdown_initial': 5,
+        'countdown_min': 1,
+        'countdown_max': 60,
+        'countdown_jitter': 0.1,
+        'max_poll_attempts': 50,
+        'countdown_state_factors': {
+            'Submitted': 1,
+            'Accepted': 0.5
+        },
+        'http_pool_size': 10,
+        'http_timeouts': None,
+        'upload_min_rate': 262144,
+        'verify_deadline': None,
+        'rate_limit': 10,
+        'rate_limit_burst': None,
+        'rate_limit_wait': 5,
+        'circuit_failure_threshold': 5,
+        'circuit_reset_timeout': 30,
+        'metadata_cache_ttl': 300,
+        'validation_ttl': 3600,
+        'max_parallel_submissions': 5,
+        'max_parallel_polls': 10,
+        'bulk_result_polls': False,
+        'bulk_result_min_documents': 20,
+        'poll_aggregation': False,
+        'poll_aggregation_tick': 60,
+        'poll_aggregation_backend': None,
+        'poll_deadline': 60,
+        'upload_stream_threshold': 10485760,
+        'cross_request_deduplication': False,
+        'deduplication_cache_backend': None,
+        'deduplication_cache_size': 1024,
+        'base_url': None,
+        'trace_spans': False,
+        'extraction_processes': 0
     }
     _urkund_lib = None
 
+    def __init__(self):
+        super().__init__()
+        # options are set on the instance, the class defaults are shared by all the providers of the process
+        self.config = copy.deepcopy(UrkundProvider.config)
+
     def _get_urkund_lib(self):
         """
-        Return UrkundLib instance
+        Return UrkundLib instance, shared by the providers of the process with the same credentials and options
         :return:
         """
         if self._urkund_lib is None:
@@ -77,14 +138,43 @@ class UrkundProvider(BaseProvider):
             if self.credentials['URKUND_SUBORGANIZATION'] is not None:
                 suborganization = suborganization.strip()
 
-            self._urkund_lib = UrkundLib(user=self.credentials['URKUND_USER'].strip(),
-                                         password=self.credentials['URKUND_PASSWORD'].strip(),
-                                         unit=self.credentials['URKUND_UNIT'].strip(),
-                                         organization=self.credentials['URKUND_ORGANIZATION'].strip(),
-                                         sub_organization=suborganization)
+            self._urkund_lib = get_urkund_lib(user=self.credentials['URKUND_USER'].strip(),
+                                              password=self.credentials['URKUND_PASSWORD'].strip(),
+                                              unit=self.credentials['URKUND_UNIT'].strip(),
+                                              organization=self.credentials['URKUND_ORGANIZATION'].strip(),
+                                              sub_organization=suborganization,
+                                              pool_size=self.config['http_pool_size'],
+                                              rate_limit=self.config['rate_limit'],
+                                              rate_limit_burst=self.config['rate_limit_burst'],
+                                              rate_limit_wait=self.config['rate_limit_wait'],
+                                              circuit_failure_threshold=self.config['circuit_failure_threshold'],
+                                              circuit_reset_timeout=self.config['circuit_reset_timeout'],
+                                              timeouts=self.config['http_timeouts'],
+                                              upload_min_rate=self.config['upload_min_rate'],
+                                              cache_ttl=self.config['metadata_cache_ttl'],
+                                              validation_ttl=self.config['validation_ttl'],
+                                              base_url=self.config['base_url'])
 
         return self._urkund_lib
 
+    def _check_sample(self, request):
+        """
+        Check the sample of a request and build its lazy tree of files
+        :param request: Verification request
+        :type request: Request
+        :return: Sample check, see utils.check_sample_file
+        :rtype: dict
+        """
+        executor = None
+        if self.config['extraction_processes'] > 0:
+            executor = utils.get_extraction_pool(self.config['extraction_processes'])
+
+        return utils.check_sample_file(request, self.config['compression_recursive_extract_level'],
+                                       self.accepted_mimetypes, self.compressed_mimetypes,
+                                       self.accepted_mimetypes_urkund,
+                                       stream_threshold=self.config['upload_stream_threshold'], lazy=True,
+                                       executor=executor)
+
     def set_options(self, options):
         """
             Set options for the provider
@@ -108,20 +198,34 @@ class UrkundProvider(BaseProvider):
             :return: Verification result
             :rtype: tesla_provider.VerificationResult
         """
+        metrics.set_tracing(self.config['trace_spans'])
+        with metrics.span('verify'):
+            return self._verify(request, model)
+
+    def _verify(self, request, model):
+        """
+            Verify a learner request, see verify
+            :param request: Verification request
+            :type request: Request
+            :param model: Provider model
+            :type model: dict
+            :return: Verification result
+            :rtype: tesla_provider.VerificationResult
+        """
+        deadline = self._get_deadline()
 
         # Check provided input
-        sample_check = utils.check_sample_file(request, self.config['compression_recursive_extract_level'],
-                                               self.accepted_mimetypes, self.compressed_mimetypes,
-                                               self.accepted_mimetypes_urkund)
+        sample_check = self._check_sample(request)
 
         if not sample_check['valid']:
             return result.VerificationResult(False, error_message=sample_check['msg'],
                                              message_code=sample_check['code'])
 
         # sample is valid proceed to sent to urkund
-        receiver = self._get_urkund_lib().receivers.get_by_email(self.credentials['URKUND_DEFAULT_EMAIL_RECEIVER'])
+        with metrics.span('receiver_lookup'):
+            receiver = self._get_urkund_lib().receivers.get_by_email(
+                self.credentials['URKUND_DEFAULT_EMAIL_RECEIVER'], deadline=deadline)
 
-        idx = 0
         info = {
             "learner_id": request.learner_id,
             "request_id": request.request_id,
@@ -132,95 +236,464 @@ class UrkundProvider(BaseProvider):
             },
             "errors": [],
             "countdown": self.config['countdown_initial'],
-            "total_files": len(sample_check['tree_file'])
+            "poll_attempt": 0,
+            "total_files": 0
         }
 
-        for t_file in sample_check['tree_file']:
-            if t_file['status'] == 'ACCEPTED':
-                file = {
-                    "filename": t_file['filename'],
-                    "mimetype": t_file['mimetype'],
-                    "content": t_file['content']
-                }
-                external_id = "{}_{}".format(request.request_id, idx)
-
-                email = "{}{}".format(request.learner_id, self._get_urkund_lib().receivers.get_suffix())
-                try:
-                    response = self._get_urkund_lib().submissions.send(external_id=external_id, file=file,
-                                                                       analysis_email=receiver['AnalysisAddress'],
-                                                                       email=email)
-
-                    if response['Status']['State'] in ('Submitted', 'Accepted', 'Analyzed'):
-                        aux = {
-                            "external_id": external_id,
-                            "analysis_email": receiver['AnalysisAddress'],
-                            "filename": t_file['filename']
-                        }
-                        info['external_ids'].append(aux)
-
-                    elif response['Status']['State'] == 'Error':
-                        urkund_code = self._get_urkund_lib().submissions.\
-                            get_message_from_submission_error(response['Status']['ErrorCode'])
-
-                        aux = {
-                            "code": message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
-                            "filename": t_file['filename'],
-                            "urkund_code": urkund_code,
-                            "urkund_message": response['Status']['Message']
-                        }
-                        info['processed_external_ids']['errors'].append(aux)
-
-                    else:
-                        aux = {
-                            "code": message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
-                            "filename": t_file['filename'],
-                            "urkund_code": None,
-                            "urkund_message": response['Status']['Message']
-                        }
-                        info['processed_external_ids']['errors'].append(aux)
-
-                    idx += 1
-                except Timeout:
-                    self.config['timeout_retries'] += 1
-                    if self.config['timeout_retries'] >= self.config['max_timeout_retries']:
-                        aux = {
-                            "code": message.provider.Provider.PROVIDER_EXTERNAL_SERVICE_TIMEOUT.value,
-                            "filename": t_file['filename'],
-                            "urkund_code": None,
-                            "urkund_message": None
-                        }
-                        info['processed_external_ids']['errors'].append(aux)
-                    else:
-                        return self.verify(request, model)
-
-                except MediaTypeNotSupported:
-                    aux = {
-                        "code": message.provider.Provider.PROVIDER_INVALID_MIMETYPE.value,
+        # files are sent while the sample is extracted, external ids follow the order of the accepted files
+        email = "{}{}".format(request.learner_id, self._get_urkund_lib().receivers.get_suffix())
+        max_workers = max(1, int(self.config['max_parallel_submissions']))
+        submission_cache = None
+        if self.config['cross_request_deduplication']:
+            submission_cache = self._get_submission_cache()
+
+        # timeouts are retried inline with a growing wait, or handed off to a delayed notification as throttled files
+        attempts = 1
+        if self.config['timeout_retry_mode'] != 'delayed':
+            attempts += self.config['max_timeout_retries']
+        keep_pending = self.config['max_timeout_retries'] > 0
+
+        sent_files = []
+        sent_hashes = {}
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for t_file in sample_check['tree_file']:
+                info['total_files'] += 1
+                if t_file['status'] != 'ACCEPTED':
+                    # rejected files are processed documents of the request, as archives which could not be
+                    # extracted once the files before the error are sent
+                    utils.close_tree_file(t_file)
+                    code = message.provider.Provider.PROVIDER_INVALID_MIMETYPE.value
+                    if t_file.get('error') == 'EXTRACTION_ERROR':
+                        code = message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value
+                    info['processed_external_ids']['errors'].append({
+                        "code": code,
                         "filename": t_file['filename'],
                         "urkund_code": None,
                         "urkund_message": None
-                    }
-                    info['processed_external_ids']['errors'].append(aux)
-                except (BadRequest, RequestTooLarge, BaseUrkundLibException):
-                    aux = {
-                        "code": message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
-                        "filename": t_file['filename'],
-                        "urkund_code": None,
-                        "urkund_message": None
-                    }
-                    info['processed_external_ids']['errors'].append(aux)
+                    })
+                    continue
+
+                # duplicated documents are analysed once
+                content_hash = get_content_hash(t_file['content'])
+                if content_hash in sent_hashes:
+                    utils.close_tree_file(t_file)
+                    sent_files.append((sent_hashes[content_hash][0], t_file['filename'], sent_hashes[content_hash][1]))
+                    continue
+
+                cache_key = None
+                if submission_cache is not None:
+                    cache_key = get_cache_key(content_hash, receiver['AnalysisAddress'], request.learner_id)
+                    cached = submission_cache.get(cache_key)
+                    if cached is not None:
+                        utils.close_tree_file(t_file)
+                        if cached['report'] is not None:
+                            info['processed_external_ids']['corrects'].append(
+                                self._get_correct(dict(cached, filename=t_file['filename']), cached['report']))
+                        else:
+                            info['external_ids'].append({
+                                "external_id": cached['external_id'],
+                                "analysis_email": cached['analysis_email'],
+                                "filename": t_file['filename'],
+                                "cache_key": cache_key
+                            })
+                        continue
+
+                external_id = "{}_{}".format(request.request_id, len(sent_hashes))
+                future = executor.submit(self._send_file, external_id, t_file, receiver['AnalysisAddress'], email,
+                                         attempts=attempts, keep_pending=keep_pending, deadline=deadline)
+                sent_hashes[content_hash] = (future, cache_key)
+                sent_files.append((future, t_file['filename'], cache_key))
+
+                # do not extract more files than the ones that can be sent
+                in_flight.add(future)
+                if len(in_flight) >= max_workers:
+                    _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+
+        request_documents.observe(info['total_files'])
+
+        # files which timed out or were throttled are extracted again from the request and sent later with the same
+        # external id, the rest are not sent again
+        pending_files = {}
+        for future, filename, cache_key in sent_files:
+            sent, aux = self._get_sent_file(future, filename)
+            if sent is None:
+                if aux['external_id'] in pending_files:
+                    pending_files[aux['external_id']]['duplicates'].append(filename)
+                else:
+                    pending_files[aux['external_id']] = dict(aux, filename=filename, cache_key=cache_key,
+                                                             duplicates=[])
+                continue
+
+            self._add_sent_file(info, sent, aux, filename, cache_key)
+
+        if len(pending_files) > 0:
+            info['pending_files'] = list(pending_files.values())
+            info['analysis_email'] = receiver['AnalysisAddress']
+            info['email'] = email
+            info['send_attempt'] = 1
+            self._create_send_notification(info)
+
+            return result.VerificationDelayedResult(learner_id=request.learner_id, request_id=request.request_id,
+                                                    result=result.VerificationResult(True))
 
         # check if there is any sent document valid to check in the future
         if len(info['external_ids']) == 0:
+            if len(info['processed_external_ids']['corrects']) > 0:
+                # all the documents were already analysed
+                return self._get_verification_result(info['processed_external_ids'])
             return result.VerificationResult(False, message_code=message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value)
 
-        key = "tukrund_check_data_{}".format(uuid.uuid4())
-        notification = result.NotificationTask(key, countdown=info['countdown']*60, info=info)
-        self.update_or_create_notification(notification)
+        self._create_check_notification(info)
 
         return result.VerificationDelayedResult(learner_id=request.learner_id, request_id=request.request_id,
                                                 result=result.VerificationResult(True))
 
+    def _get_sent_file(self, future, filename):
+        """
+            Get the result of a file submission. Unexpected errors only reject the file, the rest of the sent
+            files are still checked.
+            :param future: Submission of the file
+            :type future: concurrent.futures.Future
+            :param filename: Filename of the document
+            :type filename: str
+            :return: Whether the file was submitted (None if it is pending) and the external id, error information
+                     or pending file
+            :rtype: tuple
+        """
+        try:
+            return future.result()
+        except Exception as exception:
+            self.log_trace('File {} not sent: {}'.format(filename, repr(exception)))
+            return False, self._get_error(message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value, filename)
+
+    def _add_sent_file(self, info, sent, aux, filename, cache_key=None):
+        """
+            Add the result of a file submission to the request information
+            :param info: Request information
+            :type info: dict
+            :param sent: Whether the file was submitted
+            :type sent: bool
+            :param aux: External id or error information
+            :type aux: dict
+            :param filename: Filename of the document
+            :type filename: str
+            :param cache_key: Key of the document in the submissions cache
+            :type cache_key: str
+        """
+        aux = dict(aux, filename=filename)
+        if sent:
+            if cache_key is not None:
+                aux['cache_key'] = cache_key
+                self._get_submission_cache().set(cache_key, {
+                    "external_id": aux['external_id'],
+                    "analysis_email": aux['analysis_email'],
+                    "report": None
+                })
+            info['external_ids'].append(aux)
+        else:
+            info['processed_external_ids']['errors'].append(aux)
+
+    def _create_check_notification(self, info):
+        """
+            Schedule the next result check of the sent documents. With poll aggregation and a shared pending index
+            the request is added to the check of its receiver in the first tick after the countdown.
+            :param info: Request information, with the number of checks already done
+            :type info: dict
+        """
+        countdown = PollScheduler(self.config).next_countdown(info['poll_attempt'], info['external_ids'])
+        info['countdown'] = countdown / 60
+
+        # aggregated notifications only point to the requests in the index, which has to be shared by the workers
+        if self.config['poll_aggregation'] and self.config['poll_aggregation_backend'] is not None:
+            tick_seconds = self.config['poll_aggregation_tick']
+            analysis_email = info['external_ids'][0]['analysis_email']
+            tick = get_tick(time.time() + countdown, tick_seconds)
+            if not self._get_pending_index().add(analysis_email, tick, info):
+                # the check of the receiver in this tick is already scheduled
+                return
+            notification = result.NotificationTask(get_poll_key(analysis_email, tick),
+                                                   countdown=max(tick * tick_seconds - time.time(), 0),
+                                                   info={"analysis_email": analysis_email, "tick": tick})
+        else:
+            key = "tukrund_check_data_{}".format(uuid.uuid4())
+            notification = result.NotificationTask(key, countdown=countdown, info=info)
+
+        self.update_or_create_notification(notification)
+
+    def _create_send_notification(self, info):
+        """
+            Schedule a new submission of the files which timed out or were throttled. The submission waits at
+            least until the Urkund API circuit is closed again.
+            :param info: Request information, with the pending files and the number of attempts already done
+            :type info: dict
+        """
+        countdown = max(self._get_retry_countdown(info['send_attempt']),
+                        self._get_urkund_lib().request.get_retry_after())
+        countdown = min(countdown, self.config['countdown_max'] * 60)
+        key = "tukrund_send_data_{}".format(uuid.uuid4())
+        notification = result.NotificationTask(key, countdown=countdown, info=info)
+        self.update_or_create_notification(notification)
+
+    def _get_retry_countdown(self, attempt):
+        """
+            Seconds to wait before sending again a file which timed out. The wait doubles with every attempt.
+            :param attempt: Number of attempts already done
+            :type attempt: int
+            :return: Seconds to wait
+            :rtype: float
+        """
+        return self.config['timeout_between_retries'] * (2 ** (attempt - 1))
+
+    def _resend_files(self, info):
+        """
+            Send again the files of a request which timed out or were throttled. Pending files only keep their path
+            in the sample, which is downloaded again from TeSLA CE and extracted to get them.
+            :param info: Request information, with the pending files and the number of attempts already done
+            :type info: dict
+        """
+        attempt = info['send_attempt'] + 1
+        # the last attempt converts timeouts and throttled files into errors
+        keep_pending = attempt <= self.config['max_timeout_retries']
+        max_workers = max(1, min(int(self.config['max_parallel_submissions']), len(info['pending_files'])))
+        deadline = self._get_deadline()
+
+        pending_by_filename = {pending['filename']: pending for pending in info['pending_files']}
+        sent_files = []
+        unsent_files = []
+        try:
+            sample_check = self._check_sample(self._get_request(info['request_id']))
+        except Exception as exception:
+            # TeSLA CE is not available, the files are sent later
+            self.log_trace('Sample of request {} not available: {}'.format(info['request_id'], repr(exception)))
+            sample_check = None
+            unsent_files = list(pending_by_filename.values())
+            pending_by_filename = {}
+
+        if sample_check is not None and sample_check['valid']:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for t_file in sample_check['tree_file']:
+                    pending = pending_by_filename.pop(t_file['filename'], None)
+                    if pending is None or t_file['status'] != 'ACCEPTED':
+                        utils.close_tree_file(t_file)
+                        continue
+
+                    future = executor.submit(self._send_file, pending['external_id'], t_file,
+                                             info['analysis_email'], info['email'], keep_pending=keep_pending,
+                                             deadline=deadline)
+                    sent_files.append((future, pending))
+                    if len(pending_by_filename) == 0:
+                        break
+
+        pending_files = []
+        for future, pending in sent_files:
+            sent, aux = self._get_sent_file(future, pending['filename'])
+            if sent is None:
+                pending_files.append(pending)
+                continue
+
+            for filename in [pending['filename']] + pending['duplicates']:
+                self._add_sent_file(info, sent, aux, filename, pending['cache_key'])
+
+        for pending in unsent_files:
+            if keep_pending:
+                pending_files.append(pending)
+                continue
+            for filename in [pending['filename']] + pending['duplicates']:
+                self._add_sent_file(info, False, self._get_error(
+                    message.provider.Provider.PROVIDER_EXTERNAL_SERVICE_TIMEOUT.value, filename), filename)
+
+        # files no longer found in the sample
+        for pending in pending_by_filename.values():
+            for filename in [pending['filename']] + pending['duplicates']:
+                self._add_sent_file(info, False, self._get_error(
+                    message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value, filename), filename)
+
+        if len(pending_files) > 0:
+            info['pending_files'] = pending_files
+            info['send_attempt'] = attempt
+            self._create_send_notification(info)
+            return
+
+        del info['pending_files']
+        del info['send_attempt']
+        if len(info['external_ids']) > 0:
+            self._create_check_notification(info)
+            return
+
+        if len(info['processed_external_ids']['corrects']) > 0:
+            result_obj = self._get_verification_result(info['processed_external_ids'])
+        else:
+            result_obj = result.VerificationResult(
+                False, message_code=message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value)
+        verif_delayed_result = result.VerificationDelayedResult(learner_id=info['learner_id'],
+                                                                request_id=info['request_id'],
+                                                                result=result_obj, info=None)
+        self.update_delayed_result(verif_delayed_result)
+
+    def _get_request(self, request_id):
+        """
+            Get a verification request of the provider from TeSLA CE, with its sample data
+            :param request_id: Request id
+            :type request_id: int
+            :return: Verification request
+            :rtype: Request
+        """
+        from tesla_ce_provider import client
+
+        request = client.provider.verification.get_provider_request_result(self.provider_id, request_id)
+        verify = os.getenv('SSL_VERIFY', True) not in ['False', 'false', 0, False, '0']
+        response = requests.get(request['request']['data'], verify=verify,
+                                timeout=tuple(self.config['sample_download_timeout']))
+        response.raise_for_status()
+        request['request']['data'] = response.json()
+
+        return Request(request)
+
+    def _get_deadline(self):
+        """
+            Get the time the Urkund requests of a task have to finish before
+            :return: time.monotonic() value, None if there is no deadline
+            :rtype: float
+        """
+        if self.config['verify_deadline'] is None:
+            return None
+
+        return time.monotonic() + self.config['verify_deadline']
+
+    def _send_file(self, external_id, t_file, analysis_email, email, attempts=1, keep_pending=False,
+                   deadline=None):
+        """
+            Send an accepted file to Urkund
+            :param external_id: External id of the submission
+            :type external_id: str
+            :param t_file: Accepted file from the sample tree
+            :type t_file: dict
+            :param analysis_email: Analysis address of the receiver
+            :type analysis_email: str
+            :param email: Submitter email
+            :type email: str
+            :param attempts: Number of times the file is sent while Urkund times out
+            :type attempts: int
+            :param keep_pending: Return the file as pending instead of an error when it is throttled, or when it
+                                 times out and it is not retried inline, so it can be sent later
+            :type keep_pending: bool
+            :param deadline: time.monotonic() value the submission has to finish before. Files with attempts left
+                             are returned to be sent later when it is reached.
+            :type deadline: float
+            :return: Whether the file was submitted (None if it is pending) and the external id, error information
+                     or pending file
+            :rtype: tuple
+        """
+        file = {
+            "filename": t_file['filename'],
+            "mimetype": t_file['mimetype'],
+            "content": t_file['content']
+        }
+        size = utils.get_content_size(t_file['content'])
+
+        try:
+            attempt = 1
+            while True:
+                try:
+                    response = self._get_urkund_lib().submissions.send(external_id=external_id, file=file,
+                                                                       analysis_email=analysis_email, email=email,
+                                                                       deadline=deadline)
+                    break
+                except (RateLimited, CircuitOpen):
+                    # Urkund is overloaded, the file is sent later while there are attempts left
+                    if keep_pending:
+                        return None, self._get_pending_file(external_id, t_file)
+
+                    return False, self._get_error(message.provider.Provider.PROVIDER_EXTERNAL_SERVICE_TIMEOUT.value,
+                                                  t_file['filename'])
+                except (Timeout, ConnectionFailed):
+                    countdown = self._get_retry_countdown(attempt)
+                    if deadline is not None and time.monotonic() + countdown >= deadline and \
+                            (keep_pending or attempt < attempts):
+                        # the task has no time left, the file is sent later
+                        return None, self._get_pending_file(external_id, t_file)
+
+                    if attempt < attempts:
+                        time.sleep(countdown)
+                        attempt += 1
+                        continue
+
+                    if keep_pending and attempts == 1:
+                        # files retried inline are not sent again later
+                        return None, self._get_pending_file(external_id, t_file)
+
+                    return False, self._get_error(message.provider.Provider.PROVIDER_EXTERNAL_SERVICE_TIMEOUT.value,
+                                                  t_file['filename'])
+        except MediaTypeNotSupported:
+            return False, self._get_error(message.provider.Provider.PROVIDER_INVALID_MIMETYPE.value,
+                                          t_file['filename'])
+        except (BadRequest, RequestTooLarge, BaseUrkundLibException):
+            return False, self._get_error(message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
+                                          t_file['filename'])
+        finally:
+            # release the file as soon as it is sent
+            utils.close_tree_file(t_file)
+
+        if response['Status']['State'] in ('Submitted', 'Accepted', 'Analyzed'):
+            return True, {
+                "external_id": external_id,
+                "analysis_email": analysis_email,
+                "filename": t_file['filename'],
+                "mimetype": t_file['mimetype'],
+                "size": size,
+                "state": response['Status']['State'],
+                "submitted_at": time.time()
+            }
+
+        urkund_code = None
+        if response['Status']['State'] == 'Error':
+            urkund_code = self._get_urkund_lib().submissions.\
+                get_message_from_submission_error(response['Status']['ErrorCode'])
+
+        return False, self._get_error(message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
+                                      t_file['filename'], urkund_code, response['Status']['Message'])
+
+    @staticmethod
+    def _get_error(code, filename, urkund_code=None, urkund_message=None):
+        """
+            Get the processed information of a document which could not be analysed
+            :param code: Provider message code
+            :type code: str
+            :param filename: Filename of the document
+            :type filename: str
+            :param urkund_code: Urkund error message
+            :type urkund_code: str
+            :param urkund_message: Urkund status message
+            :type urkund_message: str
+            :return: Processed document
+            :rtype: dict
+        """
+        return {
+            "code": code,
+            "filename": filename,
+            "urkund_code": urkund_code,
+            "urkund_message": urkund_message
+        }
+
+    @staticmethod
+    def _get_pending_file(external_id, t_file):
+        """
+            Get a file which could not be sent. Its content is not stored in the notification, the file is extracted
+            again from the request sample by its filename.
+            :param external_id: External id of the submission
+            :type external_id: str
+            :param t_file: Accepted file from the sample tree
+            :type t_file: dict
+            :return: Pending file
+            :rtype: dict
+        """
+        return {
+            "external_id": external_id,
+            "filename": t_file['filename'],
+            "mimetype": t_file['mimetype']
+        }
+
     def on_notification(self, key, info):
         """
             Respond to a notification task
@@ -231,89 +704,269 @@ class UrkundProvider(BaseProvider):
 
             self.update_or_create_notification(result.NotificationTask('key', countdown=30, info={'my_field': 3}))
         """
+        metrics.set_tracing(self.config['trace_spans'])
+        # the notification type, without the request or receiver part of the key
+        with metrics.span('notification', '_'.join(key.split('_')[:3])):
+            self._on_notification(key, info)
 
-        if key.startswith('tukrund_check_data'):
-            new_info = {
-                "learner_id": info['learner_id'],
-                "request_id": info['request_id'],
-                "external_ids": [],
-                "processed_external_ids": {
-                    "errors": [],
-                    "corrects": []
-                },
-                "errors": [],
-                "countdown": self.config['countdown_initial'] * self.config['countdown_multiplier']
-            }
+    def _on_notification(self, key, info):
+        """
+            Respond to a notification task, see on_notification
+            :param key: The notification task unique key
+            :type key: str
+            :param info: Information stored in the notification
+            :type info: dict
+        """
+        if key.startswith('tukrund_send_data'):
+            self._resend_files(info)
+
+        elif key.startswith('tukrund_poll_data'):
+            # aggregated checks of the requests of a receiver, results are requested together
+            requests_info = self._get_pending_index().pop(info['analysis_email'], info['tick'])
+            if len(requests_info) == 0:
+                self.log_trace('No pending requests in the Urkund check of tick {}'.format(info['tick']))
+                return
+            try:
+                responses_by_id = self._get_results([res for request_info in requests_info
+                                                     for res in request_info['external_ids']])
+            except Exception as exception:
+                # the requests taken from the index are added again to a later check
+                self.log_trace('Urkund check of tick {} failed: {}'.format(info['tick'], repr(exception)))
+                for request_info in requests_info:
+                    self._reschedule_check(request_info)
+                return
+
+            for request_info in requests_info:
+                try:
+                    self._check_request(request_info, responses_by_id)
+                except Exception as exception:
+                    # a failing request does not stop the rest, it is checked again later
+                    self.log_trace('Urkund check of request {} failed: {}'.format(
+                        request_info['request_id'], repr(exception)))
+                    self._reschedule_check(request_info)
+
+        elif key.startswith('tukrund_check_data'):
+            self._check_request(info, self._get_results(info['external_ids']))
 
-            # check for every external_id if Urkund has result
-            for res in info['external_ids']:
-                responses = self._get_urkund_lib().submissions.result(external_id=res['external_id'],
-                                                                      analysis_email=res['analysis_email'])
+    def _get_results(self, external_ids):
+        """
+            Get the Urkund results of sent documents, entries not checked before the deadline are not returned
+            :param external_ids: Sent documents
+            :type external_ids: list
+            :return: Submissions or raised exception by analysis email and external id
+            :rtype: dict
+        """
+        # duplicated documents share the same submission, which is checked only once
+        return self._get_urkund_lib().submissions.results(
+            [(res['analysis_email'], res['external_id']) for res in external_ids],
+            max_workers=self.config['max_parallel_polls'], timeout=self.config['poll_deadline'],
+            bulk=self.config['bulk_result_polls'], bulk_min_submissions=self.config['bulk_result_min_documents'])
+
+    def _check_request(self, info, responses_by_id):
+        """
+            Update the documents of a request with their Urkund results, sending the verification result once all
+            of them are processed or scheduling a new check of the pending ones
+            :param info: Request information
+            :type info: dict
+            :param responses_by_id: Submissions or raised exception by analysis email and external id
+            :type responses_by_id: dict
+        """
+        scheduler = PollScheduler(self.config)
+        # documents already processed are kept, only the pending ones are checked again
+        new_info = {
+            "learner_id": info['learner_id'],
+            "request_id": info['request_id'],
+            "external_ids": [],
+            "processed_external_ids": {
+                "errors": list(info['processed_external_ids']['errors']),
+                "corrects": list(info['processed_external_ids']['corrects'])
+            },
+            "errors": info['errors'],
+            "countdown": info['countdown'],
+            "poll_attempt": info.get('poll_attempt', 0),
+            "total_files": info['total_files']
+        }
 
-                for response in responses:
-                    if response['Status']['State'] == 'Analyzed':
-                        # return response OK
-                        aux = {
+        # entries without result are left for the next check
+        for res in info['external_ids']:
+            responses = responses_by_id.get((res['analysis_email'], res['external_id']))
+            if responses is None or isinstance(responses, TRANSIENT_CHECK_ERRORS):
+                if responses is None:
+                    poll_outcomes.inc(outcome='unchecked')
+                elif isinstance(responses, (Timeout, ConnectionFailed)):
+                    poll_outcomes.inc(outcome='timeout')
+                elif isinstance(responses, (RateLimited, CircuitOpen)):
+                    poll_outcomes.inc(outcome='throttled')
+                else:
+                    poll_outcomes.inc(outcome='unavailable')
+                new_info['external_ids'].append(res)
+                continue
+            if isinstance(responses, Exception):
+                # the submission can not be checked, as an unknown one, the rest of documents are still checked
+                poll_outcomes.inc(outcome='failed')
+                if 'cache_key' in res:
+                    self._get_submission_cache().delete(res['cache_key'])
+                new_info['processed_external_ids']['errors'].append(self._get_error(
+                    message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value, res['filename'],
+                    urkund_message=repr(responses)))
+                continue
+
+            for response in responses:
+                poll_outcomes.inc(outcome=response['Status']['State'])
+                if response['Status']['State'] == 'Analyzed':
+                    # return response OK
+                    scheduler.add_analyzed(res)
+                    if 'submitted_at' in res:
+                        analysis_seconds.observe(time.time() - res['submitted_at'])
+                    report = self._get_report(response)
+                    new_info['processed_external_ids']['corrects'].append(self._get_correct(res, report))
+                    if 'cache_key' in res:
+                        self._get_submission_cache().set(res['cache_key'], {
                             "external_id": res['external_id'],
                             "analysis_email": res['analysis_email'],
-                            "filename": res['filename'],
-                            "report_url": response['Report']['ReportUrl'],
-                            "significance": response['Report']['Significance'],
-                            "match_count": response['Report']['MatchCount'],
-                            "source_count": response['Report']['SourceCount'],
-                            "warnings": response['Report']['Warnings']
-                        }
-                        new_info['processed_external_ids']['corrects'].append(aux)
-
-                    elif response['Status']['State'] == 'Error':
-                        # return response KO
-                        urkund_code = self._get_urkund_lib().submissions. \
-                            get_message_from_submission_error(response['Status']['ErrorCode'])
-
-                        aux = {
-                            "code": message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
-                            "filename": res['filename'],
-                            "urkund_code": urkund_code,
-                            "urkund_message": response['Status']['Message']
-                        }
-
-                        new_info['processed_external_ids']['errors'].append(aux)
-                    else:
-                        # put in next check
-                        new_info['external_ids'].append(res)
-
-            # decide if all requests are processed
-            num_errors = len(new_info['processed_external_ids']['errors'])
-            num_corrects = len(new_info['processed_external_ids']['corrects'])
-            total_processed = num_errors + num_corrects
-
-            if info['total_files'] == total_processed:
-                # we can return result from this request
-                if num_errors < num_corrects:
-                    code_alert = result.VerificationResult.AlertCode.OK
+                            "report": report
+                        })
+
+                elif response['Status']['State'] == 'Error':
+                    # return response KO
+                    if 'cache_key' in res:
+                        self._get_submission_cache().delete(res['cache_key'])
+                    urkund_code = self._get_urkund_lib().submissions. \
+                        get_message_from_submission_error(response['Status']['ErrorCode'])
+
+                    aux = {
+                        "code": message.provider.Provider.PROVIDER_INVALID_SAMPLE_DATA.value,
+                        "filename": res['filename'],
+                        "urkund_code": urkund_code,
+                        "urkund_message": response['Status']['Message']
+                    }
+
+                    new_info['processed_external_ids']['errors'].append(aux)
                 else:
-                    code_alert = result.VerificationResult.AlertCode.WARNING
-
-                audit = PlagiarismAudit(documents=new_info['processed_external_ids'],
-                                        total_documents=num_errors+num_corrects,
-                                        total_documents_accepted=num_corrects,
-                                        total_documents_rejected=num_errors)
-                max_significance = 0
-
-                for correct in new_info['processed_external_ids']['corrects']:
-                    if (correct["significance"] / 100) > max_significance:
-                        max_significance = correct["significance"] / 100
-
-                    audit.add_comparison(comparison_id=correct['external_id'], result=correct['significance'],
-                                         extra_info=correct)
-
-                result_obj = result.VerificationResult(True, code=code_alert, audit=audit, result=max_significance)
-                verif_delayed_result = result.VerificationDelayedResult(learner_id=info['learner_id'],
-                                                                        request_id=info['request_id'],
-                                                                        result=result_obj, info=None)
-                self.update_delayed_result(verif_delayed_result)
-            else:
-                # create new notification
-                key = "tukrund_check_data_{}".format(uuid.uuid4())
-                notification = result.NotificationTask(key, countdown=info['countdown']*60, info=info)
-                self.update_or_create_notification(notification)
+                    # put in next check
+                    res['state'] = response['Status']['State']
+                    new_info['external_ids'].append(res)
+
+        # decide if all requests are processed
+        num_errors = len(new_info['processed_external_ids']['errors'])
+        num_corrects = len(new_info['processed_external_ids']['corrects'])
+        total_processed = num_errors + num_corrects
+
+        if total_processed >= info['total_files']:
+            # we can return result from this request
+            result_obj = self._get_verification_result(new_info['processed_external_ids'])
+            verif_delayed_result = result.VerificationDelayedResult(learner_id=info['learner_id'],
+                                                                    request_id=info['request_id'],
+                                                                    result=result_obj, info=None)
+            self.update_delayed_result(verif_delayed_result)
+        else:
+            self._reschedule_check(new_info)
+
+    def _reschedule_check(self, info):
+        """
+            Schedule a new check of the pending documents of a request. Once the checks run out, the pending
+            documents are reported as timed out and the verification result is sent.
+            :param info: Request information, with the number of checks already done
+            :type info: dict
+        """
+        info['poll_attempt'] = info.get('poll_attempt', 0) + 1
+        if info['poll_attempt'] < self.config['max_poll_attempts']:
+            self._create_check_notification(info)
+            return
+
+        for res in info['external_ids']:
+            if 'cache_key' in res:
+                self._get_submission_cache().delete(res['cache_key'])
+            info['processed_external_ids']['errors'].append(self._get_error(
+                message.provider.Provider.PROVIDER_EXTERNAL_SERVICE_TIMEOUT.value, res['filename']))
+        info['external_ids'] = []
+
+        result_obj = self._get_verification_result(info['processed_external_ids'])
+        self.update_delayed_result(result.VerificationDelayedResult(learner_id=info['learner_id'],
+                                                                    request_id=info['request_id'],
+                                                                    result=result_obj, info=None))
+
+    def _get_verification_result(self, processed_external_ids):
+        """
+            Build the verification result of a request once all its documents are processed
+            :param processed_external_ids: Corrects and errors of the request documents
+            :type processed_external_ids: dict
+            :return: Verification result
+            :rtype: result.VerificationResult
+        """
+        num_errors = len(processed_external_ids['errors'])
+        num_corrects = len(processed_external_ids['corrects'])
+
+        if num_errors < num_corrects:
+            code_alert = result.VerificationResult.AlertCode.OK
+        else:
+            code_alert = result.VerificationResult.AlertCode.WARNING
+
+        audit = PlagiarismAudit(documents=processed_external_ids,
+                                total_documents=num_errors+num_corrects,
+                                total_documents_accepted=num_corrects,
+                                total_documents_rejected=num_errors)
+        max_significance = 0
+
+        for correct in processed_external_ids['corrects']:
+            if (correct["significance"] / 100) > max_significance:
+                max_significance = correct["significance"] / 100
+
+            audit.add_comparison(comparison_id=correct['external_id'], result=correct['significance'],
+                                 extra_info=correct)
+
+        return result.VerificationResult(True, code=code_alert, audit=audit, result=max_significance)
+
+    @staticmethod
+    def _get_report(response):
+        """
+            Get the report values of an analyzed submission
+            :param response: Urkund submission
+            :type response: dict
+            :return: Report values
+            :rtype: dict
+        """
+        return {
+            "report_url": response['Report']['ReportUrl'],
+            "significance": response['Report']['Significance'],
+            "match_count": response['Report']['MatchCount'],
+            "source_count": response['Report']['SourceCount'],
+            "warnings": response['Report']['Warnings']
+        }
+
+    @staticmethod
+    def _get_correct(res, report):
+        """
+            Get the processed information of an analyzed document
+            :param res: Sent document
+            :type res: dict
+            :param report: Report values
+            :type report: dict
+            :return: Processed document
+            :rtype: dict
+        """
+        correct = {
+            "external_id": res['external_id'],
+            "analysis_email": res['analysis_email'],
+            "filename": res['filename']
+        }
+        correct.update(report)
+
+        return correct
+
+    def _get_pending_index(self):
+        """
+            Return the index of the requests waiting for an aggregated result check
+            :return: Pending index
+            :rtype: aggregation.BasePendingIndex
+        """
+        return get_pending_index(backend=self.config['poll_aggregation_backend'])
+
+    def _get_submission_cache(self):
+        """
+            Return the submissions cache used to deduplicate documents between requests
+            :return: Submissions cache
+            :rtype: cache.BaseSubmissionCache
+        """
+        return get_submission_cache(backend=self.config['deduplication_cache_backend'],
+                                    max_size=self.config['deduplication_cache_size'])
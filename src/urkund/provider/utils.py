@@ -14,12 +14,23 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE Urkund Plagiarism utility module """
 import base64
+import bz2
+import concurrent.futures
+import gzip
+import io
 import json
+import lzma
+import multiprocessing
 import os
+import tarfile
 import tempfile
+import threading
+import time
 import shutil
-import magic
+import zipfile
 from tesla_ce_provider import message
+from ..urkund_lib import metrics
+from . import detection
 
 
 FILENAME_CONTENT = 'content.txt'
@@ -28,6 +39,15 @@ TYPE_ASSIGN_ONLINE = 'assign_online'
 TYPE_QUIZ_ATTEMPT = 'quiz_attempt'
 TYPE_FORUM_POST = 'forum_post'
 
+# compressed formats read as a stream, either tar archives or a single compressed file
+STREAM_DECOMPRESSORS = {
+    'application/x-tar': None,
+    'application/gzip': gzip.open,
+    'application/x-bzip2': bz2.open,
+    'application/x-xz': lzma.open,
+    'application/x-lzma': lzma.open
+}
+
 
 def get_decompress_files(sample_data, filename):
     """
@@ -38,25 +58,266 @@ def get_decompress_files(sample_data, filename):
     """
     # decompress files
     file_p = tempfile.NamedTemporaryFile()
-    file_p.write(sample_data)
+    if hasattr(sample_data, 'read'):
+        sample_data.seek(0)
+        shutil.copyfileobj(sample_data, file_p)
+    else:
+        file_p.write(sample_data)
     file_p.seek(0)
 
     tmp_filename = file_p.name
     extract_directory = tempfile.TemporaryDirectory()
     # read data from file
     extension = filename.split('.')[-1]
-    shutil.unpack_archive(tmp_filename, extract_directory.name, extension)
+    with metrics.span('unpack_archive', extension):
+        shutil.unpack_archive(tmp_filename, extract_directory.name, extension)
 
     return [os.listdir(extract_directory.name), extract_directory]
 
 
-def get_sample_tree_files(sample_data, context, mimetype, filename, level, max_recursive_level, compressed_mimetypes,
-                          accepted_mimetypes_provider, files_structure=None):
+def get_mimetype(content):
     """
-        Get tree files from sample
+    Get the mimetype of a file from its first bytes
+    :param content: File content or file handle
+    :type content: bytes | file
+    :return: Mimetype
+    :rtype: str
+    """
+    with metrics.span('mimetype'):
+        return detection.detect_mimetype(content)
+
+
+def _read_member(member, size, stream_threshold=None):
+    """
+    Read an archive member. Members larger than the stream threshold are copied in chunks to a temporary file.
+    :param member: Member stream
+    :param size: Uncompressed size of the member, None if unknown
+    :param stream_threshold: Maximum size in bytes of the members loaded in memory
+    :return: Member content or file handle
+    """
+    if stream_threshold is None:
+        return member.read()
+
+    if size is None:
+        content = member.read(stream_threshold + 1)
+        if len(content) <= stream_threshold:
+            return content
+        file_handle = tempfile.TemporaryFile()
+        file_handle.write(content)
+        del content
+    elif size <= stream_threshold:
+        return member.read()
+    else:
+        file_handle = tempfile.TemporaryFile()
+
+    shutil.copyfileobj(member, file_handle)
+    file_handle.seek(0)
+
+    return file_handle
+
+
+def iter_archive_members(sample_data, mimetype, filename, stream_threshold=None):
+    """
+    Iterate over the files of a compressed sample without writing it to disk. Zip, tar and single file gzip, bzip2
+    and xz samples are read from memory, other formats are extracted to a temporary directory.
+
+    :param sample_data: Raw sample data or file handle
+    :type sample_data: bytes | file
+    :param mimetype: Mimetype of sample data
+    :type mimetype: str
+    :param filename: Filename of sample data
+    :type filename: str
+    :param stream_threshold: Maximum size in bytes of the members loaded in memory
+    :type stream_threshold: int
+    :return: Generator of member name and content
+    :rtype: generator
+    """
+    if hasattr(sample_data, 'read'):
+        file_p = sample_data
+        file_p.seek(0)
+    else:
+        file_p = io.BytesIO(sample_data)
+
+    if mimetype == 'application/zip':
+        with zipfile.ZipFile(file_p) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with metrics.span('extract', mimetype), archive.open(info) as member:
+                    content = _read_member(member, info.file_size, stream_threshold)
+                yield info.filename, content
+
+    elif mimetype in STREAM_DECOMPRESSORS:
+        try:
+            archive = tarfile.open(fileobj=file_p, mode='r:*')
+        except tarfile.ReadError:
+            if STREAM_DECOMPRESSORS[mimetype] is None:
+                raise
+            archive = None
+
+        if archive is not None:
+            with archive:
+                for info in archive:
+                    if not info.isfile():
+                        continue
+                    with metrics.span('extract', mimetype), archive.extractfile(info) as member:
+                        content = _read_member(member, info.size, stream_threshold)
+                    yield info.name, content
+        else:
+            # single compressed file
+            file_p.seek(0)
+            name = os.path.basename(filename)
+            if '.' in name:
+                name = name[:name.rindex('.')]
+            with metrics.span('extract', mimetype), STREAM_DECOMPRESSORS[mimetype](file_p) as member:
+                content = _read_member(member, None, stream_threshold)
+            yield name, content
+
+    else:
+        [_, extract_directory] = get_decompress_files(sample_data, filename)
+        with extract_directory:
+            for root, _, files in os.walk(extract_directory.name):
+                for member_name in sorted(files):
+                    member_filename = os.path.join(root, member_name)
+                    yield os.path.relpath(member_filename, extract_directory.name), \
+                        read_extracted_file(member_filename, stream_threshold)
+
+
+def iter_checked_archive_members(sample_data, mimetype, filename, stream_threshold=None):
+    """
+    Iterate over the files of a compressed sample, see iter_archive_members. An error reading the archive ends the
+    iteration instead of being raised, and is returned as a last member without name.
+
+    :param sample_data: Raw sample data or file handle
+    :type sample_data: bytes | file
+    :param mimetype: Mimetype of sample data
+    :type mimetype: str
+    :param filename: Filename of sample data
+    :type filename: str
+    :param stream_threshold: Maximum size in bytes of the members loaded in memory
+    :type stream_threshold: int
+    :return: Generator of member name and content, or None and the extraction error
+    :rtype: generator
+    """
+    members = iter_archive_members(sample_data, mimetype, filename, stream_threshold)
+    while True:
+        try:
+            member = next(members)
+        except StopIteration:
+            return
+        except Exception as error:
+            # corrupt, truncated or unsupported archives
+            yield None, error
+            return
+        yield member
+
+
+def get_extraction_error_file(filename, mimetype, error):
+    """
+    Get the rejected tree file of an archive which could not be extracted, or of a file which could not be read
+    :param filename: Filename of the archive or file
+    :type filename: str
+    :param mimetype: Mimetype of the archive or file, if known
+    :type mimetype: str
+    :param error: Extraction error
+    :type error: Exception
+    :return: Tree file
+    :rtype: dict
+    """
+    return {
+        "filename": filename,
+        "mimetype": mimetype,
+        "status": "REJECTED",
+        "error": "EXTRACTION_ERROR",
+        "message": repr(error),
+        "content": None
+    }
+
+
+def read_extracted_file(filename, stream_threshold=None):
+    """
+    Read an extracted file. Files larger than the stream threshold are not loaded, an open file handle is returned
+    instead so they can be uploaded in chunks. The handle keeps the file readable once its directory is removed.
+    :param filename: Path of the extracted file
+    :type filename: str
+    :param stream_threshold: Maximum size in bytes of the files loaded in memory
+    :type stream_threshold: int
+    :return: File content or file handle
+    :rtype: bytes | file
+    """
+    if stream_threshold is not None and os.path.getsize(filename) > stream_threshold:
+        return open(filename, mode='rb')
+
+    with open(filename, mode='rb') as file:
+        return file.read()
+
+
+def get_content_size(content):
+    """
+    Get the size of a tree file content
+    :param content: File content or file handle
+    :type content: bytes | file
+    :return: Size in bytes
+    :rtype: int
+    """
+    if hasattr(content, 'read'):
+        return os.fstat(content.fileno()).st_size
+
+    return len(content)
+
 
-        :param sample_data: Raw sample data
-        :type sample_data: bytes
+def close_tree_file(t_file):
+    """
+    Close the file handle of a tree file and release its content
+    :param t_file: Tree file
+    :type t_file: dict
+    """
+    if hasattr(t_file['content'], 'close'):
+        t_file['content'].close()
+    t_file['content'] = None
+
+
+def get_content_tree_file(context, content):
+    """
+        Get the tree file with the text of the content file of a special context sample
+        :param context: Context of sample data
+        :type context: dict
+        :param content: Content file data or file handle
+        :type content: bytes | file
+        :return: Tree file
+        :rtype: dict
+    """
+    # process as quiz_attempt, only process open_text responses
+    content_raw_text = ''
+    if hasattr(content, 'read'):
+        content = content.read()
+    content = json.loads(content)
+
+    if context.get('type') == TYPE_ASSIGN_ONLINE or TYPE_ASSIGN:
+        content_raw_text = content.get('online_text')
+    elif content.get('type') == TYPE_FORUM_POST:
+        content_raw_text = content.get('message')
+    elif content.get('type') == TYPE_QUIZ_ATTEMPT:
+        for attempt in content:
+            if attempt.get('open_text') is True:
+                content_raw_text += attempt.get('answer')+'\n\r'
+
+    return {
+        "filename": context.get('type')+'.txt',
+        "mimetype": 'text/plain',
+        "status": "ACCEPTED",
+        "content": content_raw_text.encode('utf-8')
+    }
+
+
+def iter_sample_tree_files(sample_data, context, mimetype, filename, level, max_recursive_level,
+                           compressed_mimetypes, accepted_mimetypes_provider, stream_threshold=None, executor=None):
+    """
+        Iterate over the tree files of a sample. Files are yielded as soon as they are extracted, so archives are
+        never fully loaded in memory.
+
+        :param sample_data: Raw sample data or file handle
+        :type sample_data: bytes | file
         :param context: Context of sample data
         :type context: dict
         :param mimetype: Mimetype of sample data
@@ -71,125 +332,329 @@ def get_sample_tree_files(sample_data, context, mimetype, filename, level, max_r
         :type compressed_mimetypes: list
         :param accepted_mimetypes_provider: Accepted provider mimetypes
         :type accepted_mimetypes_provider: list
-        :param files_structure: Files return structure
-        :type files_structure: list
-        :return: files_structure
-        :rtype: list
+        :param stream_threshold: Maximum size in bytes of the extracted files loaded in memory
+        :type stream_threshold: int
+        :param executor: Process pool extracting the archives in parallel, see iter_parallel_tree_files
+        :type executor: concurrent.futures.ProcessPoolExecutor
+        :return: Generator of tree files
+        :rtype: generator
     """
-    if not files_structure:
-        files_structure = []
-
     if level >= max_recursive_level:
-        files_structure.append({
+        yield {
             "filename": filename,
             "mimetype": mimetype,
             "status": "REJECTED",
             "error": "MAX_RECURSIVE_LEVEL",
             "content": sample_data
-        })
-        return files_structure
+        }
+        return
 
     # check if context gets how to process this sample
     special_context_types = [TYPE_QUIZ_ATTEMPT, TYPE_FORUM_POST, TYPE_ASSIGN, TYPE_ASSIGN_ONLINE]
     if level == 0 and context.get('type') in special_context_types:
-        [decompress_files, extract_directory] = get_decompress_files(sample_data, filename)
-
-        # process as quiz_attempt, only process open_text responses
-        content_raw_text = ''
-
-        if os.path.isfile(extract_directory.name+os.path.sep+FILENAME_CONTENT):
-            f = open (extract_directory.name+os.path.sep+FILENAME_CONTENT, "r")
-            content = json.loads(f.read())
-
-            if context.get('type') == TYPE_ASSIGN_ONLINE or TYPE_ASSIGN:
-                content_raw_text = content.get('online_text')
-            elif content.get('type') == TYPE_FORUM_POST:
-                content_raw_text = content.get('message')
-            elif content.get('type') == TYPE_QUIZ_ATTEMPT:
-                for attempt in content:
-                    if attempt.get('open_text') is True:
-                        content_raw_text += attempt.get('answer')+'\n\r'
-
-            files_structure.append({
-                "filename": context.get('type')+'.txt',
-                "mimetype": 'text/plain',
-                "status": "ACCEPTED",
-                "content": content_raw_text.encode('utf-8')
-            })
+        for member_name, new_sample_data in iter_checked_archive_members(sample_data, mimetype, filename,
+                                                                         stream_threshold):
+            if member_name is None:
+                # files extracted before the error are kept
+                yield get_extraction_error_file(filename, mimetype, new_sample_data)
+                continue
+            new_filename = os.path.join(filename, member_name)
+            try:
+                if member_name == FILENAME_CONTENT:
+                    t_file = get_content_tree_file(context, new_sample_data)
+                else:
+                    # sample attachments
+                    new_mimetype = get_mimetype(new_sample_data)
+            except Exception as error:
+                # a malformed file only rejects itself, the rest of the sample is still processed
+                yield get_extraction_error_file(new_filename, None, error)
+                continue
 
-        # check if sample has attachments
-        for decompress_file in decompress_files:
-            # skip content.txt file
-            if decompress_file == FILENAME_CONTENT:
+            if member_name == FILENAME_CONTENT:
+                yield t_file
                 continue
 
-            new_filename = extract_directory.name+os.path.sep+decompress_file
-            new_sample_data = None
-            new_mimetype = 'directory'
-            if os.path.isfile(new_filename):
-                with open(new_filename, mode='rb') as file:
-                    new_sample_data = base64.b64encode(file.read())
-
-                new_mimetype = magic.from_file(new_filename, mime=True)
-
-            files_structure = get_sample_tree_files(new_sample_data, context, new_mimetype, new_filename, level+1,
-                                                    max_recursive_level, compressed_mimetypes,
-                                                    accepted_mimetypes_provider, files_structure)
-    elif mimetype == 'directory':
-        for subitem in os.listdir(filename):
-            new_filename = filename+os.path.sep+subitem
-            new_sample_data = None
-            new_mimetype = 'directory'
-            if os.path.isfile(new_filename):
-                with open(new_filename, mode='rb') as file:
-                    new_sample_data = base64.b64encode(file.read())
-
-                new_mimetype = magic.from_file(new_filename, mime=True)
-
-            files_structure = get_sample_tree_files(new_sample_data, context, new_mimetype, new_filename, level+1,
-                                                    max_recursive_level, compressed_mimetypes,
-                                                    accepted_mimetypes_provider, files_structure)
+            yield from iter_sample_tree_files(new_sample_data, context, new_mimetype, new_filename, level+1,
+                                              max_recursive_level, compressed_mimetypes, accepted_mimetypes_provider,
+                                              stream_threshold)
+
+    elif mimetype in compressed_mimetypes and executor is not None:
+        yield from iter_parallel_tree_files(executor, sample_data, mimetype, filename, level, max_recursive_level,
+                                            compressed_mimetypes, accepted_mimetypes_provider, stream_threshold)
 
     elif mimetype in compressed_mimetypes:
         # check if file is compress file
-        [decompress_files, extract_directory] = get_decompress_files(sample_data, filename)
-
-        for decompress_file in decompress_files:
-            new_filename = extract_directory.name+os.path.sep+decompress_file
-            new_sample_data = None
-            new_mimetype = 'directory'
-            if os.path.isfile(new_filename):
-                with open(new_filename, mode='rb') as file:
-                    new_sample_data = base64.b64encode(file.read())
-
-                new_mimetype = magic.from_file(new_filename, mime=True)
-
-            files_structure = get_sample_tree_files(new_sample_data, context, new_mimetype, new_filename, level+1,
-                                                    max_recursive_level, compressed_mimetypes,
-                                                    accepted_mimetypes_provider, files_structure)
+        for member_name, new_sample_data in iter_checked_archive_members(sample_data, mimetype, filename,
+                                                                         stream_threshold):
+            if member_name is None:
+                # files extracted before the error are kept
+                yield get_extraction_error_file(filename, mimetype, new_sample_data)
+                continue
+            new_filename = os.path.join(filename, member_name)
+            try:
+                new_mimetype = get_mimetype(new_sample_data)
+            except Exception as error:
+                yield get_extraction_error_file(new_filename, None, error)
+                continue
+            yield from iter_sample_tree_files(new_sample_data, context, new_mimetype, new_filename, level+1,
+                                              max_recursive_level, compressed_mimetypes, accepted_mimetypes_provider,
+                                              stream_threshold)
 
     elif mimetype in accepted_mimetypes_provider:
         # append file directly
-        files_structure.append({
+        yield {
             "filename": filename,
             "mimetype": mimetype,
             "status": "ACCEPTED",
             "content": sample_data
-        })
+        }
     else:
         # TODO: try extract text
-        files_structure.append({
+        yield {
             "filename": filename,
             "mimetype": mimetype,
             "status": "REJECTED",
             "content": sample_data
-        })
+        }
+
+
+_extraction_pools = {}
+_extraction_pools_lock = threading.Lock()
+
+
+def get_extraction_pool(processes):
+    """
+    Get the process wide pool extracting archives in parallel. Processes are forked, so they do not load the TeSLA
+    CE client again. Daemon processes, as the children of a prefork Celery worker, can not create the pool.
+    :param processes: Number of extraction processes
+    :type processes: int
+    :return: Process pool
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    with _extraction_pools_lock:
+        if processes not in _extraction_pools:
+            context = None
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            _extraction_pools[processes] = concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                                                  mp_context=context)
+
+        return _extraction_pools[processes]
+
+
+def shutdown_extraction_pools():
+    """
+    Stop the extraction processes
+    """
+    with _extraction_pools_lock:
+        for pool in _extraction_pools.values():
+            pool.shutdown()
+        _extraction_pools.clear()
+
+
+def extract_archive_members(path, mimetype, filename, directory, stream_threshold=None):
+    """
+    Extract the files of an archive to a directory and detect their mimetype. Run by the extraction processes, which
+    return descriptors of the extracted files instead of their content.
+    :param path: Path of the archive
+    :type path: str
+    :param mimetype: Mimetype of the archive
+    :type mimetype: str
+    :param filename: Filename of the archive in the sample
+    :type filename: str
+    :param directory: Directory the files are extracted to
+    :type directory: str
+    :param stream_threshold: Maximum size in bytes of the files loaded in memory while they are extracted
+    :type stream_threshold: int
+    :return: List of dicts with the name of the file in the archive, its path, size and mimetype
+    :rtype: list
+    """
+    members = []
+    with open(path, mode='rb') as archive:
+        for member_name, content in iter_archive_members(archive, mimetype, filename, stream_threshold):
+            member_mimetype = get_mimetype(content)
+            descriptor, member_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(descriptor, mode='wb') as member_file:
+                if hasattr(content, 'read'):
+                    shutil.copyfileobj(content, member_file)
+                    content.close()
+                else:
+                    member_file.write(content)
+            members.append({
+                "name": member_name,
+                "path": member_path,
+                "size": os.path.getsize(member_path),
+                "mimetype": member_mimetype
+            })
+
+    return members
+
+
+def iter_parallel_tree_files(executor, sample_data, mimetype, filename, level, max_recursive_level,
+                             compressed_mimetypes, accepted_mimetypes_provider, stream_threshold=None):
+    """
+        Iterate over the tree files of a compressed sample, extracting sibling archives in parallel in a process
+        pool. Extracted files are written to a temporary directory, removed once the iteration ends, and tree files
+        are yielded in the same order as iter_sample_tree_files does.
+
+        :param executor: Process pool extracting the archives
+        :type executor: concurrent.futures.ProcessPoolExecutor
+        :param sample_data: Raw sample data or file handle
+        :type sample_data: bytes | file
+        :param mimetype: Mimetype of sample data
+        :type mimetype: str
+        :param filename: Filename of sample data
+        :type filename: str
+        :param level: Which level are actually analyzing inside file.
+        :type level: int
+        :param max_recursive_level: Max recursive level accepted
+        :type max_recursive_level: int
+        :param compressed_mimetypes: Accepted compressed mimetype values
+        :type compressed_mimetypes: list
+        :param accepted_mimetypes_provider: Accepted provider mimetypes
+        :type accepted_mimetypes_provider: list
+        :param stream_threshold: Maximum size in bytes of the extracted files loaded in memory
+        :type stream_threshold: int
+        :return: Generator of tree files
+        :rtype: generator
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        descriptor, path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(descriptor, mode='wb') as archive:
+            if hasattr(sample_data, 'read'):
+                sample_data.seek(0)
+                shutil.copyfileobj(sample_data, archive)
+            else:
+                archive.write(sample_data)
+
+        future = executor.submit(extract_archive_members, path, mimetype, filename, directory, stream_threshold)
+        yield from _iter_extracted_tree_files(executor, future, mimetype, directory, filename, level,
+                                              max_recursive_level, compressed_mimetypes, accepted_mimetypes_provider,
+                                              stream_threshold)
+
+
+def _iter_extracted_tree_files(executor, future, mimetype, directory, filename, level, max_recursive_level,
+                               compressed_mimetypes, accepted_mimetypes_provider, stream_threshold):
+    """
+        Iterate over the tree files of an archive being extracted by the process pool
+        :param future: Future of the extract_archive_members call of the archive
+        :type future: concurrent.futures.Future
+        :return: Generator of tree files
+        :rtype: generator
+    """
+    try:
+        with metrics.span('parallel_extract', mimetype):
+            members = future.result()
+    except Exception as error:
+        yield get_extraction_error_file(filename, mimetype, error)
+        return
+
+    # nested archives are submitted at once, they are extracted while the files before them are processed
+    futures = {}
+    if level + 1 < max_recursive_level:
+        for member in members:
+            if member['mimetype'] in compressed_mimetypes:
+                futures[member['path']] = executor.submit(extract_archive_members, member['path'],
+                                                          member['mimetype'], os.path.join(filename, member['name']),
+                                                          directory, stream_threshold)
+
+    try:
+        for member in members:
+            member_filename = os.path.join(filename, member['name'])
+            if member['path'] in futures:
+                yield from _iter_extracted_tree_files(executor, futures[member['path']], member['mimetype'],
+                                                      directory, member_filename, level+1, max_recursive_level,
+                                                      compressed_mimetypes, accepted_mimetypes_provider,
+                                                      stream_threshold)
+                continue
+
+            try:
+                member_data = read_extracted_file(member['path'], stream_threshold)
+            except Exception as error:
+                yield get_extraction_error_file(member_filename, member['mimetype'], error)
+                continue
+
+            yield from iter_sample_tree_files(member_data, {}, member['mimetype'], member_filename, level+1,
+                                              max_recursive_level, compressed_mimetypes, accepted_mimetypes_provider,
+                                              stream_threshold)
+    finally:
+        # an iteration stopped early waits for the running extractions before the directory is removed
+        for nested_future in futures.values():
+            nested_future.cancel()
+        concurrent.futures.wait(futures.values())
+
+
+def get_sample_tree_files(sample_data, context, mimetype, filename, level, max_recursive_level, compressed_mimetypes,
+                          accepted_mimetypes_provider, files_structure=None, stream_threshold=None, executor=None):
+    """
+        Get tree files from sample
+
+        :param sample_data: Raw sample data or file handle
+        :type sample_data: bytes | file
+        :param context: Context of sample data
+        :type context: dict
+        :param mimetype: Mimetype of sample data
+        :type mimetype: str
+        :param filename: Filename of sample data
+        :type filename: str
+        :param level: Which level are actually analyzing inside file.
+        :type level: int
+        :param max_recursive_level: Max recursive level accepted
+        :type max_recursive_level: int
+        :param compressed_mimetypes: Accepted compressed mimetype values
+        :type compressed_mimetypes: list
+        :param accepted_mimetypes_provider: Accepted provider mimetypes
+        :type accepted_mimetypes_provider: list
+        :param files_structure: Files return structure
+        :type files_structure: list
+        :param stream_threshold: Maximum size in bytes of the extracted files loaded in memory
+        :type stream_threshold: int
+        :param executor: Process pool extracting the archives in parallel, see iter_parallel_tree_files
+        :type executor: concurrent.futures.ProcessPoolExecutor
+        :return: files_structure
+        :rtype: list
+    """
+    if not files_structure:
+        files_structure = []
+
+    with metrics.span('tree_files'):
+        files_structure.extend(iter_sample_tree_files(sample_data, context, mimetype, filename, level,
+                                                      max_recursive_level, compressed_mimetypes,
+                                                      accepted_mimetypes_provider, stream_threshold, executor))
 
     return files_structure
 
 
+def iter_measured_tree_files(tree_files):
+    """
+        Measure a lazy files tree as the tree_files span. Only the time spent extracting the files is counted, not
+        the time the caller spends on each of them before asking for the next one.
+
+        :param tree_files: Tree files generator, see iter_sample_tree_files
+        :type tree_files: generator
+        :return: The same tree files
+        :rtype: generator
+    """
+    elapsed = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                t_file = next(tree_files)
+            except StopIteration:
+                return
+            except Exception as exception:
+                metrics.span_errors.inc(span='tree_files', detail='', exception=type(exception).__name__)
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            yield t_file
+    finally:
+        metrics.span_seconds.observe_labels(elapsed, ('tree_files', ''))
+
+
 def check_sample_file(sample, max_recursive_level, accepted_mimetypes=None, compressed_mimetypes=None,
-                      accepted_mimetypes_provider=None):
+                      accepted_mimetypes_provider=None, stream_threshold=None, lazy=False, executor=None):
     """
         Check sample information
         :param sample: Sample structure
@@ -202,6 +667,12 @@ def check_sample_file(sample, max_recursive_level, accepted_mimetypes=None, comp
         :type compressed_mimetypes: list
         :param accepted_mimetypes_provider: Accepted provider mimetypes
         :type accepted_mimetypes_provider: list
+        :param stream_threshold: Maximum size in bytes of the extracted files loaded in memory
+        :type stream_threshold: int
+        :param lazy: Return the tree files as a generator instead of a list
+        :type lazy: bool
+        :param executor: Process pool extracting the archives in parallel, see iter_parallel_tree_files
+        :type executor: concurrent.futures.ProcessPoolExecutor
         :return: An object with the image and mimetype or the found errors
         :rtype: dict
     """
@@ -209,9 +680,10 @@ def check_sample_file(sample, max_recursive_level, accepted_mimetypes=None, comp
     mimetype = None
     sample_mimetype = None
 
+    # only the header is split, sample data can be large
     try:
-        sample_mimetype = sample.data.split(',')[0].split(';')[0].split(':')[1]
-    except IndexError:
+        sample_mimetype = sample.data[:sample.data.find(',')].split(';')[0].split(':')[1]
+    except (AttributeError, IndexError):
         return {
             'valid': False,
             'msg': "Mimetype is not in sample base64 data",
@@ -238,9 +710,8 @@ def check_sample_file(sample, max_recursive_level, accepted_mimetypes=None, comp
         }
 
     # Open file
-    try:
-        data = sample.data.split(',')[1]
-    except (AttributeError, IndexError):
+    data_start = sample.data.find(',')
+    if data_start < 0:
         return {
             'valid': False,
             'msg': "Invalid format sample data.",
@@ -250,10 +721,19 @@ def check_sample_file(sample, max_recursive_level, accepted_mimetypes=None, comp
 
     tree_files = None
     try:
-        sample_data = base64.b64decode(data)
+        # sample data is decoded only once, the tree files carry raw bytes
+        with metrics.span('decode'):
+            sample_data = base64.b64decode(sample.data[data_start+1:])
         filename = sample.metadata['filename']
-        tree_files = get_sample_tree_files(sample_data, sample.context, mimetype, filename, 0, max_recursive_level,
-                                           compressed_mimetypes, accepted_mimetypes_provider)
+        if lazy:
+            tree_files = iter_measured_tree_files(iter_sample_tree_files(
+                sample_data, sample.context, mimetype, filename, 0, max_recursive_level, compressed_mimetypes,
+                accepted_mimetypes_provider, stream_threshold=stream_threshold, executor=executor))
+        else:
+            tree_files = get_sample_tree_files(sample_data, sample.context, mimetype, filename, 0,
+                                               max_recursive_level, compressed_mimetypes,
+                                               accepted_mimetypes_provider, stream_threshold=stream_threshold,
+                                               executor=executor)
 
     except base64.binascii.Error:
         return {
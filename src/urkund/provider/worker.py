@@ -0,0 +1,241 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Urkund worker warm up, health and metrics exporters module """
+import os
+import threading
+import time
+
+from celery.signals import worker_process_init, worker_ready, worker_shutdown
+from celery.worker.control import inspect_command
+
+from . import detection
+from . import utils
+from .aggregation import get_pending_index, get_worker_id
+from .cache import get_submission_cache
+from ..urkund_lib import metrics
+from ..urkund_lib.cache import metadata_cache
+
+_provider = None
+_provider_lock = threading.Lock()
+_warm_up_done = False
+_metrics_server = None
+_metrics_pusher = None
+
+DEFAULT_METRICS_JOB = 'tesla_ce_provider_pt_urkund'
+DEFAULT_METRICS_PUSH_INTERVAL = 15
+
+
+def get_provider():
+    """
+    Get the provider instance of the worker process. It is the provider of the verification tasks, with the
+    credentials and options they set from the TeSLA CE client.
+    :return: Provider instance
+    :rtype: UrkundProvider
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            from tesla_ce_provider.tasks import VerificationTask
+            _provider = VerificationTask.provider
+
+        return _provider
+
+
+def warm_up(provider=None):
+    """
+    Load the mimetype database, validate the Urkund unit and open the first connection to Urkund, so the first
+    task of the worker does not pay for them
+    :param provider: Provider instance. The provider of the worker process is used if not provided.
+    :type provider: UrkundProvider
+    :return: Seconds spent in every step, and the error if the warm up failed
+    :rtype: dict
+    """
+    global _warm_up_done
+    timings = {}
+
+    start = time.monotonic()
+    detection.preload()
+    timings['mimetype'] = time.monotonic() - start
+
+    try:
+        start = time.monotonic()
+        if provider is None:
+            provider = get_provider()
+        urkund_lib = provider._get_urkund_lib()
+        timings['urkund_lib'] = time.monotonic() - start
+
+        start = time.monotonic()
+        urkund_lib.receivers.get_by_email(provider.credentials['URKUND_DEFAULT_EMAIL_RECEIVER'])
+        timings['receiver'] = time.monotonic() - start
+    except Exception as exception:
+        # the worker starts anyway, the tasks will report the error
+        timings['error'] = repr(exception)
+
+    _warm_up_done = True
+
+    return timings
+
+
+def _get_hit_rate(stats):
+    requests = stats.get('hits', 0) + stats.get('misses', 0)
+    if requests == 0:
+        return None
+    return stats['hits'] / requests
+
+
+def health(provider=None, probe=False):
+    """
+    Get the health of the worker: warm up state, connection pool, circuit breaker and rate limiter state, cache hit
+    rates and the metrics summary. Only the state of the worker process is reported, so an Urkund outage does not
+    make a live worker unhealthy. With probe, the Urkund API latency is measured too. No submission is sent to
+    Urkund, and the latency probe has its own connection, outside the circuit breaker and rate limiter of the tasks.
+    :param provider: Provider instance. The provider of the worker process is used if not provided.
+    :type provider: UrkundProvider
+    :param probe: Check the Urkund API
+    :type probe: bool
+    :return: Health report, status is ok or error
+    :rtype: dict
+    """
+    report = {
+        'status': 'ok',
+        'warm': _warm_up_done
+    }
+
+    metadata_stats = metadata_cache.get_stats()
+    metadata_stats['hit_rate'] = _get_hit_rate(metadata_stats)
+    report['caches'] = {
+        'metadata': metadata_stats
+    }
+    report['metrics'] = metrics.registry.get_stats()
+    report['magic'] = detection.magic_pool.get_stats()
+
+    try:
+        if provider is None:
+            # the provider of the worker is created by the warm up or the first task, not by the health checks
+            provider = get_provider() if probe else _provider
+        if provider is None:
+            return report
+
+        urkund_lib = provider._get_urkund_lib() if probe else provider._urkund_lib
+        if urkund_lib is not None:
+            report['urkund_validated'] = urkund_lib.is_valid()
+            report.update(urkund_lib.get_stats())
+
+        if provider.config['poll_aggregation_backend'] is not None:
+            report['caches']['pending_index'] = get_pending_index(
+                backend=provider.config['poll_aggregation_backend']).get_stats()
+        if provider.config['cross_request_deduplication']:
+            submission_stats = get_submission_cache(backend=provider.config['deduplication_cache_backend'],
+                                                    max_size=provider.config['deduplication_cache_size']).get_stats()
+            submission_stats['hit_rate'] = _get_hit_rate(submission_stats)
+            report['caches']['submissions'] = submission_stats
+
+        if probe:
+            # the probe does not take rate limiter tokens from the tasks nor counts as a failure of their circuit
+            start = time.monotonic()
+            urkund_lib.get_probe_request().make(verb='GET', url='units/'+str(urkund_lib.config['unit']),
+                                                operation='units')
+            report['urkund_latency'] = time.monotonic() - start
+    except Exception as exception:
+        report['status'] = 'error'
+        report['error'] = repr(exception)
+
+    return report
+
+
+def start_metrics_exporters(serve=True):
+    """
+    Start the metrics exporters configured with environment variables: the metrics are served on
+    URKUND_METRICS_PORT (and URKUND_METRICS_ADDR) and pushed every URKUND_METRICS_PUSH_INTERVAL seconds to the
+    Pushgateway at URKUND_METRICS_PUSH_URL, as the URKUND_METRICS_JOB job
+    :param serve: Serve the metrics on a port. The child processes of a prefork worker only push them, they can
+                  not share the port.
+    :type serve: bool
+    :return: Started exporters
+    :rtype: list
+    """
+    global _metrics_server, _metrics_pusher
+    started = []
+
+    port = os.getenv('URKUND_METRICS_PORT')
+    if serve and port and _metrics_server is None:
+        _metrics_server = metrics.start_http_server(int(port), os.getenv('URKUND_METRICS_ADDR', '0.0.0.0'))
+        started.append('server')
+
+    push_url = os.getenv('URKUND_METRICS_PUSH_URL')
+    if push_url and _metrics_pusher is None:
+        interval = float(os.getenv('URKUND_METRICS_PUSH_INTERVAL', DEFAULT_METRICS_PUSH_INTERVAL))
+        _metrics_pusher = metrics.MetricsPusher(push_url, os.getenv('URKUND_METRICS_JOB', DEFAULT_METRICS_JOB),
+                                                grouping_key={'instance': get_worker_id()},
+                                                interval=interval).start()
+        started.append('pusher')
+
+    return started
+
+
+@worker_process_init.connect
+def on_worker_process_init(**kwargs):
+    """
+    Warm up the child processes of a prefork worker and start pushing their metrics
+    """
+    start_metrics_exporters(serve=False)
+    if not _warm_up_done:
+        warm_up()
+
+
+@worker_ready.connect
+def on_worker_ready(sender=None, **kwargs):
+    """
+    Warm up gevent, threads and solo workers, which run the tasks in the main process, and start their metrics
+    exporters. Connections opened by the main process of a prefork worker would be shared by its children, so only
+    the mimetype database is loaded.
+    """
+    pool = getattr(sender, 'pool', None)
+    if pool is not None and type(pool).__module__.endswith('prefork'):
+        detection.preload()
+        return
+
+    start_metrics_exporters()
+    if not _warm_up_done:
+        warm_up()
+
+
+@worker_shutdown.connect
+def on_worker_shutdown(**kwargs):
+    """
+    Stop the archive extraction processes of the worker
+    """
+    utils.shutdown_extraction_pools()
+
+
+@inspect_command()
+def urkund_health(state, **kwargs):
+    """
+    Celery inspect command returning the health of the worker process, without any request to Urkund. The reply
+    also shows the worker is connected to the broker:
+
+    celery -A tesla_ce_provider inspect urkund_health
+    """
+    return health()
+
+
+@inspect_command()
+def urkund_probe(state, **kwargs):
+    """
+    Celery inspect command returning the health of the worker and the Urkund API latency:
+
+    celery -A tesla_ce_provider inspect urkund_probe
+    """
+    return health(probe=True)
@@ -13,84 +13,145 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ UrkundLib module """
+import hashlib
+import threading
+import time
+from types import MappingProxyType
+from .cache import DEFAULT_CACHE_TTL
 from .exceptions import UnitAndOrganizationNotValid
 from .receivers import Receivers
-from .request import Request
+from .request import Request, DEFAULT_POOL_SIZE
 from .submissions import Submissions
 from .units import Units
 
 
-class UrkundLib:
+DEFAULT_VALIDATION_TTL = 3600
+DEFAULT_BASE_URL = 'https://secure.urkund.com/api/'
+
+
+class BaseUrkundLib:
     """
-        UrkundLib class
+        Base class of the sync and async clients, with the configuration, resources and unit validation
     """
-    _base_url = None
-    _config = {
-        'base_url': None,
-        'user': None,
-        'password': None,
-        'unit': None,
-        'organization': None,
-        'sub_organization': None,
-        'suffix': None,
-        'valid_unit_and_organization': False
-    }
+    _config = None
     _request = None
     _receivers = None
     _submissions = None
     _units = None
+    _suffix = None
+    _validated_at = None
+    _validation_ttl = DEFAULT_VALIDATION_TTL
+    _probe_request = None
 
-    def __init__(self, user, password, **kwargs):
-        self._config['base_url'] = 'https://secure.urkund.com/api/'
-        self._config['user'] = user
-        self._config['password'] = password
+    # resource classes, replaced by the async client
+    _request_class = Request
+    _receivers_class = Receivers
+    _submissions_class = Submissions
+    _units_class = Units
 
+    def _setup(self, user, password, **kwargs):
+        """
+        Create the resources of the client
+        :param user:
+        :param password:
+        :param kwargs:
+        :return:
+        """
         unit = None
         if 'unit' in kwargs.keys():
             unit = kwargs['unit']
-        self._config['unit'] = int(unit)
 
         organization = None
-        if 'organization' in kwargs.keys():
-            organization = kwargs['organization']
-
-        if organization is not None:
-            self._config['organization'] = int(organization)
+        if 'organization' in kwargs.keys() and kwargs['organization'] is not None:
+            organization = int(kwargs['organization'])
 
         sub_organization = None
-        if 'sub_organization' in kwargs.keys():
-            sub_organization = kwargs['sub_organization']
+        if 'sub_organization' in kwargs.keys() and kwargs['sub_organization'] is not None:
+            sub_organization = int(kwargs['sub_organization'])
 
-        if sub_organization is not None:
-            self._config['sub_organization'] = int(sub_organization)
+        base_url = DEFAULT_BASE_URL
+        if 'base_url' in kwargs.keys() and kwargs['base_url'] is not None:
+            base_url = kwargs['base_url']
 
-        self._config['valid_unit_and_organization'] = False
-        self._config['suffix'] = None
+        # configuration can not be changed once the instance is created
+        self._config = MappingProxyType({
+            'base_url': base_url,
+            'user': user,
+            'password': password,
+            'unit': int(unit),
+            'organization': organization,
+            'sub_organization': sub_organization
+        })
 
-        self.request = Request(base_url=self._config['base_url'], user=self._config['user'],
-                               password=self._config['password'])
-        self._units = Units(request=self.request)
-        self._submissions = Submissions(organization=self._config['organization'], request=self.request)
-        self.init()
+        pool_size = DEFAULT_POOL_SIZE
+        if 'pool_size' in kwargs.keys() and kwargs['pool_size'] is not None:
+            pool_size = kwargs['pool_size']
 
-    def init(self):
+        # circuit breaker, rate limiter and timeout options, the Request defaults are used if not provided
+        request_options = {}
+        for option in ('rate_limit', 'rate_limit_burst', 'rate_limit_wait', 'circuit_failure_threshold',
+                       'circuit_reset_timeout', 'timeouts', 'upload_min_rate'):
+            if option in kwargs.keys() and kwargs[option] is not None:
+                request_options[option] = kwargs[option]
+
+        self._cache_ttl = DEFAULT_CACHE_TTL
+        if 'cache_ttl' in kwargs.keys() and kwargs['cache_ttl'] is not None:
+            self._cache_ttl = kwargs['cache_ttl']
+
+        if 'validation_ttl' in kwargs.keys() and kwargs['validation_ttl'] is not None:
+            self._validation_ttl = kwargs['validation_ttl']
+
+        self.request = self._request_class(base_url=self._config['base_url'], user=self._config['user'],
+                                           password=self._config['password'], pool_size=pool_size,
+                                           **request_options)
+        # a rejected request means the credentials or the unit have changed, they are checked again before use
+        self.request.on_unauthorized = self.invalidate
+        self._units = self._units_class(request=self.request, cache_ttl=self._cache_ttl)
+        self._submissions = self._submissions_class(organization=self._config['organization'],
+                                                    request=self.request)
+
+    @property
+    def config(self):
         """
-        Check if variables are correct: user, password, unit, organization, sub_organization
-        :return:
+        Return the read only configuration of the instance
+        :return: MappingProxyType
         """
-        # check if the user and password provided are correct
-        if self._config['valid_unit_and_organization'] is True:
-            return
+        return self._config
+
+    def is_valid(self):
+        """
+        Check if the unit and organization were validated less than validation_ttl seconds ago
+        :return: bool
+        """
+        if self._validated_at is None:
+            return False
+        if self._validation_ttl is None:
+            return True
+
+        return time.monotonic() - self._validated_at < self._validation_ttl
 
-        unit = self.units.get(self._config['unit'])
+    def invalidate(self):
+        """
+        Force the validation of the unit and organization before the next use
+        :return:
+        """
+        self._validated_at = None
+        self._units.invalidate_cache()
 
-        self._config['valid_unit_and_organization'] = False
+    def _check_unit(self, unit):
+        """
+        Check the unit, organization and sub_organization with the unit returned by Urkund
+        :param unit:
+        :return:
+        """
+        valid = False
         valid_unit = False
         valid_organization = False
         valid_sub_organization = False
         organization = None
+        suffix = None
         if unit is not None and unit['Id'] == self._config['unit']:
-            self._config['suffix'] = unit['Suffix']
+            suffix = unit['Suffix']
             valid_unit = True
 
         # check if unit and organization provided are correct
@@ -109,13 +170,47 @@ class UrkundLib:
         if (valid_unit and valid_organization and valid_sub_organization) or \
                 (valid_unit and valid_organization and self._config['sub_organization'] is None) or \
                 (valid_unit and self._config['organization'] is None):
-            self._config['valid_unit_and_organization'] = True
+            valid = True
 
-        if not self._config['valid_unit_and_organization']:
+        if not valid:
+            self._validated_at = None
             raise UnitAndOrganizationNotValid()
 
-        assert self._config['suffix'] is not None
-        self._receivers = Receivers(config=self._config, request=self.request)
+        assert suffix is not None
+        if self._receivers is None or suffix != self._suffix:
+            self._suffix = suffix
+            self._receivers = self._receivers_class(config=dict(self._config, suffix=suffix), request=self.request,
+                                                    cache_ttl=self._cache_ttl)
+        self._validated_at = time.monotonic()
+
+    def get_probe_request(self):
+        """
+        Return a request without circuit breaker and rate limiter, on a connection of its own, to check the Urkund
+        API without affecting the requests of this instance
+        :return: Request
+        """
+        if self._probe_request is None:
+            self._probe_request = Request(base_url=self._config['base_url'], user=self._config['user'],
+                                          password=self._config['password'], pool_size=1, rate_limit=0,
+                                          circuit_failure_threshold=0)
+
+        return self._probe_request
+
+    def get_stats(self):
+        """
+        Return statistics of the HTTP connections, circuit breaker and rate limiter used by this instance
+        :return: dict
+        """
+        return self.request.get_stats()
+
+    def invalidate_cache(self):
+        """
+        Remove the cached units and receivers of this instance
+        :return:
+        """
+        self.units.invalidate_cache()
+        if self._receivers is not None:
+            self._receivers.invalidate_cache()
 
     @property
     def units(self):
@@ -125,14 +220,6 @@ class UrkundLib:
         """
         return self._units
 
-    @property
-    def receivers(self):
-        """
-        Return Receivers property
-        :return: Receivers
-        """
-        return self._receivers
-
     @property
     def submissions(self):
         """
@@ -142,7 +229,82 @@ class UrkundLib:
         return self._submissions
 
 
+class UrkundLib(BaseUrkundLib):
+    """
+        UrkundLib class
+    """
+
+    def __init__(self, user, password, **kwargs):
+        self._setup(user, password, **kwargs)
+        self.init()
+
+    def init(self):
+        """
+        Check if variables are correct: user, password, unit, organization, sub_organization
+        :return:
+        """
+        # check if the user and password provided are correct
+        if self.is_valid():
+            return
+
+        self._check_unit(self.units.get(self._config['unit']))
+
+    @property
+    def receivers(self):
+        """
+        Return Receivers property. The unit and organization are validated again if the validation has expired.
+        :return: Receivers
+        """
+        if not self.is_valid():
+            self.init()
+        return self._receivers
+
+
+_urkund_libs = {}
+_urkund_libs_lock = threading.Lock()
+
+
+def get_urkund_lib(user, password, **kwargs):
+    """
+    Get the UrkundLib instance of the process for a set of credentials and options, creating and validating it the
+    first time it is requested
+    :param user:
+    :param password:
+    :param kwargs: UrkundLib options
+    :return: UrkundLib
+    """
+    key = (user, hashlib.sha256(str(password).encode('utf-8')).hexdigest(), repr(sorted(kwargs.items())))
+    with _urkund_libs_lock:
+        urkund_lib = _urkund_libs.get(key)
+    if urkund_lib is not None:
+        return urkund_lib
+
+    urkund_lib = UrkundLib(user=user, password=password, **kwargs)
+    with _urkund_libs_lock:
+        return _urkund_libs.setdefault(key, urkund_lib)
+
+
+def clear_urkund_libs():
+    """
+    Remove all the UrkundLib instances of the process
+    :return:
+    """
+    with _urkund_libs_lock:
+        _urkund_libs.clear()
+
+
+def __getattr__(name):
+    # the async client depends on the optional aiohttp package, it is only imported when requested
+    if name == 'AsyncUrkundLib':
+        from .aio import AsyncUrkundLib
+        return AsyncUrkundLib
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 __all__ = [
     'UrkundLib',
+    'AsyncUrkundLib',
+    'get_urkund_lib',
+    'clear_urkund_libs',
     'exceptions'
 ]
@@ -0,0 +1,398 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Async UrkundLib module """
+import asyncio
+
+try:
+    import aiohttp
+except ImportError as import_error:
+    raise ImportError('The async Urkund client requires aiohttp. Install the provider with the async extra: '
+                      'pip install tesla-ce-provider-pt-urkund[async]') from import_error
+
+from . import BaseUrkundLib
+from . import metrics
+from .cache import metadata_cache
+from .exceptions import BaseUrkundLibException
+from .exceptions import ConnectionFailed
+from .exceptions import Timeout as RequestTimeout
+from .receivers import BaseReceivers
+from .request import BaseRequest, DEFAULT_POOL_SIZE, get_endpoint, http_responses, process_response, urkund_exceptions
+from .submissions import BULK_MIN_SUBMISSIONS, BaseSubmissions
+from .units import BaseUnits
+
+
+class AsyncRequest(BaseRequest):
+    """
+    AsyncRequest class. Requests are done with a pooled aiohttp session, sharing the timeouts, circuit breaker,
+    rate limiter and response processing of the sync Request.
+    """
+
+    def __init__(self, base_url, user, password, pool_size=DEFAULT_POOL_SIZE, **kwargs):
+        super().__init__(base_url, user, password, **kwargs)
+        self._pool_size = int(pool_size)
+        self._client = None
+        self._requests = 0
+
+    def _get_client(self):
+        """
+        Get the aiohttp session, creating it the first time it is requested. aiohttp sessions belong to an event
+        loop, so it is not created before the first request.
+        :return: aiohttp.ClientSession
+        """
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size)
+            # credentials are sent on every request, never keep server cookies
+            self._client = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+
+        return self._client
+
+    async def make(self, verb, url, data=None, headers=None, operation=None, deadline=None):
+        """
+        Make HTTP request
+        :param verb:
+        :param url:
+        :param data:
+        :param headers:
+        :param operation: Operation used to choose the timeouts, see get_timeout
+        :param deadline: time.monotonic() value the request has to finish before
+        :return:
+        """
+        endpoint = get_endpoint(verb, url)
+        try:
+            return await self._make(verb, url, data, headers, operation, deadline, endpoint)
+        except BaseUrkundLibException as exception:
+            urkund_exceptions.inc(endpoint=endpoint, exception=type(exception).__name__)
+            raise
+
+    async def _make(self, verb, url, data, headers, operation, deadline, endpoint):
+        """
+        Make HTTP request, see make
+        :param endpoint: Endpoint of the request, see get_endpoint
+        :return:
+        """
+        headers_send = self._get_headers(headers)
+        connect, read = self.get_timeout(operation, headers_send.get('Content-Length'), deadline)
+
+        # requests rejected by an open circuit do not take rate limiter tokens
+        self._circuit_breaker.before_request()
+
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        recorded = False
+        try:
+            waited = 0
+            wait = self._rate_limiter.try_acquire(waited)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                waited += wait
+                wait = self._rate_limiter.try_acquire(waited)
+
+            try:
+                with metrics.span('http', endpoint):
+                    async with self._get_client().request(verb, self._base_url+url, headers=headers_send,
+                                                          data=data, timeout=timeout) as response:
+                        status_code = response.status
+                        content = await response.read()
+            except asyncio.TimeoutError as timeout_error:
+                recorded = True
+                self._circuit_breaker.record_failure()
+                http_responses.inc(endpoint=endpoint, status='timeout')
+                raise RequestTimeout() from timeout_error
+            except aiohttp.ClientError as error:
+                recorded = True
+                self._circuit_breaker.record_failure()
+                http_responses.inc(endpoint=endpoint, status='connection_error')
+                raise ConnectionFailed(repr(error)) from error
+
+            recorded = True
+            self._requests += 1
+            http_responses.inc(endpoint=endpoint, status=status_code)
+            self._record_status(status_code)
+        finally:
+            # a half open circuit would reject every request if its trial request never ended
+            if not recorded:
+                self._circuit_breaker.release_trial()
+
+        return process_response(status_code, content)
+
+    def get_stats(self):
+        """
+        Get statistics of the connection pool, circuit breaker and rate limiter used by this request
+        :return:
+        """
+        return {
+            'pool': {
+                'requests': self._requests,
+                'size': self._pool_size
+            },
+            'circuit_breaker': self._circuit_breaker.get_stats(),
+            'rate_limiter': self._rate_limiter.get_stats()
+        }
+
+    async def close(self):
+        """
+        Close the pooled connections
+        :return:
+        """
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class AsyncUnits(BaseUnits):
+    """
+    AsyncUnits class
+    """
+
+    async def get(self, unit_id):
+        """
+        Get unit. Units are cached for cache_ttl seconds.
+        :param unit_id:
+        :return:
+        """
+        return await metadata_cache.async_get_or_set(
+            self._get_cache_key('units', unit_id),
+            lambda: self.request.make(verb='GET', url=self._get_url(unit_id), operation='units'),
+            ttl=self.cache_ttl)
+
+    async def get_organizations(self, unit_id):
+        """
+        Get organizations of unit. Organizations are cached for cache_ttl seconds.
+        :param unit_id:
+        :return:
+        """
+        return await metadata_cache.async_get_or_set(
+            self._get_cache_key('organizations', unit_id),
+            lambda: self.request.make(verb='GET', url=self._get_url(unit_id, 'organizations'), operation='units'),
+            ttl=self.cache_ttl)
+
+    async def get_all(self):
+        """
+        Get all units
+        :return:
+        """
+        return await self.request.make(verb='GET', url='units', operation='units')
+
+
+class AsyncReceivers(BaseReceivers):
+    """
+    AsyncReceivers class
+    """
+
+    async def create(self, full_name, email):
+        """
+        Create receiver
+        :param full_name:
+        :param email:
+        :return:
+        """
+        headers_send = {'Content-Type': 'application/json'}
+
+        response = await self._request.make(verb='POST', url='receivers',
+                                            data=self._get_create_data(full_name, email), headers=headers_send,
+                                            operation='receivers')
+        self.invalidate_cache()
+
+        return response
+
+    async def update(self, full_name, email):
+        """
+        Update receiver
+        :param full_name:
+        :param email:
+        :return:
+        """
+        headers_send = {'Content-Type': 'application/json'}
+
+        response = await self._request.make(verb='PUT', url='receivers',
+                                            data=self._get_update_data(full_name, email), headers=headers_send,
+                                            operation='receivers')
+        self.invalidate_cache()
+
+        return response
+
+    async def delete(self, analysis_email):
+        """
+        Delete receiver
+        :param analysis_email:
+        :return:
+        """
+        response = await self._request.make('DELETE', self._get_url(analysis_email), operation='receivers')
+        self.invalidate_cache()
+
+        return response
+
+    async def get_by_email(self, email, deadline=None):
+        """
+        Ger receiver by email
+        :param email:
+        :param deadline: time.monotonic() value the request has to finish before
+        :return:
+        """
+        return await self.get(analysis_email=self._get_analysis_email(email), deadline=deadline)
+
+    async def get(self, analysis_email, deadline=None):
+        """
+        Get receiver by analysis email. Receivers are cached for cache_ttl seconds.
+        :param analysis_email:
+        :param deadline: time.monotonic() value the request has to finish before
+        :return:
+        """
+        return await metadata_cache.async_get_or_set(
+            self._get_cache_key(analysis_email),
+            lambda: self._request.make('GET', self._get_url(analysis_email), operation='receivers',
+                                       deadline=deadline),
+            ttl=self._cache_ttl)
+
+    async def get_all(self):
+        """
+        Get all receivers
+        :return:
+        """
+        return await self._request.make('GET', 'receivers', operation='receivers')
+
+
+class AsyncSubmissions(BaseSubmissions):
+    """
+    AsyncSubmissions class
+    """
+
+    async def send(self, external_id, file, analysis_email, email, deadline=None):
+        """
+        Send submission
+        :param external_id:
+        :param file: dict with filename, mimetype and content. Content can be raw bytes or a file handle, which is
+                     uploaded in chunks
+        :param analysis_email:
+        :param email:
+        :param deadline: time.monotonic() value the upload has to finish before
+        :return:
+        """
+        response = await self.request.make(verb='POST', url=self._get_url(analysis_email, external_id),
+                                           headers=self._get_send_headers(file, email), data=file['content'],
+                                           operation='upload', deadline=deadline)
+        self._count_state(response)
+
+        return response
+
+    async def result(self, external_id, analysis_email, deadline=None):
+        """
+        Get result of submission
+        :param external_id:
+        :param analysis_email:
+        :param deadline: time.monotonic() value the request has to finish before
+        :return:
+        """
+        return await self.request.make(verb='GET', url=self._get_url(analysis_email, external_id),
+                                       operation='result', deadline=deadline)
+
+    async def results(self, pairs, max_workers=10, timeout=None, bulk=False,
+                      bulk_min_submissions=BULK_MIN_SUBMISSIONS):
+        """
+        Get results of many submissions. Submissions not returned by a bulk request, or all of them if bulk is not
+        used, are requested concurrently one by one.
+        :param pairs: List of (analysis_email, external_id) tuples
+        :param max_workers: Maximum number of concurrent requests
+        :param timeout: Seconds to wait for the results, submissions without result are not returned
+        :param bulk: Request all the submissions of a receiver at once
+        :param bulk_min_submissions: Pending submissions of a receiver needed to request its listing
+        :return: dict with the list of submissions or the raised Urkund exception by (analysis_email, external_id)
+        """
+        results = {}
+        pairs = list(dict.fromkeys(pairs))
+        if len(pairs) == 0:
+            return results
+
+        deadline = self._get_deadline(timeout)
+        for analysis_email, external_ids in self._get_bulk_receivers(pairs, bulk, bulk_min_submissions).items():
+            try:
+                submissions = await self.request.make(verb='GET', url=self._get_url(analysis_email),
+                                                      operation='result', deadline=deadline)
+            except BaseUrkundLibException as exception:
+                if self._add_listing_error(results, analysis_email, external_ids, exception):
+                    break
+                continue
+            self._add_listed(results, analysis_email, external_ids, submissions)
+
+        pending = [pair for pair in pairs if pair not in results]
+        if len(pending) == 0:
+            return results
+
+        semaphore = asyncio.Semaphore(max(1, int(max_workers)))
+
+        async def get_result(analysis_email, external_id):
+            async with semaphore:
+                try:
+                    results[(analysis_email, external_id)] = await self.result(
+                        external_id=external_id, analysis_email=analysis_email, deadline=deadline)
+                except BaseUrkundLibException as exception:
+                    results[(analysis_email, external_id)] = exception
+
+        tasks = [asyncio.ensure_future(get_result(analysis_email, external_id))
+                 for analysis_email, external_id in pending]
+        _, not_done = await asyncio.wait(tasks, timeout=self._get_remaining(deadline))
+        for task in not_done:
+            task.cancel()
+
+        return results
+
+
+class AsyncUrkundLib(BaseUrkundLib):
+    """
+        AsyncUrkundLib class. Resource methods are coroutines, the unit and organization are checked by init or
+        when the client is used as an async context manager.
+
+        async with AsyncUrkundLib(user=user, password=password, unit=unit) as urkund_lib:
+            receiver = await urkund_lib.receivers.get_by_email(email)
+    """
+    _request_class = AsyncRequest
+    _receivers_class = AsyncReceivers
+    _submissions_class = AsyncSubmissions
+    _units_class = AsyncUnits
+
+    def __init__(self, user, password, **kwargs):
+        self._setup(user, password, **kwargs)
+
+    async def init(self):
+        """
+        Check if variables are correct: user, password, unit, organization, sub_organization
+        :return:
+        """
+        if self.is_valid():
+            return
+
+        self._check_unit(await self.units.get(self._config['unit']))
+
+    @property
+    def receivers(self):
+        """
+        Return Receivers property. Await init before using it to validate the unit and organization again if the
+        validation has expired.
+        :return: AsyncReceivers
+        """
+        return self._receivers
+
+    async def close(self):
+        """
+        Close the pooled connections
+        :return:
+        """
+        await self.request.close()
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,126 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Cache module """
+import copy
+import threading
+import time
+
+DEFAULT_CACHE_TTL = 300
+
+
+class TTLCache:
+    """
+    TTLCache class
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get_or_set(self, key, func, ttl=DEFAULT_CACHE_TTL):
+        """
+        Get a cached value, calling func to get it when it is not cached or has expired
+        :param key: Tuple key, the first elements identify the owner of the value
+        :param func: Function returning the value
+        :param ttl: Seconds the value is valid. The value is not cached if ttl is 0 or None
+        :return:
+        """
+        if not ttl:
+            return func()
+
+        found, value = self.get(key)
+        if found:
+            return value
+
+        value = func()
+        self.set(key, value, ttl)
+
+        return copy.deepcopy(value)
+
+    async def async_get_or_set(self, key, func, ttl=DEFAULT_CACHE_TTL):
+        """
+        Get a cached value, awaiting the coroutine returned by func to get it when it is not cached or has expired
+        :param key: Tuple key, the first elements identify the owner of the value
+        :param func: Function returning a coroutine with the value
+        :param ttl: Seconds the value is valid. The value is not cached if ttl is 0 or None
+        :return:
+        """
+        if not ttl:
+            return await func()
+
+        found, value = self.get(key)
+        if found:
+            return value
+
+        value = await func()
+        self.set(key, value, ttl)
+
+        return copy.deepcopy(value)
+
+    def get(self, key):
+        """
+        Get a cached value
+        :param key: Tuple key
+        :return: tuple with whether the value is cached and not expired, and a copy of the value
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > now:
+                self._hits += 1
+                return True, copy.deepcopy(item[1])
+            self._misses += 1
+
+        return False, None
+
+    def set(self, key, value, ttl=DEFAULT_CACHE_TTL):
+        """
+        Cache a value
+        :param key: Tuple key
+        :param value:
+        :param ttl: Seconds the value is valid
+        :return:
+        """
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, *prefix):
+        """
+        Remove the values whose key starts with prefix. All the values are removed if prefix is not provided.
+        :param prefix:
+        :return:
+        """
+        with self._lock:
+            for key in list(self._items.keys()):
+                if key[:len(prefix)] == prefix:
+                    del self._items[key]
+
+    def get_stats(self):
+        """
+        Get cache statistics
+        :return:
+        """
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'hits': self._hits,
+                'misses': self._misses
+            }
+
+
+# units and receivers cache shared by all the UrkundLib instances of the process
+metadata_cache = TTLCache()
@@ -26,3 +26,6 @@ from .unauthorized import Unauthorized
 from .unit_and_organization_not_valid import UnitAndOrganizationNotValid
 from .not_available import NotAvailable
 from .timeout import Timeout
+from .circuit_open import CircuitOpen
+from .rate_limited import RateLimited
+from .connection_failed import ConnectionFailed
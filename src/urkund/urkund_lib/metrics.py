@@ -0,0 +1,460 @@
+#  Copyright (c) 2020 Roger Muñoz Bernaus
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Metrics module
+
+Process wide counters and histograms, and the timing spans used to measure the stages of a verification. Spans
+are recorded in the urkund_span_seconds histogram by span name, and optionally sent to Sentry as trace spans when
+tracing is enabled and sentry_sdk is installed. Metrics are exposed in the Prometheus text format, served on a
+port or pushed to a Prometheus Pushgateway.
+"""
+import bisect
+import threading
+import time
+import urllib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+try:
+    import sentry_sdk
+except ImportError:
+    sentry_sdk = None
+
+# histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    """
+    Counter class
+    """
+
+    def __init__(self, name, description, labelnames=()):
+        """
+        :param name: Metric name
+        :param description: Metric description
+        :param labelnames: Names of the labels of the metric
+        """
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment the counter
+        :param amount: Value added to the counter
+        :param labels: Label values
+        :return:
+        """
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        """
+        Get the values of the counter
+        :return: dict of values by label values tuple
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        """
+        Remove all the values
+        :return:
+        """
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """
+    Histogram class
+    """
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param name: Metric name
+        :param description: Metric description
+        :param labelnames: Names of the labels of the metric
+        :param buckets: Sorted upper bounds of the buckets
+        """
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Add an observation
+        :param value: Observed value
+        :param labels: Label values
+        :return:
+        """
+        self.observe_labels(value, tuple(str(labels.get(label, '')) for label in self.labelnames))
+
+    def observe_labels(self, value, key):
+        """
+        Add an observation given the values of all the labels, avoiding the labels lookup of observe
+        :param value: Observed value
+        :param key: Tuple of label values, in the order of labelnames
+        :return:
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                # bucket counts, the last one counts the observations above every bucket, count and sum
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            values[0][index] += 1
+            values[1] += 1
+            values[2] += value
+
+    def collect(self):
+        """
+        Get the values of the histogram
+        :return: dict of values by label values tuple. Values are dicts with the non cumulative bucket counts, the
+                 number of observations and their sum.
+        """
+        with self._lock:
+            return {key: {'buckets': list(values[0]), 'count': values[1], 'sum': values[2]}
+                    for key, values in self._values.items()}
+
+    def reset(self):
+        """
+        Remove all the observations
+        :return:
+        """
+        with self._lock:
+            self._values.clear()
+
+
+class MetricsRegistry:
+    """
+    MetricsRegistry class
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(self._metrics[name], metric_class):
+                raise ValueError('Metric {} is already registered with another type'.format(name))
+
+            return self._metrics[name]
+
+    def counter(self, name, description, labelnames=()):
+        """
+        Get a counter, creating it the first time it is requested
+        :param name: Metric name
+        :param description: Metric description
+        :param labelnames: Names of the labels of the metric
+        :return: Counter
+        """
+        return self._get_or_create(Counter, name, description, labelnames)
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Get a histogram, creating it the first time it is requested
+        :param name: Metric name
+        :param description: Metric description
+        :param labelnames: Names of the labels of the metric
+        :param buckets: Sorted upper bounds of the buckets
+        :return: Histogram
+        """
+        return self._get_or_create(Histogram, name, description, labelnames, buckets=buckets)
+
+    def get_metrics(self):
+        """
+        Get the registered metrics
+        :return: list of Counter and Histogram
+        """
+        with self._lock:
+            return list(self._metrics.values())
+
+    def get_stats(self):
+        """
+        Get a summary of the metrics: counter values and the number of observations and their sum of histograms
+        :return: dict by metric name and label values joined by commas
+        """
+        stats = {}
+        for metric in self.get_metrics():
+            values = {}
+            for key, value in metric.collect().items():
+                if isinstance(metric, Histogram):
+                    value = {'count': value['count'], 'sum': value['sum']}
+                values[','.join(key)] = value
+            stats[metric.name] = values
+
+        return stats
+
+    def reset(self):
+        """
+        Remove the values of all the metrics
+        :return:
+        """
+        for metric in self.get_metrics():
+            metric.reset()
+
+
+# metrics of the process
+registry = MetricsRegistry()
+
+span_seconds = registry.histogram('urkund_span_seconds', 'Duration of the verification stages', ('span', 'detail'))
+span_errors = registry.counter('urkund_span_errors_total', 'Verification stages finished with an exception',
+                               ('span', 'detail', 'exception'))
+
+_tracing = False
+
+
+def set_tracing(enabled):
+    """
+    Send the spans to Sentry as trace spans. Ignored if sentry_sdk is not installed.
+    :param enabled:
+    :return:
+    """
+    global _tracing
+    _tracing = bool(enabled) and sentry_sdk is not None
+
+
+def is_tracing():
+    """
+    Return whether spans are sent to Sentry
+    :return: bool
+    """
+    return _tracing
+
+
+class Span:
+    """
+    Context manager measuring the duration of a stage
+    """
+    __slots__ = ('name', 'detail', '_start', '_trace')
+
+    def __init__(self, name, detail=''):
+        """
+        :param name: Stage name
+        :param detail: Low cardinality detail of the stage, for instance the HTTP verb and endpoint
+        """
+        self.name = name
+        self.detail = detail
+        self._start = None
+        self._trace = None
+
+    def __enter__(self):
+        if _tracing:
+            self._trace = sentry_sdk.start_span(op='urkund.' + self.name)
+            self._trace.set_tag('detail', self.detail)
+            self._trace.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        span_seconds.observe_labels(time.perf_counter() - self._start, (self.name, self.detail))
+        if exc_type is not None:
+            span_errors.inc(span=self.name, detail=self.detail, exception=exc_type.__name__)
+        if self._trace is not None:
+            self._trace.__exit__(exc_type, exc_value, traceback)
+        return False
+
+
+def span(name, detail=''):
+    """
+    Measure the duration of a stage
+
+        with metrics.span('mimetype'):
+            mimetype = magic.from_buffer(header, mime=True)
+
+    :param name: Stage name
+    :param detail: Low cardinality detail of the stage, for instance the HTTP verb and endpoint
+    :return: Span
+    """
+    return Span(name, detail)
+
+
+# content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value, quotes=True):
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
+
+
+def _format_labels(labelnames, key, extra=None):
+    labels = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(labelnames, key)]
+    if extra is not None:
+        labels.append('{}="{}"'.format(extra[0], extra[1]))
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def generate_latest(metrics_registry=None):
+    """
+    Get the metrics in the Prometheus text exposition format
+    :param metrics_registry: Registry of the metrics, the process registry if not provided
+    :return: Metrics text
+    :rtype: str
+    """
+    if metrics_registry is None:
+        metrics_registry = registry
+
+    lines = []
+    for metric in metrics_registry.get_metrics():
+        metric_type = 'histogram' if isinstance(metric, Histogram) else 'counter'
+        lines.append('# HELP {} {}'.format(metric.name, _escape(metric.description, quotes=False)))
+        lines.append('# TYPE {} {}'.format(metric.name, metric_type))
+        for key, value in sorted(metric.collect().items()):
+            if metric_type == 'counter':
+                lines.append('{}{} {}'.format(metric.name, _format_labels(metric.labelnames, key),
+                                              _format_value(value)))
+                continue
+
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name, _format_labels(metric.labelnames, key, ('le', _format_value(bound))), cumulative))
+            lines.append('{}_sum{} {}'.format(metric.name, _format_labels(metric.labelnames, key),
+                                              _format_value(value['sum'])))
+            lines.append('{}_count{} {}'.format(metric.name, _format_labels(metric.labelnames, key),
+                                                value['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """ Request handler serving the metrics of the process """
+    metrics_registry = None
+
+    def do_GET(self):
+        """ Return the metrics """
+        content = generate_latest(self.metrics_registry).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr='0.0.0.0', metrics_registry=None):
+    """
+    Serve the metrics on a port in a background thread, to be scraped by Prometheus
+    :param port: Port the metrics are served on, a free port is used if 0
+    :param addr: Address the server listens on
+    :param metrics_registry: Registry of the metrics, the process registry if not provided
+    :return: HTTP server
+    :rtype: ThreadingHTTPServer
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'metrics_registry': metrics_registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def push_to_gateway(url, job, grouping_key=None, metrics_registry=None, timeout=10):
+    """
+    Push the metrics to a Prometheus Pushgateway, replacing the ones previously pushed with the same grouping key
+    :param url: Base url of the Pushgateway
+    :param job: Job name
+    :param grouping_key: dict of labels identifying the pushing process, for instance its instance
+    :param metrics_registry: Registry of the metrics, the process registry if not provided
+    :param timeout: Seconds to wait for the Pushgateway
+    :return:
+    """
+    path = '/metrics/job/' + urllib.parse.quote(job, safe='')
+    for name, value in sorted((grouping_key or {}).items()):
+        path += '/{}/{}'.format(name, urllib.parse.quote(str(value), safe=''))
+
+    response = requests.put(url.rstrip('/') + path, data=generate_latest(metrics_registry).encode('utf-8'),
+                            headers={'Content-Type': CONTENT_TYPE}, timeout=timeout)
+    response.raise_for_status()
+
+
+class MetricsPusher:
+    """
+    Push the metrics of the process to a Prometheus Pushgateway periodically, in a background thread
+    """
+
+    def __init__(self, url, job, grouping_key=None, interval=15, metrics_registry=None):
+        """
+        :param url: Base url of the Pushgateway
+        :param job: Job name
+        :param grouping_key: dict of labels identifying the pushing process
+        :param interval: Seconds between pushes
+        :param metrics_registry: Registry of the metrics, the process registry if not provided
+        """
+        self._url = url
+        self._job = job
+        self._grouping_key = grouping_key
+        self._interval = interval
+        self._metrics_registry = metrics_registry
+        self._stop = threading.Event()
+        self._thread = None
+        self.errors = 0
+
+    def start(self):
+        """
+        Start pushing the metrics
+        :return: MetricsPusher
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        """
+        Stop pushing the metrics, after a last push
+        :return:
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _push(self):
+        try:
+            push_to_gateway(self._url, self._job, self._grouping_key, self._metrics_registry)
+        except requests.RequestException:
+            # the metrics are pushed again in the next interval
+            self.errors += 1
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._push()
+        self._push()
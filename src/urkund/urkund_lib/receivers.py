@@ -15,18 +15,21 @@
 """ Receivers module """
 import json
 import urllib
+from .cache import metadata_cache, DEFAULT_CACHE_TTL
 
 
-class Receivers:
+class BaseReceivers:
     """
-    Receivers class
+    Base class of the sync and async receivers, with the request bodies, urls and cache keys
     """
     _unit = None
     _organization = None
     _sub_organization = None
     _suffix = None
+    _cache_ttl = DEFAULT_CACHE_TTL
 
-    def __init__(self, config, request):
+    def __init__(self, config, request, cache_ttl=DEFAULT_CACHE_TTL):
+        self._cache_ttl = cache_ttl
         self._unit = config['unit']
         self._organization = config['organization']
         self._sub_organization = config['sub_organization']
@@ -40,9 +43,9 @@ class Receivers:
         """
         return self._suffix
 
-    def create(self, full_name, email):
+    def _get_create_data(self, full_name, email):
         """
-        Create receiver
+        Get the body of a receiver creation
         :param full_name:
         :param email:
         :return:
@@ -58,15 +61,11 @@ class Receivers:
         if self._organization is not None:
             receiver['SubOrganizationId'] = self._sub_organization
 
-        data = json.dumps(receiver)
-
-        headers_send = {'Content-Type': 'application/json'}
-
-        return self._request.make(verb='POST', url='receivers', data=data, headers=headers_send)
+        return json.dumps(receiver)
 
-    def update(self, full_name, email):
+    def _get_update_data(self, full_name, email):
         """
-        Update receiver
+        Get the body of a receiver update
         :param full_name:
         :param email:
         :return:
@@ -79,11 +78,77 @@ class Receivers:
             "SubOrganizationId": self._sub_organization,
         }
 
-        data = json.dumps(receiver)
+        return json.dumps(receiver)
+
+    def _get_analysis_email(self, email):
+        """
+        Get the analysis email of the receiver of an email
+        :param email:
+        :return:
+        """
+        first_part = email.split('@')[0]
+
+        return str(first_part)+str(self._suffix)
+
+    @staticmethod
+    def _get_url(analysis_email):
+        """
+        Get the url of a receiver
+        :param analysis_email:
+        :return:
+        """
+        return 'receivers/'+str(urllib.parse.quote(analysis_email))
+
+    def _get_cache_key(self, analysis_email):
+        """
+        Get the metadata cache key of a receiver
+        :param analysis_email:
+        :return:
+        """
+        return self._request.get_cache_key(), 'receivers', analysis_email
+
+    def invalidate_cache(self):
+        """
+        Remove the cached receivers
+        :return:
+        """
+        metadata_cache.invalidate(self._request.get_cache_key(), 'receivers')
 
+
+class Receivers(BaseReceivers):
+    """
+    Receivers class
+    """
+
+    def create(self, full_name, email):
+        """
+        Create receiver
+        :param full_name:
+        :param email:
+        :return:
+        """
+        headers_send = {'Content-Type': 'application/json'}
+
+        response = self._request.make(verb='POST', url='receivers', data=self._get_create_data(full_name, email),
+                                      headers=headers_send, operation='receivers')
+        self.invalidate_cache()
+
+        return response
+
+    def update(self, full_name, email):
+        """
+        Update receiver
+        :param full_name:
+        :param email:
+        :return:
+        """
         headers_send = {'Content-Type': 'application/json'}
 
-        return self._request.make(verb='PUT', url='receivers', data=data, headers=headers_send)
+        response = self._request.make(verb='PUT', url='receivers', data=self._get_update_data(full_name, email),
+                                      headers=headers_send, operation='receivers')
+        self.invalidate_cache()
+
+        return response
 
     def delete(self, analysis_email):
         """
@@ -91,35 +156,35 @@ class Receivers:
         :param analysis_email:
         :return:
         """
-        email_url_encoded = urllib.parse.quote(analysis_email)
+        response = self._request.make('DELETE', self._get_url(analysis_email), operation='receivers')
+        self.invalidate_cache()
 
-        return self._request.make('DELETE', 'receivers/'+str(email_url_encoded))
+        return response
 
-    def get_by_email(self, email):
+    def get_by_email(self, email, deadline=None):
         """
         Ger receiver by email
         :param email:
+        :param deadline: time.monotonic() value the request has to finish before
         :return:
         """
-        first_part = email.split('@')[0]
+        return self.get(analysis_email=self._get_analysis_email(email), deadline=deadline)
 
-        analysis_email = str(first_part)+str(self._suffix)
-
-        return self.get(analysis_email=analysis_email)
-
-    def get(self, analysis_email):
+    def get(self, analysis_email, deadline=None):
         """
-        Get receiver by analysis email
+        Get receiver by analysis email. Receivers are cached for cache_ttl seconds.
         :param analysis_email:
+        :param deadline: time.monotonic() value the request has to finish before
         :return:
         """
-        email_url_encoded = urllib.parse.quote(analysis_email)
-
-        return self._request.make('GET', 'receivers/'+str(email_url_encoded))
+        return metadata_cache.get_or_set(self._get_cache_key(analysis_email),
+                                         lambda: self._request.make('GET', self._get_url(analysis_email),
+                                                                    operation='receivers', deadline=deadline),
+                                         ttl=self._cache_ttl)
 
     def get_all(self):
         """
         Get all receivers
         :return:
         """
-        return self._request.make('GET', 'receivers')
+        return self._request.make('GET', 'receivers', operation='receivers')
@@ -14,9 +14,21 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Request module """
 import base64
+import hashlib
+import http.cookiejar
 import json
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 from requests.exceptions import Timeout
+from urllib3.util.retry import Retry
+from . import metrics
+from .exceptions import BaseUrkundLibException
+from .exceptions import CircuitOpen
+from .exceptions import ConnectionFailed
+from .exceptions import RateLimited
 from .exceptions import Unauthorized
 from .exceptions import Timeout as RequestTimeout
 from .exceptions import BadRequest
@@ -27,32 +39,357 @@ from .exceptions import MediaTypeNotSupported
 from .exceptions import ReceiverExists
 from .exceptions import RequestTooLarge
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RATE_LIMIT = 10
+DEFAULT_RATE_LIMIT_WAIT = 5
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 5
+DEFAULT_CIRCUIT_RESET_TIMEOUT = 30
+# connection errors retried by GET requests, for instance when a pooled keep-alive connection was closed
+DEFAULT_IDEMPOTENT_RETRIES = 2
 
-class Request:
+# connect and read timeouts in seconds by operation
+DEFAULT_TIMEOUTS = {
+    'default': (5, 20),
+    'units': (5, 10),
+    'receivers': (5, 10),
+    'upload': (5, 20),
+    'result': (5, 10)
+}
+# upload read timeouts grow one second for every DEFAULT_UPLOAD_MIN_RATE bytes of the body
+DEFAULT_UPLOAD_MIN_RATE = 262144
+
+
+http_responses = metrics.registry.counter('urkund_http_responses_total',
+                                          'Urkund API responses by endpoint and status', ('endpoint', 'status'))
+urkund_exceptions = metrics.registry.counter('urkund_exceptions_total', 'Urkund API errors by endpoint and exception',
+                                             ('endpoint', 'exception'))
+
+
+def get_endpoint(verb, url):
     """
-    Request class
+    Get the endpoint of a request, the verb and the first path element of the url. Ids and addresses are left out
+    to keep the number of metric labels low.
+    :param verb: HTTP verb
+    :param url: Url relative to the base url
+    :return: Endpoint, for instance "POST submissions"
+    """
+    return '{} {}'.format(verb, url.split('/', 1)[0])
+
+
+def process_response(status_code, content):
+    """
+    Process HTTP Urkund response
+    :param status_code: HTTP status code
+    :param content: Response body
+    :return:
+    """
+    if status_code == 200:
+        return json.loads(content.decode('utf-8'))
+
+    if status_code == 202:
+        return json.loads(content.decode('utf-8'))
+
+    if status_code == 400:
+        raise BadRequest(content.decode('utf-8'))
+
+    if status_code == 401:
+        raise Unauthorized()
+
+    if status_code == 404:
+        raise NotFound(content.decode('utf-8'))
+
+    if status_code == 409:
+        raise ReceiverExists()
+
+    if status_code == 410:
+        raise NotAvailable(content.decode('utf-8'))
+
+    if status_code == 415:
+        raise MediaTypeNotSupported(content.decode('utf-8'))
+
+    if status_code == 413:
+        raise RequestTooLarge(content.decode('utf-8'))
+
+    raise InvalidResponse(content.decode('utf-8'))
+
+
+class CircuitBreaker:
+    """
+    CircuitBreaker class. Opens after failure_threshold consecutive failures, rejecting the requests until
+    reset_timeout seconds have passed. Then a single trial request is allowed, closing the circuit if it succeeds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=DEFAULT_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_CIRCUIT_RESET_TIMEOUT):
+        """
+        :param failure_threshold: Consecutive failures opening the circuit, 0 disables the breaker
+        :param reset_timeout: Seconds the circuit is kept open
+        """
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._times_opened = 0
+        self._rejected = 0
+
+    def before_request(self):
+        """
+        Check if a request can be done
+        :return:
+        """
+        if not self._failure_threshold:
+            return
+
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self._reset_timeout:
+                    self._rejected += 1
+                    raise CircuitOpen('Urkund API circuit is open')
+                self._state = self.HALF_OPEN
+                self._trial = False
+
+            if self._state == self.HALF_OPEN:
+                if self._trial:
+                    self._rejected += 1
+                    raise CircuitOpen('Urkund API circuit is half open')
+                self._trial = True
+
+    def record_success(self):
+        """
+        Register a successful request
+        :return:
+        """
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial = False
+
+    def release_trial(self):
+        """
+        Allow a new trial request when the trial request ended without an Urkund response, as when it was throttled
+        :return:
+        """
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        """
+        Register a failed request
+        :return:
+        """
+        if not self._failure_threshold:
+            return
+
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+                if self._state != self.OPEN:
+                    self._times_opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def get_retry_after(self):
+        """
+        Seconds until the circuit allows a trial request
+        :return: float
+        """
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0
+            return max(self._reset_timeout - (time.monotonic() - self._opened_at), 0)
+
+    def get_stats(self):
+        """
+        Get circuit breaker statistics
+        :return:
+        """
+        retry_after = self.get_retry_after()
+        with self._lock:
+            return {
+                'state': self._state,
+                'failures': self._failures,
+                'times_opened': self._times_opened,
+                'rejected': self._rejected,
+                'retry_after': retry_after
+            }
+
+
+class RateLimiter:
+    """
+    RateLimiter class. Token bucket allowing rate requests per second with bursts of up to burst requests.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=None, max_wait=DEFAULT_RATE_LIMIT_WAIT):
+        """
+        :param rate: Requests per second, 0 or None disables the limiter
+        :param burst: Maximum number of requests done at once, rate if not provided
+        :param max_wait: Maximum seconds a request waits for a token
+        """
+        self._rate = rate
+        self._burst = burst
+        if self._burst is None:
+            self._burst = max(rate or 0, 1)
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self._tokens = float(self._burst)
+        self._updated_at = time.monotonic()
+        self._waited = 0
+        self._throttled = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def acquire(self):
+        """
+        Take a token, waiting up to max_wait seconds for it
+        :return:
+        """
+        waited = 0
+        wait = self.try_acquire(waited)
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            wait = self.try_acquire(waited)
+
+    def try_acquire(self, waited=0):
+        """
+        Take a token if there is one available
+        :param waited: Seconds already waited for the token
+        :return: 0 if the token was taken, otherwise seconds to wait before trying again
+        """
+        if not self._rate:
+            return 0
+
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                if waited > 0:
+                    self._waited += 1
+                return 0
+            wait = (1 - self._tokens) / self._rate
+            if waited + wait > self._max_wait:
+                self._throttled += 1
+                raise RateLimited('Urkund API rate limit exceeded')
+
+            return wait
+
+    def get_stats(self):
+        """
+        Get rate limiter statistics
+        :return:
+        """
+        with self._lock:
+            if self._rate:
+                self._refill()
+            return {
+                'rate': self._rate,
+                'burst': self._burst,
+                'tokens': self._tokens,
+                'waited': self._waited,
+                'throttled': self._throttled
+            }
+
+
+class BaseRequest:
+    """
+    Base class of the sync and async requests, with the credentials, timeouts, circuit breaker and rate limiter
     """
     _base_url = None
     _user = None
     _password = None
     _hash_user_password = None
-    """
-    Request class
-    """
-    def __init__(self, base_url, user, password):
+    # called when Urkund rejects the credentials
+    on_unauthorized = None
+
+    # circuit breakers and rate limiters shared by all the Request instances of the process, by base url and options
+    _circuit_breakers = {}
+    _rate_limiters = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, base_url, user, password, rate_limit=DEFAULT_RATE_LIMIT, rate_limit_burst=None,
+                 rate_limit_wait=DEFAULT_RATE_LIMIT_WAIT, circuit_failure_threshold=DEFAULT_CIRCUIT_FAILURE_THRESHOLD,
+                 circuit_reset_timeout=DEFAULT_CIRCUIT_RESET_TIMEOUT, timeouts=None,
+                 upload_min_rate=DEFAULT_UPLOAD_MIN_RATE):
         self._base_url = base_url
         self._user = user
         self._password = password
 
         user_password = str(self._user)+':'+str(self._password)
         self._hash_user_password = base64.b64encode(user_password.encode()).decode('utf-8')
+        # cached responses of other credentials, as a wrong password, are never returned
+        self._cache_key = "{}, user{}, {}".format(self._base_url, self._user,
+                                                  hashlib.sha256(user_password.encode()).hexdigest())
+
+        self._timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts is not None:
+            for operation, timeout in timeouts.items():
+                self._timeouts[operation] = tuple(timeout)
+        self._upload_min_rate = upload_min_rate
+
+        self._circuit_breaker = self._get_shared(self._circuit_breakers, CircuitBreaker, base_url,
+                                                 failure_threshold=circuit_failure_threshold,
+                                                 reset_timeout=circuit_reset_timeout)
+        self._rate_limiter = self._get_shared(self._rate_limiters, RateLimiter, base_url, rate=rate_limit,
+                                              burst=rate_limit_burst, max_wait=rate_limit_wait)
 
-    def make(self, verb, url, data=None, headers=None):
+    @classmethod
+    def _get_shared(cls, instances, instance_class, base_url, **kwargs):
         """
-        Make HTTP request
-        :param verb:
-        :param url:
-        :param data:
+        Get the process wide instance of instance_class for a base url and options
+        :param instances: Dict of the created instances
+        :param instance_class: CircuitBreaker or RateLimiter
+        :param base_url:
+        :param kwargs: Options of the instance
+        :return:
+        """
+        key = (base_url, ) + tuple(sorted(kwargs.items()))
+        with cls._shared_lock:
+            if key not in instances:
+                instances[key] = instance_class(**kwargs)
+
+            return instances[key]
+
+    def get_timeout(self, operation=None, size=None, deadline=None):
+        """
+        Get the connect and read timeouts of an operation
+        :param operation: units, receivers, upload or result. Default timeouts are used for other operations.
+        :param size: Size in bytes of the uploaded body
+        :param deadline: time.monotonic() value the request has to finish before
+        :return: tuple with the connect and read timeouts
+        """
+        connect, read = self._timeouts.get(operation, self._timeouts['default'])
+        if operation == 'upload' and size and self._upload_min_rate:
+            read += int(size) / self._upload_min_rate
+
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RequestTimeout('Deadline exceeded')
+            connect = min(connect, remaining)
+            read = min(read, remaining)
+
+        return connect, read
+
+    def get_retry_after(self):
+        """
+        Seconds until the Urkund API accepts requests again
+        :return: float
+        """
+        return self._circuit_breaker.get_retry_after()
+
+    def _get_headers(self, headers=None):
+        """
+        Add the authentication and language headers to the headers of a request
         :param headers:
         :return:
         """
@@ -66,48 +403,164 @@ class Request:
         headers_send['Accept-Language'] = 'en-US'
         headers_send['Content-Language'] = 'en-US'
 
-        try:
-            response = requests.request(method=verb, url=self._base_url+url, headers=headers_send, data=data,
-                                        timeout=20)
-            return self._process_response(response)
-        except Timeout as timeout:
-            raise RequestTimeout() from timeout
+        return headers_send
 
-    @staticmethod
-    def _process_response(response):
+    def _record_status(self, status_code):
         """
-        Process HTTP Urkund response
-        :param response:
+        Register the status code of a response in the circuit breaker and notify rejected credentials
+        :param status_code:
         :return:
         """
-        if response.status_code == 200:
-            return json.loads(response.content.decode('utf-8'))
+        if status_code == 410 or status_code >= 500:
+            self._circuit_breaker.record_failure()
+        else:
+            self._circuit_breaker.record_success()
+
+        if status_code == 401 and self.on_unauthorized is not None:
+            self.on_unauthorized()
+
+    def get_cache_key(self):
+        """
+        Get the key of the cached responses of this base url and credentials
+        :return:
+        """
+        return self._cache_key
+
+    def __str__(self):
+        return self._base_url+", user"+self._user
+
+
+class Request(BaseRequest):
+    """
+    Request class
+    """
+    _session = None
+
+    # HTTP sessions shared by all the Request instances of the process, by base url and pool size
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, base_url, user, password, pool_size=DEFAULT_POOL_SIZE, **kwargs):
+        super().__init__(base_url, user, password, **kwargs)
+        self._session = self._get_session(base_url, pool_size)
+
+    @classmethod
+    def _get_session(cls, base_url, pool_size):
+        """
+        Get the pooled keep-alive session for a base url, creating it the first time it is requested
+        :param base_url:
+        :param pool_size:
+        :return: requests.Session
+        """
+        key = (base_url, int(pool_size))
+        with cls._sessions_lock:
+            if key not in cls._sessions:
+                session = requests.Session()
+                # credentials are sent on every request, never keep server cookies between different users
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                # GET requests are sent again once when a pooled connection was closed by the server, and on
+                # connection errors. Error statuses are left to the callers.
+                retry = Retry(total=DEFAULT_IDEMPOTENT_RETRIES, connect=DEFAULT_IDEMPOTENT_RETRIES, read=1,
+                              status=0, redirect=False, allowed_methods=frozenset(['GET', 'HEAD']),
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_size), pool_block=False,
+                                      max_retries=retry)
+                session.mount(base_url, adapter)
+                cls._sessions[key] = session
 
-        if response.status_code == 202:
-            return json.loads(response.content.decode('utf-8'))
+            return cls._sessions[key]
 
-        if response.status_code == 400:
-            raise BadRequest(response.content.decode('utf-8'))
+    def get_stats(self):
+        """
+        Get statistics of the connection pool, circuit breaker and rate limiter used by this request. They are
+        shared by the whole process.
+        :return:
+        """
+        opened = 0
+        requests_done = 0
 
-        if response.status_code == 401:
-            raise Unauthorized()
+        pools = self._session.get_adapter(self._base_url).poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            opened += pool.num_connections
+            requests_done += pool.num_requests
 
-        if response.status_code == 404:
-            raise NotFound(response.content.decode('utf-8'))
+        return {
+            'pool': {
+                'requests': requests_done,
+                'connections_opened': opened,
+                'connections_reused': max(requests_done - opened, 0)
+            },
+            'circuit_breaker': self._circuit_breaker.get_stats(),
+            'rate_limiter': self._rate_limiter.get_stats()
+        }
 
-        if response.status_code == 409:
-            raise ReceiverExists()
+    def make(self, verb, url, data=None, headers=None, operation=None, deadline=None):
+        """
+        Make HTTP request
+        :param verb:
+        :param url:
+        :param data:
+        :param headers:
+        :param operation: Operation used to choose the timeouts, see get_timeout
+        :param deadline: time.monotonic() value the request has to finish before
+        :return:
+        """
+        endpoint = get_endpoint(verb, url)
+        try:
+            return self._make(verb, url, data, headers, operation, deadline, endpoint)
+        except BaseUrkundLibException as exception:
+            urkund_exceptions.inc(endpoint=endpoint, exception=type(exception).__name__)
+            raise
 
-        if response.status_code == 410:
-            raise NotAvailable(response.content.decode('utf-8'))
+    def _make(self, verb, url, data, headers, operation, deadline, endpoint):
+        """
+        Make HTTP request, see make
+        :param endpoint: Endpoint of the request, see get_endpoint
+        :return:
+        """
+        headers_send = self._get_headers(headers)
+        timeout = self.get_timeout(operation, headers_send.get('Content-Length'), deadline)
 
-        if response.status_code == 415:
-            raise MediaTypeNotSupported(response.content.decode('utf-8'))
+        # requests rejected by an open circuit do not take rate limiter tokens
+        self._circuit_breaker.before_request()
 
-        if response.status_code == 413:
-            raise RequestTooLarge(response.content.decode('utf-8'))
+        recorded = False
+        try:
+            self._rate_limiter.acquire()
+            try:
+                with metrics.span('http', endpoint):
+                    response = self._session.request(method=verb, url=self._base_url+url, headers=headers_send,
+                                                     data=data, timeout=timeout)
+            except Timeout as timeout:
+                recorded = True
+                self._circuit_breaker.record_failure()
+                http_responses.inc(endpoint=endpoint, status='timeout')
+                raise RequestTimeout() from timeout
+            except RequestException as error:
+                recorded = True
+                self._circuit_breaker.record_failure()
+                http_responses.inc(endpoint=endpoint, status='connection_error')
+                raise ConnectionFailed(repr(error)) from error
 
-        raise InvalidResponse(response.content.decode('utf-8'))
+            recorded = True
+            http_responses.inc(endpoint=endpoint, status=response.status_code)
+            self._record_status(response.status_code)
+        finally:
+            # a half open circuit would reject every request if its trial request never ended
+            if not recorded:
+                self._circuit_breaker.release_trial()
 
-    def __str__(self):
-        return self._base_url+", user"+self._user
+        return self._process_response(response)
+
+    @staticmethod
+    def _process_response(response):
+        """
+        Process HTTP Urkund response
+        :param response:
+        :return:
+        """
+        return process_response(response.status_code, response.content)
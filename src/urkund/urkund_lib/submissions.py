@@ -14,12 +14,26 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Units module """
 import base64
+import os
+import time
 import urllib
+from concurrent.futures import ThreadPoolExecutor, wait
+from . import metrics
+from .exceptions import BadRequest, BaseUrkundLibException, InvalidResponse, NotFound
 
+submission_states = metrics.registry.counter('urkund_submissions_total', 'Submissions by the state returned by Urkund',
+                                             ('state',))
+# seconds the bulk requests are not used after Urkund rejects a receiver listing
+BULK_BACKOFF = 600
+# pending submissions of a receiver needed to request its listing, which returns its whole history
+BULK_MIN_SUBMISSIONS = 20
+# receivers whose last listing returned more submissions than this factor times the pending ones are not listed
+BULK_MAX_LISTING_FACTOR = 10
 
-class Submissions:
+
+class BaseSubmissions:
     """
-    Submissions class
+    Base class of the sync and async submissions, with the request headers, urls and the grouping of bulk results
     """
     organization = None
     request = None
@@ -27,37 +41,38 @@ class Submissions:
     def __init__(self, organization, request):
         self.organization = organization
         self.request = request
+        self._bulk_disabled_until = 0
+        self._listing_sizes = {}
 
-    def send(self, external_id, file, analysis_email, email):
+    @staticmethod
+    def _count_state(response):
         """
-        Send submission
-        :param external_id:
-        :param file:
-        :param analysis_email:
-        :param email:
+        Count a submission by the state returned by Urkund
+        :param response: Submission
         :return:
         """
-        receiver_url_encoded = urllib.parse.quote(analysis_email)
-
-        filename_only = base64.b64encode(file['filename'].split('/')[-1].encode('utf-8')).decode('utf-8', 'ignore')
-        file['content'] = base64.b64decode(file['content'].decode('utf-8', 'ignore'))
-
-        headers = {'Content-Type': file['mimetype'], 'x-urkund-anonymous': '0', 'x-urkund-message': '',
-                   'x-urkund-subject': '', 'x-urkund-submitter': email, 'x-urkund-filename': str(filename_only),
-                   'Content-Length': str(len(file['content']))}
-
-        return self.request.make(verb='POST', url='submissions/'+str(receiver_url_encoded)+"/"+str(external_id),
-                                 headers=headers, data=file['content'])
+        if isinstance(response, dict) and isinstance(response.get('Status'), dict):
+            submission_states.inc(state=response['Status'].get('State'))
 
-    def result(self, external_id, analysis_email):
+    @staticmethod
+    def _get_send_headers(file, email):
         """
-        Get result of submission
-        :param external_id:
-        :param analysis_email:
+        Get the headers of a submission. File handles are rewound to be uploaded from the start.
+        :param file: dict with filename, mimetype and content
+        :param email:
         :return:
         """
-        receiver_url_encoded = urllib.parse.quote(analysis_email)
-        return self.request.make(verb='GET', url='submissions/'+str(receiver_url_encoded)+"/"+str(external_id))
+        filename_only = base64.b64encode(file['filename'].split('/')[-1].encode('utf-8')).decode('utf-8', 'ignore')
+        content = file['content']
+        if hasattr(content, 'read'):
+            content.seek(0)
+            content_length = os.fstat(content.fileno()).st_size
+        else:
+            content_length = len(content)
+
+        return {'Content-Type': file['mimetype'], 'x-urkund-anonymous': '0', 'x-urkund-message': '',
+                'x-urkund-subject': '', 'x-urkund-submitter': email, 'x-urkund-filename': str(filename_only),
+                'Content-Length': str(content_length)}
 
     @staticmethod
     def get_message_from_submission_error(error):
@@ -78,3 +93,183 @@ class Submissions:
             return explication_errors[int(error)]
 
         return "Error not explained"
+
+    @staticmethod
+    def _get_url(analysis_email, external_id=None):
+        """
+        Get the url of the submissions of a receiver, or of one of them
+        :param analysis_email:
+        :param external_id:
+        :return:
+        """
+        url = 'submissions/'+str(urllib.parse.quote(analysis_email))
+        if external_id is not None:
+            url += "/"+str(external_id)
+
+        return url
+
+    @staticmethod
+    def _get_deadline(timeout):
+        """
+        Get the time.monotonic() value the results have to be returned before
+        :param timeout: Seconds to wait for the results
+        :return:
+        """
+        if timeout is None:
+            return None
+
+        return time.monotonic() + timeout
+
+    @staticmethod
+    def _get_remaining(deadline):
+        """
+        Get the seconds left before the deadline
+        :param deadline: time.monotonic() value or None
+        :return:
+        """
+        if deadline is None:
+            return None
+
+        return max(deadline - time.monotonic(), 0)
+
+    def _get_bulk_receivers(self, pairs, bulk, min_submissions=BULK_MIN_SUBMISSIONS):
+        """
+        Get the receivers whose submissions are requested with a single listing. A listing returns every submission
+        of the receiver, so receivers whose last listing was much larger than their pending submissions are not
+        listed again.
+        :param pairs: List of (analysis_email, external_id) tuples
+        :param bulk: Whether bulk requests are wanted
+        :param min_submissions: Pending submissions of a receiver needed to request its listing
+        :return: dict with the set of external ids by analysis_email, only receivers with many submissions
+        """
+        if not bulk or time.monotonic() < self._bulk_disabled_until:
+            return {}
+
+        receivers = {}
+        for analysis_email, external_id in pairs:
+            receivers.setdefault(analysis_email, set()).add(external_id)
+
+        return {analysis_email: external_ids for analysis_email, external_ids in receivers.items()
+                if len(external_ids) >= max(1, min_submissions) and
+                self._listing_sizes.get(analysis_email, 0) <= len(external_ids) * BULK_MAX_LISTING_FACTOR}
+
+    def _add_listing_error(self, results, analysis_email, external_ids, exception):
+        """
+        Handle the exception raised by a receiver listing
+        :param results: Results by (analysis_email, external_id)
+        :param analysis_email:
+        :param external_ids: Requested external ids of the receiver
+        :param exception: Raised Urkund exception
+        :return: True if bulk requests must not be used for the rest of the receivers
+        """
+        if isinstance(exception, (BadRequest, InvalidResponse, NotFound)):
+            # receiver listing is not available, results are requested one by one for a while
+            self._bulk_disabled_until = time.monotonic() + BULK_BACKOFF
+            return True
+
+        # timeouts, throttling or an open circuit are returned for each submission of the receiver
+        for external_id in external_ids:
+            results[(analysis_email, external_id)] = exception
+
+        return False
+
+    def _add_listed(self, results, analysis_email, external_ids, submissions):
+        """
+        Add the requested submissions of a receiver listing to the results
+        :param results: Results by (analysis_email, external_id)
+        :param analysis_email:
+        :param external_ids: Requested external ids of the receiver
+        :param submissions: Listed submissions
+        :return:
+        """
+        self._listing_sizes[analysis_email] = len(submissions)
+        for submission in submissions:
+            if submission.get('ExternalId') in external_ids:
+                results.setdefault((analysis_email, submission['ExternalId']), []).append(submission)
+
+
+class Submissions(BaseSubmissions):
+    """
+    Submissions class
+    """
+
+    def send(self, external_id, file, analysis_email, email, deadline=None):
+        """
+        Send submission
+        :param external_id:
+        :param file: dict with filename, mimetype and content. Content can be raw bytes or a file handle, which is
+                     uploaded in chunks
+        :param analysis_email:
+        :param email:
+        :param deadline: time.monotonic() value the upload has to finish before
+        :return:
+        """
+        response = self.request.make(verb='POST', url=self._get_url(analysis_email, external_id),
+                                     headers=self._get_send_headers(file, email), data=file['content'],
+                                     operation='upload', deadline=deadline)
+        self._count_state(response)
+
+        return response
+
+    def result(self, external_id, analysis_email, deadline=None):
+        """
+        Get result of submission
+        :param external_id:
+        :param analysis_email:
+        :param deadline: time.monotonic() value the request has to finish before
+        :return:
+        """
+        return self.request.make(verb='GET', url=self._get_url(analysis_email, external_id), operation='result',
+                                 deadline=deadline)
+
+    def results(self, pairs, max_workers=10, timeout=None, bulk=False, bulk_min_submissions=BULK_MIN_SUBMISSIONS):
+        """
+        Get results of many submissions. Submissions not returned by a bulk request, or all of them if bulk is not
+        used, are requested concurrently one by one.
+        :param pairs: List of (analysis_email, external_id) tuples
+        :param max_workers: Maximum number of concurrent requests
+        :param timeout: Seconds to wait for the results, submissions without result are not returned
+        :param bulk: Request all the submissions of a receiver at once. Urkund returns every submission of the
+                     receiver, so it is only worth for receivers with many pending submissions.
+        :param bulk_min_submissions: Pending submissions of a receiver needed to request its listing
+        :return: dict with the list of submissions or the raised Urkund exception by (analysis_email, external_id)
+        """
+        results = {}
+        pairs = list(dict.fromkeys(pairs))
+        if len(pairs) == 0:
+            return results
+
+        deadline = self._get_deadline(timeout)
+        for analysis_email, external_ids in self._get_bulk_receivers(pairs, bulk, bulk_min_submissions).items():
+            try:
+                submissions = self.request.make(verb='GET', url=self._get_url(analysis_email), operation='result',
+                                                deadline=deadline)
+            except BaseUrkundLibException as exception:
+                if self._add_listing_error(results, analysis_email, external_ids, exception):
+                    break
+                continue
+            self._add_listed(results, analysis_email, external_ids, submissions)
+
+        pending = [pair for pair in pairs if pair not in results]
+        if len(pending) == 0:
+            return results
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(int(max_workers), len(pending))))
+        futures = {}
+        for analysis_email, external_id in pending:
+            future = executor.submit(self.result, external_id=external_id, analysis_email=analysis_email,
+                                     deadline=deadline)
+            futures[future] = (analysis_email, external_id)
+
+        done, not_done = wait(futures.keys(), timeout=self._get_remaining(deadline))
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except BaseUrkundLibException as exception:
+                results[futures[future]] = exception
+
+        return results
@@ -13,38 +13,85 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Units module """
+from .cache import metadata_cache, DEFAULT_CACHE_TTL
 
 
-class Units:
+class BaseUnits:
     """
-    Units class
+    Base class of the sync and async units, with the urls and cache keys
     """
     unit = None
     organization = None
     request = None
+    cache_ttl = DEFAULT_CACHE_TTL
 
-    def __init__(self, request):
+    def __init__(self, request, cache_ttl=DEFAULT_CACHE_TTL):
         self.request = request
+        self.cache_ttl = cache_ttl
+
+    @staticmethod
+    def _get_url(unit_id, resource=None):
+        """
+        Get the url of a unit, or of one of its resources
+        :param unit_id:
+        :param resource: Resource of the unit, for instance organizations
+        :return:
+        """
+        url = 'units/'+str(unit_id)
+        if resource is not None:
+            url += "/"+resource
+
+        return url
+
+    def _get_cache_key(self, resource, unit_id):
+        """
+        Get the metadata cache key of a unit or its organizations
+        :param resource: units or organizations
+        :param unit_id:
+        :return:
+        """
+        return self.request.get_cache_key(), resource, unit_id
+
+    def invalidate_cache(self):
+        """
+        Remove the cached units and organizations
+        :return:
+        """
+        metadata_cache.invalidate(self.request.get_cache_key(), 'units')
+        metadata_cache.invalidate(self.request.get_cache_key(), 'organizations')
+
+
+class Units(BaseUnits):
+    """
+    Units class
+    """
 
     def get(self, unit_id):
         """
-        Get unit
+        Get unit. Units are cached for cache_ttl seconds.
         :param unit_id:
         :return:
         """
-        return self.request.make(verb='GET', url='units/'+str(unit_id))
+        return metadata_cache.get_or_set(self._get_cache_key('units', unit_id),
+                                         lambda: self.request.make(verb='GET', url=self._get_url(unit_id),
+                                                                   operation='units'),
+                                         ttl=self.cache_ttl)
 
     def get_organizations(self, unit_id):
         """
-        Get organizations of unit
+        Get organizations of unit. Organizations are cached for cache_ttl seconds.
         :param unit_id:
         :return:
         """
-        return self.request.make(verb='GET', url='units/'+str(unit_id)+"/organizations")
+        return metadata_cache.get_or_set(self._get_cache_key('organizations', unit_id),
+                                         lambda: self.request.make(verb='GET',
+                                                                   url=self._get_url(unit_id, 'organizations'),
+                                                                   operation='units'),
+                                         ttl=self.cache_ttl)
 
     def get_all(self):
         """
         Get all units
         :return:
         """
-        return self.request.make(verb='GET', url='units')
+        return self.request.make(verb='GET', url='units', operation='units')